@@ -4,6 +4,8 @@ import math
 #import copy
 import numpy as np
 import pygame
+import synth_dsp
+import synth_filter
 
 from guizero import App, Window, Drawing, Box, PushButton, Combo, Slider, Text
 
@@ -22,6 +24,7 @@ SUSTAIN_LEVEL = 50
 RELEASE = 100
 
 GRAPH_MARGIN = 5
+MAX_Q_FACTOR = 6
 # Debug levels: 0 = none, 1 = basic, 2 = long-winded.
 debug_level = 1
 
@@ -59,7 +62,7 @@ class View:
         Text(self.panel_1, grid=[1,0], text="Frequency control")
         self.frequency_slider = Slider(self.panel_1, grid=[1,1], start=0, end=90, width=180, command=self._handle_set_frequency)
         Text(self.panel_1, grid=[2,0], text="Filter Q factor")
-        self.q_factor_slider = Slider(self.panel_1, grid=[2,1], start=1, end=6, command=self._handle_set_q_factor)
+        self.q_factor_slider = Slider(self.panel_1, grid=[2,1], start=1, end=MAX_Q_FACTOR, command=self._handle_set_q_factor)
         self.test_button = PushButton(self.panel_1, grid=[3,0], text="Test", command=self._handle_request_test)
         
         # set up exit function
@@ -127,7 +130,7 @@ class View:
         self.scope.clear()
         self.scope.bg = "dark gray"
                     
-    def draw_graph(self, graph, line_colour="light green"):
+    def draw_graph(self, graph, line_colour="light green", line_width=2):
         min_y = -60.0
         max_y = 10.0
         range_y = max_y - min_y
@@ -152,7 +155,7 @@ class View:
         for i in range(num_points // sub_sampling_factor):
             plot_y = graph[int(i * sub_sampling_factor)] 
             plot_x = i * sub_sampling_factor
-            self.draw_scope_line(previous_x, previous_y, plot_x, plot_y, colour=line_colour, width=2)
+            self.draw_scope_line(previous_x, previous_y, plot_x, plot_y, colour=line_colour, width=line_width)
             previous_x = plot_x
             previous_y = plot_y
         
@@ -204,6 +207,13 @@ class Model:
         tone = np.sin(radians_per_msec * times_msec)
         return tone
 
+    # Create a unit-amplitude sine wave whose frequency rises exponentially from min_frequency to max_frequency.
+    def sine_sweep(self, min_frequency, max_frequency):
+        times_sec = np.linspace(0, self.max_duration / 1000, int(self.sample_rate * self.max_duration / 1000), False)
+        frequencies = min_frequency * np.power(max_frequency / min_frequency, times_sec * 1000 / self.max_duration)
+        phase = np.cumsum(2 * np.pi * frequencies / self.sample_rate)
+        return np.sin(phase)
+
     # VCF - Voltage Controlled Filters.
     # tone = input waveform to be filtered
     # freq_control = control signal to set filter centre frequency for bandpass and notch filters, or
@@ -213,50 +223,10 @@ class Model:
     # q_factor = ratio of filter centre frequency divided by 3dB bandwidth (approximately).
     def voltage_controlled_filters(self, tone, freq_control, q_factor):
         
-        # Truncate raw tone to length of control waveform
-        tone = tone[:len(freq_control)]
-        
-        # Calculate low pass filter coefficients (time-varying).
-        alpha = np.zeros(len(freq_control))
-        for i in range(len(freq_control)):
-            alpha[i] = min(1.0, math.pow(freq_control[i], 1.5) / 16.5)
-        #self._debug_2("VCF signal length = " + str(len(tone)))
-        
-        # Clear stores for HP and LP outputs.
-        high_pass = np.zeros(len(tone) + 2)
-        low_pass = np.zeros(len(tone) + 2)
-        x0 = x1 = x2 = x3 = x4 = 0
-        
-        for i in range(len(tone)-2):
-            x0 = (alpha[i] * tone[i]) + ((1.0 - alpha[i]) * x1) 
-            x2 = (alpha[i] * x1) + ((1.0 - alpha[i]) * x3)
-            low_pass[i] = x3
-            high_pass[i] = tone[i] - x2
-            x3 = x2
-            x1 = x0
+        low_pass, high_pass = self.low_high_pass_filters(tone, freq_control)
+        band_pass, notch = self._bandpass_notch_filters(tone, freq_control, q_factor)
         
-        # Bandpass and bandstop (notch) biquadratic filters.
-        band_pass = np.zeros(len(tone) + 2)
-        notch = np.zeros(len(tone) + 2)
-        x0 = x1 = x2 = x3 = x4 = 0
-        for i in range(len(tone)):
-            # Recalculate filter coefficients, every 1.45 milliseconds.
-            if i % 64 == 0:
-                fc = min(0.4 * SAMPLE_RATE, (LOWEST_TONE * np.power(2, (freq_control[i]))) + 0.5)
-                R = 1 - (np.pi * fc / (q_factor * SAMPLE_RATE))
-                b2 = - R
-                a1 = - 2 * R * np.cos(2 * np.pi * fc / SAMPLE_RATE)
-                a2 = R * R            
-                rescale = 1 - R
-            
-            # Calculate biquad filter.
-            x0 = tone[i] - (a1 * x1) - (a2 * x2)
-            band_pass[i] = rescale * (x0 + (b2 * x2))
-            notch[i] = tone[i] - band_pass[i]
-            x2 = x1
-            x1 = x0
-        
-        return low_pass[2:], high_pass[2:], band_pass[2:], notch[2:]
+        return low_pass, high_pass, band_pass, notch
 
 
     def low_high_pass_filters(self, tone, freq_control):
@@ -265,23 +235,17 @@ class Model:
         tone = tone[:len(freq_control)]
         
         # Calculate low pass filter coefficients (time-varying).
-        alpha = np.zeros(len(freq_control))
-        for i in range(len(freq_control)):
-            alpha[i] = min(1.0, math.pow(freq_control[i], 1.5) / 16.5)
+        alpha = np.minimum(1.0, np.power(freq_control, 1.5) / 16.5)
         self._debug_2("LPF signal length = " + str(len(tone)))
         
         # Clear stores for HP and LP outputs.
         high_pass = np.zeros(len(tone) + 2)
         low_pass = np.zeros(len(tone) + 2)
-        x0 = x1 = x2 = x3 = x4 = 0
         
-        for i in range(len(tone)-2):
-            x0 = (alpha[i] * tone[i]) + ((1.0 - alpha[i]) * x1) 
-            x2 = (alpha[i] * x1) + ((1.0 - alpha[i]) * x3)
-            low_pass[i] = x3
-            high_pass[i] = tone[i] - x2
-            x3 = x2
-            x1 = x0
+        # Run the filters sample by sample (compiled if possible, see synth_dsp.py).
+        num_samples = max(0, len(tone) - 2)
+        low_pass[:num_samples], high_pass[:num_samples] = synth_dsp.low_high_pass_filters(tone[:num_samples],
+                                                                                          alpha[:num_samples])
         
         return low_pass[2:], high_pass[2:]
 
@@ -294,29 +258,29 @@ class Model:
         
         # Truncate raw tone to length of control waveform (plus 2 to allow for output truncation.
         tone = tone[:(len(freq_control) + 2)]
+        # Extend the control waveform to match, holding its last value.
+        freq_control = np.concatenate((freq_control, freq_control[-1:], freq_control[-1:]))
+        
+        band_pass, notch = self._bandpass_notch_filters(tone, freq_control, q_factor)
+        
+        return notch
+    
+    # Bandpass and bandstop (notch) biquadratic filters.
+    def _bandpass_notch_filters(self, tone, freq_control, q_factor):
+        
+        # Truncate raw tone to length of control waveform
+        tone = tone[:len(freq_control)]
+        
+        # Convert the control signal to centre frequencies, in Hz.
+        centre_freqs = np.minimum(0.4 * self.sample_rate, (LOWEST_TONE * np.power(2, freq_control[:len(tone)])) + 0.5)
         
-        # Bandpass and bandstop (notch) biquadratic filters.
         band_pass = np.zeros(len(tone) + 2)
         notch = np.zeros(len(tone) + 2)
-        x0 = x1 = x2 = x3 = x4 = 0
-        for i in range(len(tone)):
-            # Recalculate filter coefficients, every 1.45 milliseconds.
-            if i % 64 == 0:
-                fc = min(0.4 * SAMPLE_RATE, (LOWEST_TONE * np.power(2, (freq_control[i]))) + 0.5)
-                R = 1 - (np.pi * fc / (q_factor * SAMPLE_RATE))
-                b2 = - R
-                a1 = - 2 * R * np.cos(2 * np.pi * fc / SAMPLE_RATE)
-                a2 = R * R            
-                rescale = 1 - R
-            
-            # Calculate biquad filter.
-            x0 = tone[i] - (a1 * x1) - (a2 * x2)
-            band_pass[i] = rescale * (x0 + (b2 * x2))
-            notch[i] = tone[i] - band_pass[i]
-            x2 = x1
-            x1 = x0
-        
-        return notch[2:]
+        # Run the filter sample by sample (compiled if possible, see synth_dsp.py).
+        band_pass[:len(tone)] = synth_dsp.bandpass_filter(tone, centre_freqs, q_factor, self.sample_rate)
+        notch[:len(tone)] = tone - band_pass[:len(tone)]
+        
+        return band_pass[2:], notch[2:]
     
     
     def _debug_1(self, message):
@@ -371,78 +335,49 @@ if __name__ == "__main__":
             num_tones = int(12 * math.log2(0.5 * SAMPLE_RATE / LOWEST_TONE))
             print("Number of semitones = " + str(num_tones))
             
-            lp_gain = np.zeros(num_tones)
-            hp_gain = np.zeros(num_tones)
-            bp_gain = np.zeros(num_tones)
-            bs_gain = np.zeros(num_tones)
-            
-            cutoff_freq = 0
-            cutoff_gain = 1.0
+            # Calculate the filter gains for all test tones (and all Q factors) from the filter coefficients,
+            # instead of filtering one test tone at a time.
+            start = time.perf_counter()
+            frequencies = np.floor((LOWEST_TONE * np.power(2, np.arange(num_tones) / 12)) + 0.5)
+            control = self.frequency_control + 0.001
+            q_factors = np.arange(1, MAX_Q_FACTOR + 1)
+            gains = {}
+            for filter_type in ["Lowpass", "Highpass", "Bandpass", "Notch"]:
+                b, a = synth_filter.filter_coefficients(filter_type, control, q_factors, SAMPLE_RATE)
+                gains[filter_type] = synth_filter.gain_db(synth_filter.frequency_response(b, a, frequencies, SAMPLE_RATE))
+            q_index = int(np.argmin(np.abs(q_factors - self.q_factor)))
+            print("Frequency response seconds = " + str(time.perf_counter() - start))
             
-            # Generate a range of tones and pass them through the filter function
-            for semitone in range(num_tones):
-                frequency = int((LOWEST_TONE * np.power(2, semitone/12)) + 0.5)
-                
-                #frequency = 18350 + semitone
-                
-                sine_tone = self.model.sine_wave(frequency)
+            lp_gain = gains["Lowpass"][q_index]
+            hp_gain = gains["Highpass"][q_index]
+            bp_gain = gains["Bandpass"][q_index]
+            bs_gain = gains["Notch"][q_index]
             
-                # Fade in test signal over 10 milliseconds to avoid transients
-                fade_in = min(SAMPLE_RATE // 100, len(sine_tone) // 4)
-                for i in range(fade_in):
-                    sine_tone[i] = (i / fade_in) * sine_tone[i]
-            
-                #print("Sine wave, number of samples = ", len(sine_tone))
-    
-                control = np.ones(len(sine_tone)) * (self.frequency_control + 0.001)
+            below_cutoff = np.nonzero(lp_gain <= -3.0)[0]
+            cutoff_freq = 0 if len(below_cutoff) == 0 else int(frequencies[below_cutoff[0]])
+            cutoff_gain = 1.0 if len(below_cutoff) == 0 else np.power(10, lp_gain[below_cutoff[0]] / 20)
+            for semitone in np.nonzero(bp_gain > -5)[0]:
+                print("Bandpass frequency, gain = " + str(int(frequencies[semitone])) + ", " + str(bp_gain[semitone]))
             
-                lp, hp, bp, bs =  self.model.voltage_controlled_filters(sine_tone, control, self.q_factor)
-            
-                lp_range = np.nanmax(lp) - np.nanmin(lp)
-                hp_range = np.nanmax(hp) - np.nanmin(hp)
-                bp_range = np.nanmax(bp) - np.nanmin(bp)
-                bs_range = np.nanmax(bs) - np.nanmin(bs)
-                
-                if lp_range <= 0:
-                    print("WARNING: semitone, lp_range = " + str(semitone) + ", " + str(lp_range))
-                if hp_range <= 0:
-                    print("WARNING: semitone, hp_range = " + str(semitone) + ", " + str(hp_range))
-                if bp_range <= 0:
-                    print("WARNING: semitone, bp_range = " + str(semitone) + ", " + str(bp_range))
-                if bs_range <= 0:
-                    print("WARNING: semitone, bs_range = " + str(semitone) + ", " + str(bs_range))
-                    
-                    
-                if lp_range > 0.8 and lp_range < 1.414:
-                    print("3dB cutoff at " + str(frequency))
-                    if cutoff_freq == 0:
-                        cutoff_freq = frequency
-                        cutoff_gain = lp_range / 2
-                
-                # Convert filter gain to decibels
-                lp_gain[semitone] = 20 * math.log10(lp_range / 2)
-                hp_gain[semitone] = 20 * math.log10(hp_range / 2)
-                bp_gain[semitone] = 20 * math.log10(bp_range / 2)
-                bs_gain[semitone] = 20 * math.log10(bs_range / 2)
-                
-                if bp_gain[semitone] > -5:
-                    print("Bandpass frequency, gain = " + str(frequency) + ", " + str(bp_gain[semitone]))
-                
-                if self.filter == "Lowpass":
-                    self.view.play_sound(sine_tone)
-                    print("Filter = Lowpass")
-                elif self.filter == "Highpass":
-                    self.view.play_sound(hp)
-                    print("Filter = Highpass")
-                elif self.filter == "Bandpass":
-                    self.view.play_sound(bp)
-                    print("Filter = Bandpass")
-                elif self.filter == "Notch":
-                    self.view.play_sound(bs)
-                    print("Filter = Notch")
+            # Play one sweep through all the test tones, through the selected filter.
+            sweep = self.model.sine_sweep(LOWEST_TONE, frequencies[-1])
+            lp, hp, bp, bs = self.model.voltage_controlled_filters(sweep, np.full(len(sweep), control), self.q_factor)
+            if self.filter == "Lowpass":
+                self.view.play_sound(lp)
+            elif self.filter == "Highpass":
+                self.view.play_sound(hp)
+            elif self.filter == "Bandpass":
+                self.view.play_sound(bp)
+            elif self.filter == "Notch":
+                self.view.play_sound(bs)
+            print("Filter = " + self.filter)
                     
-            #self.view.show_graph(gain)
             self.view.prepare_graph()
+            # Show the bandpass and notch responses for the other Q factors in the background.
+            for q in range(len(q_factors)):
+                if q != q_index:
+                    self.view.draw_graph(gains["Bandpass"][q], "bisque", 1)
+                    self.view.draw_graph(gains["Notch"][q], "light blue", 1)
             self.view.draw_graph(lp_gain, "light green")
             self.view.draw_graph(bp_gain, "orange")
             self.view.draw_graph(hp_gain, "red")
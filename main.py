@@ -4,5 +4,7 @@ import synth_control
 # App
 # ------------------------------
 
-synth = synth_control.Controller()
-synth.main()
+# (The main guard stops worker processes, used to render voices, from starting another synth.)
+if __name__ == "__main__":
+    synth = synth_control.Controller()
+    synth.main()
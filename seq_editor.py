@@ -2,8 +2,10 @@
 # Imports
 # ------------------------------
 import guizero
+import numpy as np
 
 import synth_constants as const
+import synth_pitch
 
 # ------------------------------
 # Module globals
@@ -13,7 +15,23 @@ NUM_VISIBLE_TIMESLOTS = 60
 MAX_WINDOW_HEIGHT = 800
 WAFFLE_PIXEL_DIM = int((MAX_WINDOW_HEIGHT - 80) // const.NUM_KEYS)
 WINDOW_WIDTH = max(800, int((NUM_VISIBLE_TIMESLOTS + 7) * WAFFLE_PIXEL_DIM))
-WINDOW_HEIGHT = (const.NUM_KEYS * WAFFLE_PIXEL_DIM) + 80
+WINDOW_HEIGHT = (const.NUM_KEYS * WAFFLE_PIXEL_DIM) + 140
+BOARD_WIDTH = NUM_VISIBLE_TIMESLOTS + 3
+KEYBOARD_COLUMNS = 3
+
+# Board colours, as (red, green, blue)
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+GRID_GREY = (230, 230, 230)
+CURSOR_GREY = (64, 64, 64)
+
+# Lengths of new notes, in timeslots.
+NOTE_LENGTH_NAMES = ["1 slot notes", "2 slot notes", "4 slot notes", "8 slot notes"]
+
+# Song arrangement: how many times the sequence is played when added to the song, and its transposition.
+REPEAT_NAMES = ["Play 1 time", "Play 2 times", "Play 4 times", "Play 8 times"]
+TRANSPOSE_NAMES = [("%+d" % semitones) + " semitones" for semitones in range(-12, 13)]
+
 debug_level = 2
 
 # ------------------------------
@@ -26,6 +44,8 @@ class Seq_Editor:
         self.seq_voice_checks = []
         self.seq_offset = 0
         self.old_pixel_colours = []
+        # Copy of the colours shown on the board, indexed [y, x, rgb], so that only changed pixels are repainted.
+        self.board_image = np.zeros((const.NUM_KEYS, BOARD_WIDTH, 3), dtype=np.uint8)
        
 
     def main(self):
@@ -41,10 +61,9 @@ class Seq_Editor:
         
         self.seq_box = guizero.Box(self.window, layout="grid")
        
-        self.board = guizero.Waffle(self.seq_box, grid=[0,0], align="bottom", width=NUM_VISIBLE_TIMESLOTS+3, height=const.NUM_KEYS,
-                                    pad=0, dim=WAFFLE_PIXEL_DIM, command=self._handle_toggle_seq_note)
-
-        self._draw_seq_keyboard(const.NUM_OCTAVES)
+        self.board = guizero.Waffle(self.seq_box, grid=[0,0], align="bottom", width=BOARD_WIDTH, height=const.NUM_KEYS,
+                                    pad=0, dim=WAFFLE_PIXEL_DIM, command=self._handle_toggle_seq_note, color=WHITE)
+        self.board_image[:, :] = WHITE
         
         self.seq_controls = guizero.Box(self.seq_box, grid=[0,1], layout="grid")
         voice_name_list = []
@@ -59,7 +78,8 @@ class Seq_Editor:
                                      height="fill", command=self._handle_set_seq_beats)
         guizero.Text(self.seq_controls, grid=[3,0], text="    ")
         self.seq_tempo_label = guizero.Text(self.seq_controls, grid=[4,0], text="Tempo, bpm")
-        self.seq_tempo_slider = guizero.Slider(self.seq_controls, grid=[5,0], start=30, end=200, width=342, command=self._handle_set_tempo)
+        self.seq_tempo_slider = guizero.Slider(self.seq_controls, grid=[5,0], start=const.MIN_TEMPO, end=const.MAX_TEMPO, width=342,
+                                               command=self._handle_set_tempo)
         self.seq_play_button = guizero.PushButton(self.seq_controls, grid=[6,0], text="Play", command=self._handle_play_sequence)
         guizero.Text(self.seq_controls, grid=[7,0], text="    ")
         self.seq_scroll_label = guizero.Text(self.seq_controls, grid=[8,0], text="Scroll")
@@ -72,42 +92,96 @@ class Seq_Editor:
             self.seq_voice_checks.append(guizero.CheckBox(self.seq_select_box, grid=[i,1], text=voice_name, command=self._handle_update_board))
             self.seq_voice_checks[i].text_color = self.view.controller.voice_params[i].colour
             self.seq_voice_checks[i].value = 1
+
+        self.seq_file_box = guizero.Box(self.seq_box, grid=[0,3], layout="grid")
+        self.seq_import_button = guizero.PushButton(self.seq_file_box, grid=[0,0], text="Import MIDI",
+                                                    command=self._handle_import_midi)
+        self.seq_export_button = guizero.PushButton(self.seq_file_box, grid=[1,0], text="Export MIDI",
+                                                    command=self._handle_export_midi)
+        guizero.Text(self.seq_file_box, grid=[2,0], text="    ")
+        self.seq_length_combo = guizero.Combo(self.seq_file_box, grid=[3,0], options=NOTE_LENGTH_NAMES,
+                                              height="fill", command=self._handle_set_note_length)
+
+        self.seq_song_box = guizero.Box(self.seq_box, grid=[0,4], layout="grid")
+        self.song_add_button = guizero.PushButton(self.seq_song_box, grid=[0,0], text="Add to song",
+                                                  command=self._handle_add_to_song)
+        self.song_repeat_combo = guizero.Combo(self.seq_song_box, grid=[1,0], options=REPEAT_NAMES, height="fill")
+        self.song_transpose_combo = guizero.Combo(self.seq_song_box, grid=[2,0], options=TRANSPOSE_NAMES,
+                                                  selected=TRANSPOSE_NAMES[12], height="fill")
+        self.song_play_button = guizero.PushButton(self.seq_song_box, grid=[3,0], text="Play song",
+                                                   command=self._handle_play_song)
+        self.song_clear_button = guizero.PushButton(self.seq_song_box, grid=[4,0], text="Clear song",
+                                                    command=self._handle_clear_song)
+        self.song_bounce_button = guizero.PushButton(self.seq_song_box, grid=[5,0], text="Bounce to WAV",
+                                                     command=self._handle_bounce_song)
+        self.song_text = guizero.Text(self.seq_song_box, grid=[6,0], text="")
+        self.bounce_text = guizero.Text(self.seq_song_box, grid=[7,0], text="")
             
        
-    def _draw_seq_keyboard(self, num_octaves=const.NUM_OCTAVES):
-        self._debug_2("In _draw_seq_keyboard()")              
-        for i in range(12 * const.NUM_OCTAVES + 1):
-            if (i % 12) in [1,3,6,8,10]:
-                self.board.set_pixel(0, 12 * const.NUM_OCTAVES - i, "black")
-                self.board.set_pixel(1, 12 * const.NUM_OCTAVES - i, "black")
-                self.board.set_pixel(2, 12 * const.NUM_OCTAVES - i, "black")
-                
-    def _draw_seq_octaves(self):
+    # Paint the black keys of the keyboard into the left hand columns of a board image.
+    def _draw_seq_keyboard(self, image):
+        self._debug_2("In _draw_seq_keyboard()")
+        keys = np.arange(const.NUM_KEYS)
+        black_keys = synth_pitch.is_black_key(keys)
+        image[const.NUM_KEYS - 1 - keys[black_keys], :KEYBOARD_COLUMNS] = BLACK
+
+    # Paint a grey line across the board image for each octave.
+    def _draw_seq_octaves(self, image):
         self._debug_2("In _draw_seq_octaves()")
-        for i in range(const.NUM_OCTAVES + 1):
-            key = 12 * i
-            for timeslot in range(NUM_VISIBLE_TIMESLOTS + 3):
-                self.board.set_pixel(timeslot, const.NUM_KEYS - 1 - key, (230,230,230))
-        
-    def _draw_seq_bars(self):
+        keys = np.arange(const.NUM_KEYS)
+        octave_keys = keys[synth_pitch.is_octave_key(keys)]
+        image[const.NUM_KEYS - 1 - octave_keys, :] = GRID_GREY
+
+    # Paint a grey line down the board image at the start of each bar.
+    def _draw_seq_bars(self, image):
         self._debug_2("In _draw_seq_bars()")
-        for timeslot in range(NUM_VISIBLE_TIMESLOTS):
-            if (timeslot % self.view.controller.sequence.beats_per_bar == 0):
-                for key in range(12 * const.NUM_OCTAVES + 1):
-                    self.board.set_pixel(timeslot+3, const.NUM_KEYS - 1 - key, (230,230,230))
+        timeslots = np.arange(NUM_VISIBLE_TIMESLOTS)
+        bar_starts = timeslots[timeslots % self.view.controller.sequence.beats_per_bar == 0]
+        image[:, bar_starts + KEYBOARD_COLUMNS] = GRID_GREY
 
-    def _draw_seq_notes(self):
+    # Paint the notes of each selected voice that fall inside the visible window into the board image.
+    # The timeslots a note is held for after its start are painted in a paler colour.
+    def _draw_seq_notes(self, image):
         self._debug_2("In _draw_seq_notes()")
+        first = self.seq_offset
+        last = min(self.seq_offset + NUM_VISIBLE_TIMESLOTS, self.view.controller.num_timeslots)
         for vi in range(self.view.controller.num_voices):
             if self.seq_voice_checks[vi].value == 1:
-                for column in range(NUM_VISIBLE_TIMESLOTS):
-                    for key in range(12 * const.NUM_OCTAVES + 1):
-                        if (
-                            column + self.seq_offset < self.view.controller.num_timeslots
-                            and self.view.controller.sequence.notes[vi, column + self.seq_offset, key] > 0
-                        ):
-                            colour = self.view.controller.voice_params[vi].colour
-                            self.board.set_pixel(column+3, const.NUM_KEYS - 1 - key, colour)
+                colour = np.array(self.view.controller.voice_params[vi].colour)
+                notes = self.view.controller.sequence.voice_notes(vi)
+                notes = notes[notes["start"] < last]
+                starts = notes["start"].astype(int)
+                keys = notes["key"].astype(int)
+                held = np.maximum(notes["duration"].astype(int) - 1, 0)
+                # Timeslots 1 to held after each start.
+                steps = np.arange(np.sum(held)) - np.repeat(np.cumsum(held) - held, held) + 1
+                tail_columns = np.repeat(starts, held) + steps
+                tail_keys = np.repeat(keys, held)
+                visible = (tail_columns >= first) & (tail_columns < last)
+                image[const.NUM_KEYS - 1 - tail_keys[visible], tail_columns[visible] - first + KEYBOARD_COLUMNS] = (colour + 255) // 2
+                visible = starts >= first
+                image[const.NUM_KEYS - 1 - keys[visible], starts[visible] - first + KEYBOARD_COLUMNS] = colour
+
+    # Build a complete image of the board as it should look now.
+    def _make_board_image(self):
+        image = np.empty_like(self.board_image)
+        image[:, :] = WHITE
+        self._draw_seq_bars(image)
+        self._draw_seq_octaves(image)
+        self._draw_seq_keyboard(image)
+        self._draw_seq_notes(image)
+        return image
+
+    # Read a pixel colour from a board image as an (r, g, b) tuple of ints, as expected by guizero.
+    def _board_colour(self, x, y, image=None):
+        if image is None:
+            image = self.board_image
+        return tuple(int(c) for c in image[y, x])
+
+    # Set a board pixel and remember its colour, so that the board and its image stay in step.
+    def _set_board_pixel(self, x, y, colour):
+        self.board.set_pixel(x, y, colour)
+        self.board_image[y, x] = colour
 
     def show_sequence(self):
         self._debug_2("In show_sequence()")
@@ -119,24 +193,38 @@ class Seq_Editor:
             beats_name = str(self.view.controller.sequence.beats_per_bar) + " beats/bar"
             self.view.update_combo(self.seq_beats_combo, beats_name)
             self._handle_update_board()
+            self.show_song()
         except:
             self._debug_1("Fatal ERROR in show_sequence().")
             
+    # Show the size of the song arrangement.
+    def show_song(self):
+        self._debug_2("In show_song()")
+        song = self.view.controller.song
+        bars = song.length() // self.view.controller.sequence.beats_per_bar
+        self.song_text.value = ("  Song: " + str(len(song.arrangement)) + " parts, " + str(len(song.patterns))
+                                + " patterns, " + str(bars) + " bars")
+
+    # Show the progress of a song bounce.
+    def show_bounce_status(self, status):
+        self._debug_2("In show_bounce_status: " + status)
+        self.bounce_text.value = "  " + status
+
     # Draw moving grey pixels on the board to show the current timeslot being played.
     def show_cursor(self, timeslot):
         self._debug_2("In show_cursor: timeslot = " + str(timeslot)) 
         cursor_x = max(0, timeslot - self.seq_offset)
         if cursor_x > 1 and len(self.old_pixel_colours) == 2:
             # restore original pixel colours
-            self.board.set_pixel(cursor_x+2, 0, self.old_pixel_colours[0])
-            self.board.set_pixel(cursor_x+2, const.NUM_KEYS-1, self.old_pixel_colours[1])
+            self._set_board_pixel(cursor_x+2, 0, self.old_pixel_colours[0])
+            self._set_board_pixel(cursor_x+2, const.NUM_KEYS-1, self.old_pixel_colours[1])
         # remember pixel colours, then draw grey ones
         if cursor_x + 3 < self.board.width:
             self.old_pixel_colours = []
-            self.old_pixel_colours.append(self.board.get_pixel(cursor_x+3, 0))
-            self.board.set_pixel(cursor_x+3, 0, (64,64,64))
-            self.old_pixel_colours.append(self.board.get_pixel(cursor_x+3, const.NUM_KEYS-1))
-            self.board.set_pixel(cursor_x+3, const.NUM_KEYS-1, (64,64,64))
+            self.old_pixel_colours.append(self._board_colour(cursor_x+3, 0))
+            self._set_board_pixel(cursor_x+3, 0, CURSOR_GREY)
+            self.old_pixel_colours.append(self._board_colour(cursor_x+3, const.NUM_KEYS-1))
+            self._set_board_pixel(cursor_x+3, const.NUM_KEYS-1, CURSOR_GREY)
 
     def _closed_sequence_editor(self):
         self._debug_1("Sequence editor closed")
@@ -150,9 +238,9 @@ class Seq_Editor:
         vi = int(value[6:]) - 1
         self.view.controller.on_request_select_voice(vi)
         if self.view.voice_window_open == False:
-            self.view.controller.on_request_note(15) # Illustrate new voice
+            self.view.controller.on_request_note(const.DEFAULT_KEY) # Illustrate new voice
         self.seq_voice_checks[vi].value = 1
-        self._draw_seq_notes()
+        self._handle_update_board()
 
 
     def _handle_set_seq_beats(self, value):
@@ -170,6 +258,42 @@ class Seq_Editor:
         self._debug_2("In _handle_play_sequence()")
         self.view.controller.on_request_play_sequence()
 
+    def _handle_import_midi(self):
+        self._debug_2("In _handle_import_midi()")
+        filename = self.window.select_file(title="Import MIDI file", filetypes=[["MIDI files", "*.mid"], ["All files", "*.*"]])
+        if filename:
+            self.view.controller.on_request_import_midi(filename)
+
+    def _handle_export_midi(self):
+        self._debug_2("In _handle_export_midi()")
+        filename = self.window.select_file(title="Export MIDI file", filetypes=[["MIDI files", "*.mid"]], save=True)
+        if filename:
+            self.view.controller.on_request_export_midi(filename)
+
+    def _handle_add_to_song(self):
+        self._debug_2("In _handle_add_to_song()")
+        repeats = self.song_repeat_combo.value.split()[1]
+        transpose = self.song_transpose_combo.value.split()[0]
+        self.view.controller.on_request_add_to_song(repeats, transpose)
+
+    def _handle_play_song(self):
+        self._debug_2("In _handle_play_song()")
+        self.view.controller.on_request_play_song()
+
+    def _handle_clear_song(self):
+        self._debug_2("In _handle_clear_song()")
+        self.view.controller.on_request_clear_song()
+
+    def _handle_bounce_song(self):
+        self._debug_2("In _handle_bounce_song()")
+        filename = self.window.select_file(title="Bounce song to WAV file", filetypes=[["WAV files", "*.wav"]], save=True)
+        if filename:
+            self.view.controller.on_request_bounce_song(filename)
+
+    def _handle_set_note_length(self, value):
+        self._debug_2("In _handle_set_note_length()")
+        self.view.controller.on_request_set_note_length(value.split()[0])
+
     def _handle_scroll(self, value):
         self._debug_2("In _handle_scroll()")
         self.seq_offset = int(value)
@@ -178,28 +302,27 @@ class Seq_Editor:
         
     def _handle_toggle_seq_note(self, x, y):
         self._debug_2("In _handle_set_seq_note: " +  str(x) + ", " + str(y))
-        key = (12 * const.NUM_OCTAVES) - y
+        key = const.NUM_KEYS - 1 - y
         if key >= 0:
             self.view.controller.on_request_note(key)
             if x > 2:
                 timeslot = x - 3
                 vi = self.view.controller.voice_index
-                if self.view.controller.sequence.notes[vi, timeslot + self.seq_offset, key] > 0:
-                    colour = "white"
-                else:
-                    colour = self.view.controller.voice_params[vi].colour
-                self.board.set_pixel(timeslot+3, const.NUM_KEYS - 1 - key, colour)
                 self.view.controller.on_request_toggle_sequence_note(timeslot + self.seq_offset, vi, key)
+                # Repaint the whole note, including any tail, and the grid lines under a removed note.
+                self._handle_update_board()
         else:
             self._debug_2("Not a key")
     
+    # Repaint only the board pixels whose colour has changed, e.g. the columns that scrolled into view.
     def _handle_update_board(self):
         self._debug_2("In _handle_update_board: ")
-        self.board.set_all("white")
-        self._draw_seq_bars()
-        self._draw_seq_octaves()
-        self._draw_seq_keyboard()
-        self._draw_seq_notes()
+        new_image = self._make_board_image()
+        changed_y, changed_x = np.nonzero(np.any(new_image != self.board_image, axis=2))
+        self._debug_2("Pixels to repaint = " + str(len(changed_x)))
+        for x, y in zip(changed_x, changed_y):
+            self.board.set_pixel(int(x), int(y), self._board_colour(x, y, new_image))
+        self.board_image = new_image
         
     def _debug_1(self, message):
         global debug_level
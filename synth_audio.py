@@ -5,7 +5,10 @@ import pygame
 import pygame.mixer
 import pygame.sndarray
 import numpy as np
+import threading
 import time
+import synth_constants as const
+import synth_mixer
 
 # ------------------------------
 # Variables
@@ -13,42 +16,94 @@ import time
 # Debug levels: 0 = none, 1 = basic, 2 = long-winded.
 debug_level = 1
 last_output_time = 0
-sound = None
+mixer = synth_mixer.Mixer()
+stream_thread = None
+streaming = False
+
+# ------------------------------
+#  Notes:
+#
+#  1. All notes are played through the streaming mixer (see synth_mixer.py), which applies each voice's
+#     effects. The stream thread keeps one block queued behind the block that pygame is playing.
+#  2. Notes are played at their own level. The mixer's master bus limits the output, instead of each note
+#     being normalised to full scale.
+# ------------------------------
 
 def initialise_audio():
     _debug_2("In initialise_audio()")
+    global stream_thread, streaming
     # initialise stereo mixer (default)
-    pygame.mixer.init()
+    pygame.mixer.init(frequency=const.SAMPLE_RATE)
     pygame.init()
+    streaming = True
+    stream_thread = threading.Thread(target=_stream_audio, daemon=True)
+    stream_thread.start()
 
-def play_sound(wave):
+def play_sound(wave, voice_index=0):
     _debug_2("In play_sound()")
-    global last_output_time, sound
+    global last_output_time
     
-    # Reduce demand on audio output by fading out previous note.
-    if not sound is None:
-        # sound.fadeout(100)
-        sound = None
-    # Ensure that highest value is in 16-bit range
-    max_level = np.max(np.abs(wave))
-    if max_level == 0:
-        _debug_1("WARNING: zero waveform in play_sound().")
-        return -1
-    
-    audio = wave * (2**15 - 1) / max_level
-    # Convert to 16-bit data
-    audio = audio.astype(np.int16)
-    # create a pygame Sound object and play it.
-    sound = pygame.sndarray.make_sound(audio)
-    sound.play()
+    mixer.add_note(voice_index, wave)
     now = time.perf_counter()
     _debug_2("Time since last note = " + str(now-last_output_time))
     last_output_time = now       
     return 0
 
+# Start a gated note, held until note_off() for its key (see synth_envelope.py).
+def note_on(voice_index, note):
+    mixer.note_on(voice_index, note)
+
+def note_off(voice_index, key):
+    mixer.note_off(voice_index, key)
+
+# Input to output latency of recent gated notes: mean and maximum, in milliseconds, or None if there are none.
+# This includes the time the first block of each note waits behind the block being played.
+def get_note_latency():
+    latency = mixer.note_latency()
+    if latency is None:
+        return None
+    block_msecs = 1000 * const.MIX_BLOCK_SIZE / const.SAMPLE_RATE
+    return (1000 * latency[0]) + block_msecs, (1000 * latency[1]) + block_msecs
+
+# Limit the number of notes playing at once (up to const.MAX_POLYPHONY), and how notes are stolen beyond that.
+def set_polyphony(polyphony, policy=None):
+    mixer.set_polyphony(polyphony, policy)
+
+# Set the effects and LFOs of a voice from a snapshot of its parameters.
+def set_voice_effects(voice_index, params):
+    mixer.set_effects(voice_index, params)
+    mixer.set_modulation(voice_index, params)
+
+# Output levels from the master bus meter: peak (dBFS), RMS (dBFS) and limiter gain reduction (dB).
+def get_output_levels():
+    master = mixer.master
+    return master.peak_level_db, master.rms_level_db, master.gain_reduction_db
+
 def stop_audio_output():
     _debug_2("In stop_audio_output()")
+    global streaming
+    streaming = False
+    if not stream_thread is None:
+        stream_thread.join()
     pygame.mixer.music.stop()
+
+# Stream thread: mix the next block whenever the channel's queue is free.
+def _stream_audio():
+    channel = pygame.mixer.Channel(0)
+    num_channels = pygame.mixer.get_init()[2]
+    block_secs = const.MIX_BLOCK_SIZE / const.SAMPLE_RATE
+    while streaming:
+        if channel.get_queue() is None:
+            audio = (mixer.mix_block() * (2**15 - 1)).astype(np.int16)
+            if num_channels == 2:
+                audio = np.column_stack((audio, audio))
+            sound = pygame.sndarray.make_sound(audio)
+            if channel.get_busy():
+                channel.queue(sound)
+            else:
+                channel.play(sound)
+        else:
+            time.sleep(block_secs / 8)
     
 def _debug_1(message):
     global debug_level
@@ -0,0 +1,355 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import collections
+import wave
+import numpy as np
+import synth_constants as const
+import synth_mixer
+import synth_model
+import synth_modulation
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+MASTER_BLOCK_SIZE = 16 * const.MIX_BLOCK_SIZE # Samples per block through the master bus.
+
+# ------------------------------
+#  Notes:
+#
+#  1. A song is bounced (rendered offline) one pattern at a time. The dry audio of each pattern is made
+#     for each voice, including the release tails that run past the end of the pattern, and is then
+#     added into the song at every place the pattern is used, so the tails overlap the next pattern.
+#  2. The audio of each pattern is kept in a Mixdown_Cache, so a pattern that is repeated is only rendered
+#     once, and later bounces re-use it. The cache key is made of everything the audio depends on: the
+#     pattern's notes, the transposition, the timeslot length, the pitch bend and the sound settings of the
+#     voices the pattern uses, and how those voices are mixed (their effects and LFOs).
+#     So there is no need to clear the cache when anything changes. The key and the audio must be made from
+#     the same settings, so a song is bounced with a model of its own, made from the voice snapshots the key is
+#     made from, and a fixed pitch bend (see synth_model.Model.from_snapshots()). Nothing else changes that model.
+#  3. The cache keeps pattern audio up to a memory budget (MIXDOWN_CACHE_SIZE), and when it is full it drops
+#     the least recently used patterns first. Only the voices a pattern uses are stored.
+#  4. The voices are mixed through their effects and the master bus in the same way as the streaming mixer
+#     (see synth_mixer.py), so a bounce sounds like the song played live. Echo and reverb are linear and
+#     time-invariant, so the voices that only use those are put through their effects pattern by pattern,
+#     with the effects tails, and cached pre-mixed. The song is then made by adding up the pre-mixed patterns.
+#     Voices with chorus or tremolo are added up dry, and modulated and put through their effects over the
+#     whole song.
+#  5. The LFOs run from the start of the song. Vibrato is applied as the notes of a pattern are made, from the
+#     vibrato LFO's phase where the pattern is played, so that phase is part of the cache key. A pattern of a
+#     voice with vibrato is only re-used where the LFO is back at the same phase.
+# ------------------------------
+
+# Least recently used cache of pattern audio, limited to budget bytes.
+class Mixdown_Cache:
+    def __init__(self, budget=const.MIXDOWN_CACHE_SIZE * 1024 * 1024):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # The cached pattern audio for a key (see premix_pattern()), or None.
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        num_bytes = _entry_bytes(entry)
+        if num_bytes > self.budget:
+            return
+        if key in self.entries:
+            self.num_bytes -= _entry_bytes(self.entries.pop(key))
+        for audio in entry:
+            audio.flags.writeable = False
+        self.entries[key] = entry
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.budget:
+            self.num_bytes -= _entry_bytes(self.entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+
+# The notes of a pattern that are played: those of the voices in use, transposed by some semitones.
+def pattern_notes(pattern, transpose, num_voices):
+    notes = pattern.notes[pattern.notes["voice"] < num_voices]
+    if transpose != 0:
+        notes = notes.copy()
+        notes["key"] += transpose
+        notes = notes[(notes["key"] >= 0) & (notes["key"] < const.NUM_KEYS)]
+    return notes
+
+# Everything the audio of a pattern depends on (see note 2), when it is played offset samples into the song.
+# voice_params = the snapshots the model's notes are made from. modulation = the song's LFOs (see song_modulation()), or None.
+def pattern_key(model, pattern, transpose, num_voices, timeslot_samples, voice_params, modulation=None, offset=0):
+    voices = np.unique(pattern_notes(pattern, transpose, num_voices)["voice"])
+    sounds = tuple((voice_params[vi].sound_key(), _mix_key(voice_params[vi])) for vi in voices)
+    vibrato_phases = ()
+    if not modulation is None:
+        vibrato_voices = voices[modulation.depths[synth_modulation.PITCH, voices] > 0]
+        vibrato_phases = tuple(np.round(modulation.phases_at(synth_modulation.PITCH, vibrato_voices, offset), 6).tolist())
+    return (pattern.content_hash, transpose, num_voices, round(timeslot_samples, 6), model.pitch_bend, const.EFFECTS_ENABLED,
+            tuple(voices.tolist()), sounds, vibrato_phases)
+
+# Dry audio of a pattern, transposed by some semitones. Returns the voices the pattern uses, and their audio,
+# indexed [voice, sample]. timeslot_samples = length of a timeslot in samples (not necessarily a whole number).
+# modulation = the song's LFOs, for vibrato, and offset = where the pattern starts in the song, in samples.
+def render_pattern(model, pattern, transpose, num_voices, timeslot_samples, modulation=None, offset=0):
+    notes = pattern_notes(pattern, transpose, num_voices)
+    voices, rows = np.unique(notes["voice"], return_inverse=True)
+    starts = np.rint(notes["start"] * timeslot_samples).astype(int)
+    gate_lengths = (notes["duration"] * timeslot_samples).astype(int)
+    segments = []
+    for i in range(len(notes)):
+        note = model.make_gated_note(int(notes["voice"][i]), int(notes["key"][i]), int(notes["velocity"][i]),
+                                     int(gate_lengths[i]), detune=float(notes["detune"][i]))
+        # Play the note to the end of its release.
+        num_samples = int(gate_lengths[i]) + note.envelope.release_length + 1
+        steps = None
+        if not modulation is None and modulation.depths[synth_modulation.PITCH, notes["voice"][i]] > 0:
+            steps = modulation.steps([notes["voice"][i]], num_samples, offset + starts[i])[0]
+        segments.append(note.next_segment(num_samples, steps))
+    num_samples = int(np.ceil(pattern.length * timeslot_samples))
+    if len(segments) > 0:
+        num_samples = max(num_samples, max(starts[i] + len(segments[i]) for i in range(len(segments))))
+    audio = np.zeros((len(voices), num_samples))
+    for i in range(len(segments)):
+        audio[rows[i], starts[i]:starts[i] + len(segments[i])] += segments[i]
+    return voices, audio
+
+# Mix the voices of a pattern that are mixed in a time-invariant way (see note 4) through their effects,
+# including the effects tails. Returns the mixed track, then the other voices and their dry audio.
+def premix_pattern(voices, audio, voice_params, sample_rate=const.SAMPLE_RATE):
+    invariant = np.array([_time_invariant(voice_params[vi]) for vi in voices], dtype=bool)
+    premix = np.zeros(audio.shape[1])
+    for row in np.flatnonzero(invariant):
+        premix = _add_at(premix, 0, apply_effects(audio[row], voice_params[voices[row]], sample_rate))
+    return premix, voices[~invariant], audio[~invariant]
+
+# Play one voice's dry audio through the voice's effects, to the end of the effects tail, at the voice gain.
+def apply_effects(dry, params, sample_rate=const.SAMPLE_RATE):
+    bus = synth_mixer.Effects_Bus(sample_rate)
+    bus.set_params(params)
+    if not (const.EFFECTS_ENABLED and bus.is_active()):
+        return const.VOICE_GAIN * dry
+    block_size = const.MIX_BLOCK_SIZE
+    num_blocks = int(np.ceil((len(dry) + bus.tail_length()) / block_size))
+    wet = np.zeros(num_blocks * block_size)
+    wet[:len(dry)] = dry
+    for start in range(0, len(wet), block_size):
+        block = wet[start:start + block_size]
+        wet[start:start + block_size] = bus.process(block, not np.any(block))
+    return const.VOICE_GAIN * wet
+
+# Render a whole song (synth_sequence.Song) to audio, in the range -1.0 to +1.0.
+# model = a model that makes its notes from voice_params, and that nothing else changes (see note 2).
+# voice_params = snapshots of the parameters of each voice, for its sound and its effects.
+# cache = Mixdown_Cache to keep pattern audio in for later bounces, or None to keep it for this bounce only.
+def bounce_song(model, song, voice_params, num_voices, timeslot_samples, sample_rate=const.SAMPLE_RATE, cache=None):
+    if cache is None:
+        cache = Mixdown_Cache(np.inf)
+    song_samples = int(np.ceil(song.length() * timeslot_samples))
+    premix = np.zeros(song_samples)
+    dry = np.zeros((num_voices, song_samples))
+    modulation = song_modulation(voice_params, num_voices, sample_rate)
+    for start, pattern_index, transpose in song.occurrences():
+        pattern = song.patterns[pattern_index]
+        offset = int(np.rint(start * timeslot_samples))
+        key = pattern_key(model, pattern, transpose, num_voices, timeslot_samples, voice_params, modulation, offset)
+        entry = cache.get(key)
+        if entry is None:
+            voices, audio = render_pattern(model, pattern, transpose, num_voices, timeslot_samples, modulation, offset)
+            entry = premix_pattern(voices, audio, voice_params, sample_rate)
+            cache.put(key, entry)
+        pattern_premix, voices, pattern_dry = entry
+        premix = _add_at(premix, offset, pattern_premix)
+        if len(voices) > 0:
+            dry = _add_at(dry, offset, pattern_dry, voices)
+    _debug_2("Mixdown cache: hits = " + str(cache.hits) + ", misses = " + str(cache.misses) + ", evictions = "
+             + str(cache.evictions) + ", megabytes = " + str(cache.num_bytes / (1024 * 1024)))
+    return mix_voices(dry, voice_params, sample_rate, premix)
+
+# Mix the dry audio of each voice through the voice's effects and the master bus, as the mixer does.
+# premix = audio that has already been through its effects, at the voice gain, to add in before the master bus.
+def mix_voices(dry, voice_params, sample_rate=const.SAMPLE_RATE, premix=None):
+    mix = np.zeros(dry.shape[1]) if premix is None else premix.copy()
+    modulation = song_modulation(voice_params, dry.shape[0], sample_rate)
+    if np.any(modulation.depths[synth_modulation.AMPLITUDE] > 0):
+        dry = dry.copy()
+        modulation.apply_amplitude(dry)
+    for vi in range(dry.shape[0]):
+        if np.any(dry[vi]):
+            mix = _add_at(mix, 0, apply_effects(dry[vi], voice_params[vi], sample_rate))
+    # The limiter gives the same output for any block size, so bigger blocks are used than when streaming.
+    master = synth_mixer.Master_Bus(sample_rate)
+    block_size = MASTER_BLOCK_SIZE
+    num_blocks = int(np.ceil((len(mix) + master.look_ahead) / block_size))
+    mix = np.pad(mix, (0, num_blocks * block_size - len(mix)))
+    output = np.concatenate([master.process(mix[start:start + block_size]) for start in range(0, len(mix), block_size)])
+    return np.clip(output[master.look_ahead:], -1.0, 1.0)
+
+# The LFOs of the voices, running from the start of the song (see synth_modulation.py).
+def song_modulation(voice_params, num_voices, sample_rate=const.SAMPLE_RATE):
+    modulation = synth_modulation.Modulation_Matrix(num_voices, sample_rate)
+    for vi in range(num_voices):
+        modulation.set_voice(vi, voice_params[vi])
+    return modulation
+
+# Write mono audio, in the range -1.0 to +1.0, to a 16-bit WAV file.
+def write_wav(filename, audio, sample_rate=const.SAMPLE_RATE):
+    samples = (audio * (2**15 - 1)).astype("<i2")
+    with wave.open(filename, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+    _debug_1("Wrote " + str(len(samples) / sample_rate) + " seconds of audio to " + filename)
+
+
+# Add audio into a track (or the given rows of a 2D track), starting at offset, making the track longer if need be.
+def _add_at(track, offset, audio, rows=None):
+    end = offset + audio.shape[-1]
+    if end > track.shape[-1]:
+        padding = [(0, 0)] * (track.ndim - 1) + [(0, end - track.shape[-1])]
+        track = np.pad(track, padding)
+    if rows is None:
+        track[..., offset:end] += audio
+    else:
+        track[rows, offset:end] += audio
+    return track
+
+def _entry_bytes(entry):
+    return sum(audio.nbytes for audio in entry)
+
+# Echo and reverb are linear and time-invariant, so a pattern can be put through them on its own, then added
+# into the song. Chorus is not, as its delay is swept with time, and nor is tremolo, which runs with the song.
+def _time_invariant(params):
+    return ((params.chorus_depth == 0 or not const.EFFECTS_ENABLED)
+            and not synth_modulation.is_modulated(params, synth_modulation.AMPLITUDE))
+
+# The settings a voice's notes are mixed with.
+def _mix_key(params):
+    return tuple(getattr(params, name) for name in synth_model.EFFECTS_PARAMETERS + synth_model.MODULATION_PARAMETERS)
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_bounce.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_bounce.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+    import synth_envelope
+    import synth_sequence
+
+    debug_level = 2
+
+    class Test_Params:
+        attack = 10
+        decay = 30
+        sustain_level = 50
+        release = 60
+        tremolo_rate = 0
+        tremolo_depth = 0
+        vibrato_rate = 0
+        vibrato_depth = 0
+        delay_time = 120
+        delay_feedback = 30
+        chorus_depth = 0
+        reverb_level = 20
+
+        @classmethod
+        def sound_key(cls):
+            return ("Sine", cls.attack, cls.decay, cls.sustain_level, cls.release)
+
+    # Stands in for the model: makes gated notes from sine tones.
+    class Test_Model:
+        pitch_bend = 0.0
+
+        def make_gated_note(self, voice_index, key, velocity=127, gate_length=None, received_time=None, detune=0.0):
+            frequency = const.LOWEST_TONE * np.exp2((key + detune / 100) / 12)
+            tone = np.sin(2 * np.pi * frequency * np.arange(const.SAMPLE_RATE // 2) / const.SAMPLE_RATE)
+            envelope = synth_envelope.Envelope_Generator(Test_Params, const.SAMPLE_RATE, gate_length)
+            return synth_envelope.Gated_Note(tone, synth_envelope.loop_start(frequency, len(tone)), envelope, key,
+                                             gain=velocity / 127)
+
+    rng = np.random.default_rng(1)
+    song = synth_sequence.Song()
+    for p in range(3):
+        notes = np.zeros(24, dtype=synth_sequence.NOTE_RECORD)
+        notes["voice"] = rng.integers(0, 2, len(notes))
+        notes["start"] = rng.integers(0, 16, len(notes))
+        notes["key"] = rng.integers(30, 60, len(notes))
+        notes["duration"] = rng.integers(1, 4, len(notes))
+        notes["velocity"] = 100
+        song.add_pattern(notes, 16)
+    for i in range(8):
+        song.append(i % 3, 4, [0, 0, 5, -7][i % 4])
+    timeslot_samples = 60.0 / (100 * 4) * const.SAMPLE_RATE
+
+    # Voice 1 has chorus and tremolo, so it is mixed over the whole song, not pattern by pattern. Its vibrato,
+    # at 5 Hz, makes 12 cycles in each 16 timeslot pattern, so its patterns can still be re-used.
+    class Test_Chorus_Params(Test_Params):
+        chorus_depth = 30
+        tremolo_rate = 5
+        tremolo_depth = 10
+        vibrato_rate = 50
+        vibrato_depth = 20
+
+    voice_params = [Test_Params, Test_Chorus_Params]
+
+    # Every voice added up dry and put through its effects over the whole song, for comparison.
+    start = time.perf_counter()
+    dry = np.zeros((2, 0))
+    modulation = song_modulation(voice_params, 2)
+    for occurrence_start, pattern_index, transpose in song.occurrences():
+        offset = int(np.rint(occurrence_start * timeslot_samples))
+        voices, audio = render_pattern(Test_Model(), song.patterns[pattern_index], transpose, 2, timeslot_samples,
+                                       modulation, offset)
+        dry = _add_at(dry, offset, audio, voices)
+    unmixed = mix_voices(dry, voice_params)
+    finish = time.perf_counter()
+    _debug_1("Without pre-mixing: bounced in seconds = " + str(finish - start))
+
+    # With no room in the cache, every pattern is rendered each time it is played. Then a cache with room
+    # for all the patterns, bounced twice, then a cache with room for only a few of them.
+    results = []
+    for budget, num_bounces in [(0, 1), (const.MIXDOWN_CACHE_SIZE * 1024 * 1024, 2), (3 * 1024 * 1024, 1)]:
+        cache = Mixdown_Cache(budget)
+        for i in range(num_bounces):
+            start = time.perf_counter()
+            audio = bounce_song(Test_Model(), song, voice_params, 2, timeslot_samples, cache=cache)
+            finish = time.perf_counter()
+            results.append(audio)
+            _debug_1("Cache budget MB = " + str(budget / (1024 * 1024)) + ": song of " + str(song.length())
+                     + " timeslots, " + str(len(audio) / const.SAMPLE_RATE) + " seconds, bounced in seconds = "
+                     + str(finish - start))
+    # Re-used patterns of the voice with vibrato were made at the same LFO phase, to rounding error.
+    _debug_1("Largest difference between bounces = " + str(max(np.max(np.abs(results[0] - audio)) for audio in results))
+             + ", peak = " + str(np.max(np.abs(audio))) + ", largest difference from no pre-mixing = "
+             + str(np.max(np.abs(audio - unmixed[:len(audio)]))) + ", lengths = " + str((len(audio), len(unmixed))))
+
+    filename = os.path.join(tempfile.gettempdir(), "synth_bounce_test.wav")
+    write_wav(filename, audio)
+    os.remove(filename)
@@ -12,11 +12,57 @@ MAX_TREMOLO_DEPTH = 100
 MAX_RING_MOD_RATE = 50
 MAX_VIBRATO_RATE = 100
 MAX_VIBRATO_DEPTH = 100
+VIBRATO_TOP_RATE = 10.0 # Hz, at a vibrato rate of 100%.
+VIBRATO_TOP_DEPTH = 100.0 # Cents either side of the note's pitch, at a vibrato depth of 100%.
 MAX_HARMONIC_BOOST = 100
+WAVETABLE_SIZE = 4096 # Samples in one cycle of a wavetable, e.g. a boosted waveform.
+MAX_HARMONICS = 32 # Harmonics of an additive voice.
+DEFAULT_HARMONIC_LEVELS = (100, 50, 33, 25, 20, 17, 14, 12) # % of full scale, like the start of a sawtooth.
 MAX_UNISON_VOICES = 8
 MAX_UNISON_DETUNE = 100
 UNISON_SCALE_FACTOR = 0.20 # Used to adjust the detune percentage.
 
+MAX_PITCH_BEND = 200 # cents
+
+# Voltage controlled filter constants (frequencies in semitones above the lowest keyboard tone)
+
+FILTER_LOWEST_TONE = 110 # Hz, the filter frequency when the cutoff is 0.
+MAX_FILTER_CUTOFF = 90
+MAX_FILTER_RESONANCE = 10 # Filter Q factor
+MAX_FILTER_ENV_DEPTH = 48
+DEFAULT_FILTER_CUTOFF = 90
+DEFAULT_FILTER_RESONANCE = 2
+
+# Effects constants (times in milli-second units)
+
+MAX_DELAY_TIME = 500
+MAX_DELAY_FEEDBACK = 90
+MAX_CHORUS_DEPTH = 100
+MAX_REVERB_LEVEL = 100
+
+# Streaming mixer
+
+MIX_BLOCK_SIZE = 1024 # Samples per output block, i.e. about 23 milliseconds.
+VOICE_GAIN = 0.5 # Gain of each voice into the master bus, leaving headroom for chords.
+
+# Polyphony: the mixer has a fixed number of note slots, shared by all the voices.
+
+MAX_POLYPHONY = 32 # Note slots, i.e. the most notes that can sound at once.
+STEAL_POLICY = "Oldest" # Note replaced when all the slots are in use: "Oldest", "Quietest" or "Same key".
+
+# Song bounces (offline rendering)
+
+MIXDOWN_CACHE_SIZE = 256 # Megabytes of rendered pattern audio kept for re-use.
+
+# Master bus limiter and meter (times in milli-second units)
+
+LIMITER_THRESHOLD = 0.95 # Peak output level, full scale = 1.0.
+LIMITER_LOOK_AHEAD = 5
+LIMITER_ATTACK_DB = 12 # Largest gain reduction that is ramped in over the look-ahead time.
+LIMITER_RELEASE_DB = 20 # Gain recovery in LIMITER_RELEASE_TIME.
+LIMITER_RELEASE_TIME = 200
+METER_DECAY_DB = 20 # Peak meter fall back, dB per second.
+
 # ADSR shaper constants (times in milli-second units)
 
 MAX_ATTACK = 100
@@ -31,12 +77,29 @@ DEFAULT_SUSTAIN = 100
 DEFAULT_SUSTAIN_LEVEL = 50
 DEFAULT_RELEASE = 20
 
-NUM_OCTAVES = 3
-LOWEST_TONE = 110
-NUM_KEYS = (12 * NUM_OCTAVES) + 1
+ENVELOPE_BANK_SIZE = 64 # Envelopes kept for re-use, by their settings.
+
+# Keyboard range: the 88 keys of a piano, from A0 to C8.
+
+NUM_KEYS = 88
+LOWEST_TONE = 27.5 # Hz, key 0 (A0).
+LOWEST_KEY_NOTE = 9 # Key 0 is an A, 9 semitones above C.
+LEGACY_KEY_OFFSET = 24 # Key 0 of the old 37-key keyboard (110 Hz) is key 24 of the 88-key range.
+DEFAULT_KEY = 36 # A3, 220 Hz.
+
+# Only a few base tones are rendered for each voice. The other keys are resampled from the base tone above them.
+
+BASE_TONE_INTERVAL = 6 # semitones between base tones.
 
 MAX_VOICES = 12
 MAX_TIMESLOTS = 300
+MIN_TEMPO = 30 # Sequence tempo range, bpm.
+MAX_TEMPO = 200
+
+# Parallel rendering of voices (at start up, and when the settings are restored)
+
+MAX_RENDER_PROCESSES = 8
+RENDER_CHUNK_KEYS = 8 # Number of base tones of one voice made by each render job.
 
 DEFAULT_FREQUENCY = 440
 
@@ -57,3 +120,8 @@ VIBRATO_ENABLED = True
 RING_MODULATION_ENABLED = False
 UNISON_ENABLED = False
 TREMOLO_ENABLED = True
+VCF_ENABLED = True
+EFFECTS_ENABLED = True
+MIDI_INPUT_ENABLED = True # Play notes from a MIDI input port, if mido is installed.
+PARALLEL_RENDER_ENABLED = True
+DSP_ACCELERATION_ENABLED = True # Compile the DSP loops with Numba, if it is installed.
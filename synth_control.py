@@ -2,6 +2,8 @@
 # Imports
 # ------------------------------
 
+import copy
+import os
 import time
 import threading
 import numpy as np
@@ -9,6 +11,11 @@ import synth_constants as const
 import synth_view
 import synth_model
 import synth_data
+import synth_midi
+import synth_midi_input
+import synth_sequence
+import synth_bounce
+import synth_polyphony
 
 # ------------------------------
 # Variables
@@ -16,6 +23,19 @@ import synth_data
 
 # Debug levels: 0 = none, 1 = basic, 2 = long-winded.
 debug_level = 2
+
+# ------------------------------
+# Functions
+# ------------------------------
+
+# Harmonic levels of the additive waveform, each limited to 0..100 %, and at most const.MAX_HARMONICS of them.
+def _harmonic_levels(levels):
+    return tuple(min(max(int(level), 0), 100) for level in levels[:const.MAX_HARMONICS])
+
+# Harmonic phases of the additive waveform, in degrees 0..359, and at most const.MAX_HARMONICS of them.
+def _harmonic_phases(phases):
+    return tuple(int(phase) % 360 for phase in phases[:const.MAX_HARMONICS])
+
 # ------------------------------
 # Classes
 # ------------------------------
@@ -36,36 +56,50 @@ class Voice_Parameters:
         self.tremolo_rate = 0
         self.tremolo_depth = 0
         self.ring_mod_rate = 0
+        self.tuning = "Equal"
+        self.harmonic_levels = const.DEFAULT_HARMONIC_LEVELS
+        self.harmonic_phases = ()
         self.attack = const.DEFAULT_ATTACK
         self.decay = const.DEFAULT_DECAY
         self.sustain_time = const.DEFAULT_SUSTAIN
         self.sustain_level = const.DEFAULT_SUSTAIN_LEVEL
         self.release = const.DEFAULT_RELEASE
-        
-class Sequence:
-    def __init__(self):
-        self.number = 0 
-        self.name = "Blank"
-        self.beats_per_bar = 4
-        self.tempo = 100
-        self.length = 0
-        self.seq_offset = 0
-        self.notes = np.zeros((const.MAX_VOICES, const.MAX_TIMESLOTS, const.NUM_KEYS), dtype=int)
+        self.filter_type = "None"
+        self.filter_cutoff = const.DEFAULT_FILTER_CUTOFF
+        self.filter_resonance = const.DEFAULT_FILTER_RESONANCE
+        self.filter_env_depth = 0
+        self.delay_time = 0
+        self.delay_feedback = 0
+        self.chorus_depth = 0
+        self.reverb_level = 0
+
+    # Make an immutable copy of the sound-making parameters, to post to the model's render thread.
+    def snapshot(self):
+        return synth_model.Voice_Snapshot.from_params(self)
         
 class Controller:
     def __init__(self):
         self.sample_rate = const.SAMPLE_RATE
         self.frequency = const.DEFAULT_FREQUENCY
         self.num_voices = 1
-        self.current_key = 12
+        self.current_key = const.DEFAULT_KEY
+        self.pitch_bend = 0.0 # semitones
         self.voice_params = []
         self.voice_index = 0
         self.num_timeslots = const.MAX_TIMESLOTS
         self.view = synth_view.View(self)
         self.model = synth_model.Model(self, const.SAMPLE_RATE)
-        self.sequence = Sequence()
+        self.sequence = synth_sequence.Sequence()
         self.thread_1 = None
         self.thread_2 = None
+        self.bounce_thread = None
+        self.midi_input = None
+        self.note_length = 1 # timeslots, for new notes in the sequence editor.
+        # Most notes that sound at once, and which note is replaced when there are more (see synth_polyphony.py).
+        self.polyphony = const.MAX_POLYPHONY
+        self.steal_policy = const.STEAL_POLICY
+        self.song = synth_sequence.Song()
+        self.pattern_cache = synth_bounce.Mixdown_Cache() # Audio of song patterns, kept between bounces.
         
     def main(self):
         self._debug_2("In main of controller")
@@ -77,6 +111,7 @@ class Controller:
         self.restore_settings()
         self.restore_sequence()
         self.model.main(self.num_voices)
+        self.start_midi_input()
         self.view.main() # This function does not return control here.
         
     # Calculate colours for different voices/instruments on graphs and charts.
@@ -127,7 +162,7 @@ class Controller:
         self.current_key = key
         if voice_index >= 0:
             self.voice_index = voice_index
-        self._play_current_note()            
+        self._play_current_note(preview=False)
         
     # Process request from view (user interface) to set the basic waveform for the current voice/instrument.
     def on_request_waveform(self, waveform):
@@ -135,7 +170,7 @@ class Controller:
         self.voice_params[self.voice_index].waveform = waveform
         self.view.show_new_settings()
         # Mark the old voice data as obsolete.
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the on/off ratio for a sawtooth or square wave.
@@ -145,7 +180,7 @@ class Controller:
         if voice.waveform == "Sawtooth" or voice.waveform == "Square":
             self._debug_2("Set width to " + str(width))
             self.voice_params[self.voice_index].width = float(width)
-            self.model.scratch_voice(self.voice_index)
+            self._post_voice_change()
             self._play_current_note()
         else:
             self._debug_1("Width of this waveform is fixed.")
@@ -154,109 +189,198 @@ class Controller:
     def on_request_attack(self, value):
         self._debug_2("In on_request_attack: " + str(value))
         self.voice_params[self.voice_index].attack = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the decay time of the ADSR envelope.
     def on_request_decay(self, value):
         self._debug_2("In on_request_decay: " + str(value))
         self.voice_params[self.voice_index].decay = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the sustain time of the ADSR envelope.
     def on_request_sustain(self, value):
         self._debug_2("In on_request_sustain: " + str(value))
         self.voice_params[self.voice_index].sustain_time = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the sustain level of the ADSR envelope.
     def on_request_sustain_level(self, value):
         self._debug_2("In on_request_sustain_level: " + str(value))
         self.voice_params[self.voice_index].sustain_level = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the release time of the ADSR envelope.
     def on_request_release(self, value):
         self._debug_2("In on_request_release: " + str(value))
         self.voice_params[self.voice_index].release = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
-    # Process request from view (user interface) to adjust the tremolo rate of the ADSR envelope.
+    # Process request from view (user interface) to adjust the rate of the voice's tremolo LFO (see synth_modulation.py).
     def on_request_tremolo_rate(self, value):
         self._debug_2("In on_request_tremolo_rate: " + str(value))
         self.voice_params[self.voice_index].tremolo_rate = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
-    # Process request from view (user interface) to adjust the tremolo depth of the ADSR envelope.
+    # Process request from view (user interface) to adjust the depth of the voice's tremolo LFO (see synth_modulation.py).
     def on_request_tremolo_depth(self, value):
         self._debug_2("In on_request_tremolo_depth: " + str(value))
         self.voice_params[self.voice_index].tremolo_depth = int(value)
-        self._change_envelope()
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the fundamental fequency suppression of the tone.
     def on_request_harmonic_boost(self, value):
         self._debug_2("In on_request_harmonic_boost: " + str(value))
         self.voice_params[self.voice_index].harmonic_boost = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the vibrato rate of the tone.
     def on_request_vibrato_rate(self, value):
         self._debug_2("In on_request_vibrato_rate: " + str(value))
         self.voice_params[self.voice_index].vibrato_rate = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the vibrato depth of the tone.
     def on_request_vibrato_depth(self, value):
         self._debug_2("In on_request_vibrato_depth: " + str(value))
         self.voice_params[self.voice_index].vibrato_depth = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the number of unison voices in the tone.
     def on_request_unison_voices(self, value):
         self._debug_2("In on_request_unison_voices: " + str(value))
         self.voice_params[self.voice_index].unison_voices = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the frequency spread of unison voices in the tone.
     def on_request_unison_detune(self, value):
         self._debug_2("In on_request_unison_detune: " + str(value))
         self.voice_params[self.voice_index].unison_detune = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
         self._play_current_note()
         
     # Process request from view (user interface) to adjust the ring modulator frequency applied to the tone.
     def on_request_ring_mod_rate(self, value):
         self._debug_2("In on_request_ring_mod_rate: " + str(value))
         self.voice_params[self.voice_index].ring_mod_rate = int(value)
-        self.model.scratch_voice(self.voice_index)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to set the tuning table of the current voice.
+    def on_request_tuning(self, tuning):
+        self._debug_2("In on_request_tuning: " + str(tuning))
+        self.voice_params[self.voice_index].tuning = tuning
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to set the harmonic levels, in %, of the additive waveform.
+    def on_request_harmonic_levels(self, levels):
+        self._debug_2("In on_request_harmonic_levels: " + str(levels))
+        self.voice_params[self.voice_index].harmonic_levels = _harmonic_levels(levels)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to set the harmonic phases, in degrees, of the additive waveform.
+    def on_request_harmonic_phases(self, phases):
+        self._debug_2("In on_request_harmonic_phases: " + str(phases))
+        self.voice_params[self.voice_index].harmonic_phases = _harmonic_phases(phases)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to bend the pitch of all notes, in cents.
+    def on_request_pitch_bend(self, value):
+        self._debug_2("In on_request_pitch_bend: " + str(value))
+        self.pitch_bend = int(value) / 100
+        self.model.set_pitch_bend(self.pitch_bend)
+        self._play_current_note()
+
+    # Process request from view (user interface) to set the type of voltage controlled filter applied to the note.
+    def on_request_filter_type(self, filter_type):
+        self._debug_2("In on_request_filter_type: " + str(filter_type))
+        self.voice_params[self.voice_index].filter_type = filter_type
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the filter cutoff (or centre) frequency.
+    def on_request_filter_cutoff(self, value):
+        self._debug_2("In on_request_filter_cutoff: " + str(value))
+        self.voice_params[self.voice_index].filter_cutoff = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the filter resonance (Q factor).
+    def on_request_filter_resonance(self, value):
+        self._debug_2("In on_request_filter_resonance: " + str(value))
+        self.voice_params[self.voice_index].filter_resonance = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust how far the envelope raises the filter frequency.
+    def on_request_filter_env_depth(self, value):
+        self._debug_2("In on_request_filter_env_depth: " + str(value))
+        self.voice_params[self.voice_index].filter_env_depth = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the echo delay time of the voice's effects bus.
+    def on_request_delay_time(self, value):
+        self._debug_2("In on_request_delay_time: " + str(value))
+        self.voice_params[self.voice_index].delay_time = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the echo feedback (level of each repeat).
+    def on_request_delay_feedback(self, value):
+        self._debug_2("In on_request_delay_feedback: " + str(value))
+        self.voice_params[self.voice_index].delay_feedback = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the chorus depth of the voice's effects bus.
+    def on_request_chorus_depth(self, value):
+        self._debug_2("In on_request_chorus_depth: " + str(value))
+        self.voice_params[self.voice_index].chorus_depth = int(value)
+        self._post_voice_change()
+        self._play_current_note()
+
+    # Process request from view (user interface) to adjust the reverb level of the voice's effects bus.
+    def on_request_reverb_level(self, value):
+        self._debug_2("In on_request_reverb_level: " + str(value))
+        self.voice_params[self.voice_index].reverb_level = int(value)
+        self._post_voice_change()
         self._play_current_note()
     
     # Local helper function to display and play the current note as recently modified in the voice editor.
-    def _play_current_note(self):
+    # The note is made on the model's render thread, which calls _show_note() when it is ready.
+    # preview = True when the note only illustrates a change of settings, so it can be skipped for a later one.
+    def _play_current_note(self, preview=True):
         self._debug_2("In _play_current_note().")        
-        tone, frequency = self.model.fetch_tone(self.voice_index, self.current_key)
-        note = self.model.apply_envelope(self.voice_index, tone) 
+        self.model.post_note(self.voice_index, self.current_key, self._show_note, preview)
+
+    # Called from the model's render thread with a newly made note. The note is played straight away,
+    # and shown by the GUI thread.
+    def _show_note(self, voice_index, note, frequency):
         if not note is None:
-            self.view.play_sound(note)
-            self.view.show_sound(note)
-            self.view.show_frequency(frequency)
+            self.view.play_sound(note, voice_index)
+            self.view.call_in_gui(self.view.show_sound, note)
+            self.view.call_in_gui(self.view.show_frequency, frequency)
         else:
             self._debug_1("WARNING: No note in _play_current_note().")
             
     # Process request from view (user interface) to play the current note.
     def on_request_play(self):
         self._debug_2("In on_request_play().")
-        self._play_current_note()
+        self._play_current_note(preview=False)
             
     # Process request from view (user interface) to play 100 notes. (All keys in order.)
     def on_request_test(self):
@@ -278,9 +402,9 @@ class Controller:
         while key < 100:
             tone, frequency = self.model.fetch_tone(self.voice_index, key % const.NUM_KEYS)
             self.frequency = frequency # noqa
-            note = self.model.apply_envelope(self.voice_index, tone) 
+            note = self.model.apply_envelope(self.voice_index, tone, frequency=frequency)
             if not note is None:
-                self.view.play_sound(note)
+                self.view.play_sound(note, self.voice_index)
             now = time.perf_counter()
             sleep_time = next_time - now
             time_asleep += sleep_time
@@ -294,16 +418,17 @@ class Controller:
     # Process request from view (user interface) to add or remove a note on the sequence editor grid.
     def on_request_toggle_sequence_note(self, timeslot, voice_index, key):
         self._debug_2("In on_request_toggle_sequence_note: " + str(timeslot) + ", " + str(voice_index) + ", " + str(key))
-        if self.sequence.notes[voice_index, timeslot, key] == 1:
-            self.sequence.notes[voice_index, timeslot, key] = 0
+        if self.sequence.remove_note(voice_index, timeslot, key):
             self._debug_2("Cleared note.")
-            # Note: sequence length is recalcualted when sequence is read back from the file.
         else:
-            self.sequence.notes[voice_index, timeslot, key] = 1
+            self.sequence.add_note(voice_index, timeslot, key, self.note_length)
             self._debug_2("Set note.")
-            if timeslot >= self.sequence.length:
-                self.sequence.length = timeslot + 1
         
+    # Process request from view (user interface) to set the length, in timeslots, of new notes in the sequence.
+    def on_request_set_note_length(self, value):
+        self._debug_2("Set note length to " + str(value))
+        self.note_length = int(value)
+
     # Process request from view (user interface) to set the beats per bar shown in the sequence editor.
     def on_request_set_beats(self, value):
         self._debug_2("Set beats/bar to " + str(value))
@@ -329,24 +454,39 @@ class Controller:
 
     def _play_sequence(self):
         self._debug_2("In _play_sequence()")
-        timeslot = self.sequence.seq_offset
+        timeslots = ((timeslot, timeslot, self.sequence.notes_at(timeslot))
+                     for timeslot in range(self.sequence.seq_offset, self.sequence.length))
+        self._play_timeslots(timeslots, True)
+
+    # Process request from view (user interface) to play the song arrangement.
+    def on_request_play_song(self):
+        self._debug_2("In on_request_play_song()")
+        if not self.thread_2 is None:
+            self._debug_2("Waiting for previous sequence to complete.")
+            self.thread_2.join()
+        # The song is expanded into timeslots as it plays. Its patterns may not be on the editor's grid,
+        # so the cursor isn't shown.
+        self.thread_2 = threading.Thread(target=self._play_timeslots, args=(self.song.timeslot_notes(), False))
+        self.thread_2.start()
+
+    # Play the notes of each timeslot in turn: timeslots yields (timeslot, timeslot in its pattern, notes).
+    def _play_timeslots(self, timeslots, show_cursor):
         note_spacing_secs = 60.0 / (self.sequence.tempo * self.sequence.beats_per_bar)
         start = time.perf_counter()
         self._debug_1("Timer start = " + str(start))
         next_time = start + note_spacing_secs
+        timeslot_samples = note_spacing_secs * self.sample_rate
         time_asleep = 0
-        while timeslot < self.sequence.length:
+        for timeslot, pattern_timeslot, notes in timeslots:
             self._debug_2("Timeslot = " + str(timeslot))
-            for vi in range(self.num_voices):
-                for key in range(const.NUM_KEYS):
-                    if self.sequence.notes[vi, timeslot, key] > 0:
-                        tone, frequency = self.model.fetch_tone(vi, key)
-                        self.frequncy = frequency # noqa
-                        note = self.model.apply_envelope(vi, tone) 
-                        if not note is None:
-                            self.view.play_sound(note)
-            timeslot += 1
-            self.view.show_cursor(timeslot) # show next timeslot on screen
+            notes = notes[notes["voice"] < self.num_voices]
+            # Each note is held for its duration in timeslots, then released.
+            gate_lengths = (notes["duration"] * timeslot_samples).astype(int)
+            gated_notes = self.model.make_gated_notes(notes, gate_lengths)
+            for vi, note in zip(notes["voice"].tolist(), gated_notes):
+                self.view.note_on(vi, note)
+            if show_cursor:
+                self.view.call_in_gui(self.view.show_cursor, pattern_timeslot + 1) # show next timeslot on screen
             now = time.perf_counter()
             sleep_time = next_time - now
             time_asleep += sleep_time
@@ -356,8 +496,119 @@ class Controller:
         self._debug_1("Sequence duration, secs = " + str(finish - start))
         self._debug_1("Time asleep in seconds = " + str(time_asleep))                               
             
+    # Process request from view (user interface) to replace the sequence with the notes of a MIDI file.
+    def on_request_import_midi(self, filename):
+        self._debug_2("In on_request_import_midi(): " + filename)
+        midi_data = synth_midi.read_midi_file(filename)
+        if midi_data is None:
+            return
+        events, ticks_per_beat, tempo, beats_per_bar = midi_data
+        notes, dropped = synth_midi.events_to_notes(events, ticks_per_beat, const.MAX_VOICES, self.num_timeslots)
+        if dropped > 0:
+            self._debug_1("WARNING: " + str(dropped) + " notes are outside the sequence range and were dropped.")
+        # The sequence editor offers 3, 4 or 5 beats per bar. The tempo keeps the timing right for any of them.
+        if not beats_per_bar in [3, 4, 5]:
+            beats_per_bar = 4
+        self.sequence.set_notes(notes)
+        self.sequence.beats_per_bar = beats_per_bar
+        # Keep the tempo in the range of the tempo slider.
+        self.sequence.tempo = int(min(max(synth_midi.sequence_tempo(tempo, beats_per_bar), const.MIN_TEMPO), const.MAX_TEMPO))
+        self.view.show_sequence()
+
+    # Process request from view (user interface) to save the sequence as a MIDI file.
+    def on_request_export_midi(self, filename):
+        self._debug_2("In on_request_export_midi(): " + filename)
+        events = synth_midi.notes_to_events(self.sequence.notes)
+        tempo = synth_midi.midi_tempo(self.sequence.tempo, self.sequence.beats_per_bar)
+        synth_midi.write_midi_file(filename, events, tempo=tempo, beats_per_bar=self.sequence.beats_per_bar)
+            
+    # Process request from view (user interface) to add the sequence to the end of the song, as a pattern
+    # that is played repeats times, transposed by some semitones. The pattern lasts for whole bars.
+    def on_request_add_to_song(self, repeats, transpose):
+        self._debug_2("In on_request_add_to_song(): " + str(repeats) + ", " + str(transpose))
+        bar_length = self.sequence.beats_per_bar
+        length = bar_length * int(np.ceil(self.sequence.length / bar_length))
+        if length == 0:
+            self._debug_1("WARNING: the sequence is empty, so it was not added to the song.")
+            return
+        pattern_index = self.song.add_pattern(self.sequence.notes, length)
+        self.song.append(pattern_index, int(repeats), int(transpose))
+        self.view.show_song()
+
+    # Process request from view (user interface) to remove all the patterns from the song.
+    def on_request_clear_song(self):
+        self._debug_2("In on_request_clear_song()")
+        self.song.clear()
+        self.view.show_song()
+
+    # Process request from view (user interface) to render the song to a WAV file.
+    # The song is rendered on its own thread, so the GUI keeps running, and the view is told when it is done.
+    def on_request_bounce_song(self, filename):
+        self._debug_2("In on_request_bounce_song(): " + filename)
+        if not self.bounce_thread is None and self.bounce_thread.is_alive():
+            self._debug_1("WARNING: the song is already being bounced.")
+            return
+        timeslot_samples = 60.0 * self.sample_rate / (self.sequence.tempo * self.sequence.beats_per_bar)
+        # Bounce copies of the song, voices and pitch bend, so they can be edited while the bounce runs.
+        # The notes are made by a model of the bounce's own, so the live model is not used by the bounce thread.
+        song = copy.copy(self.song)
+        song.patterns = list(self.song.patterns)
+        voice_params = [params.snapshot() for params in self.voice_params]
+        model = synth_model.Model.from_snapshots(voice_params, self.pitch_bend, self.sample_rate, self.model.max_duration)
+        self.view.show_bounce_status("Bouncing...")
+        self.bounce_thread = threading.Thread(target=self._bounce_song,
+                                              args=(filename, model, song, voice_params, self.num_voices, timeslot_samples))
+        self.bounce_thread.start()
+
+    def _bounce_song(self, filename, model, song, voice_params, num_voices, timeslot_samples):
+        start = time.perf_counter()
+        try:
+            audio = synth_bounce.bounce_song(model, song, voice_params, num_voices, timeslot_samples,
+                                             self.sample_rate, self.pattern_cache)
+            synth_bounce.write_wav(filename, audio, self.sample_rate)
+        except Exception as exception:
+            self._debug_1("ERROR: bouncing to file '" + filename + "' raised exception " + repr(exception))
+            self.view.call_in_gui(self.view.show_bounce_status, "Bounce failed")
+            return
+        finish = time.perf_counter()
+        self._debug_1("Song bounced in seconds = " + str(finish - start))
+        self.view.call_in_gui(self.view.show_bounce_status, "Bounced " + str(round(len(audio) / self.sample_rate, 1))
+                              + " s to " + os.path.basename(filename))
+
+    # Start reading notes from the MIDI input port, if there is one.
+    def start_midi_input(self, port=None):
+        if not const.MIDI_INPUT_ENABLED:
+            return
+        if port is None:
+            port = synth_midi_input.open_input_port()
+            if port is None:
+                return
+        self.midi_input = synth_midi_input.Midi_Input(port, self.on_midi_note_on, self.on_midi_note_off, self.num_voices)
+        self.midi_input.start()
+
+    def stop_midi_input(self):
+        if self.midi_input is None:
+            return
+        self.midi_input.stop()
+        self.midi_input = None
+        latency = self.view.get_note_latency()
+        if not latency is None:
+            self._debug_1("MIDI note latency, ms: mean = " + str(round(latency[0], 1)) + ", max = " + str(round(latency[1], 1)))
+
+    # Called from the MIDI input thread. The note is made and started on this thread, without going through the GUI.
+    def on_midi_note_on(self, voice_index, key, velocity, received_time):
+        self._debug_2("MIDI note on: voice, key, velocity = " + str(voice_index) + ", " + str(key) + ", " + str(velocity))
+        note = self.model.make_gated_note(voice_index, key, velocity, received_time=received_time)
+        self.view.note_on(voice_index, note)
+
+    def on_midi_note_off(self, voice_index, key, received_time):
+        self._debug_2("MIDI note off: voice, key = " + str(voice_index) + ", " + str(key))
+        self.view.note_off(voice_index, key)
+            
     def on_request_shutdown(self):
         self._debug_2("Shutdown requested")
+        self.stop_midi_input()
+        self.model.shutdown()
         self.save_settings()
         self.save_sequence()
         self.view.shutdown()
@@ -373,6 +624,10 @@ class Controller:
         values.append(self.num_voices)
         names.append("voice_index")
         values.append(self.voice_index)
+        names.append("polyphony")
+        values.append(self.polyphony)
+        names.append("steal_policy")
+        values.append(self.steal_policy)
         for vi in range(self.num_voices):
             name_prefix = "voice_" + str(vi) + "_"
             #print("name_prefix = " + name_prefix)
@@ -396,6 +651,12 @@ class Controller:
             values.append(int(self.voice_params[vi].unison_detune))
             names.append(name_prefix + "ring_mod_rate")
             values.append(int(self.voice_params[vi].ring_mod_rate))
+            names.append(name_prefix + "tuning")
+            values.append(self.voice_params[vi].tuning)
+            names.append(name_prefix + "harmonic_levels")
+            values.append(" ".join(str(level) for level in self.voice_params[vi].harmonic_levels))
+            names.append(name_prefix + "harmonic_phases")
+            values.append(" ".join(str(phase) for phase in self.voice_params[vi].harmonic_phases))
             names.append(name_prefix + "tremolo_rate")
             values.append(int(self.voice_params[vi].tremolo_rate))
             names.append(name_prefix + "tremolo_depth")
@@ -410,8 +671,49 @@ class Controller:
             values.append(int(self.voice_params[vi].sustain_level))
             names.append(name_prefix + "release")
             values.append(int(self.voice_params[vi].release))
+            names.append(name_prefix + "filter_type")
+            values.append(self.voice_params[vi].filter_type)
+            names.append(name_prefix + "filter_cutoff")
+            values.append(int(self.voice_params[vi].filter_cutoff))
+            names.append(name_prefix + "filter_resonance")
+            values.append(int(self.voice_params[vi].filter_resonance))
+            names.append(name_prefix + "filter_env_depth")
+            values.append(int(self.voice_params[vi].filter_env_depth))
+            names.append(name_prefix + "delay_time")
+            values.append(int(self.voice_params[vi].delay_time))
+            names.append(name_prefix + "delay_feedback")
+            values.append(int(self.voice_params[vi].delay_feedback))
+            names.append(name_prefix + "chorus_depth")
+            values.append(int(self.voice_params[vi].chorus_depth))
+            names.append(name_prefix + "reverb_level")
+            values.append(int(self.voice_params[vi].reverb_level))
         synth_data.write_synth_data("synth_settings.txt", names, values)
         
+    # Process request from view (user interface) to limit the number of notes that sound at once.
+    def on_request_polyphony(self, value):
+        self._debug_2("In on_request_polyphony: " + str(value))
+        self.polyphony = min(max(int(value), 1), const.MAX_POLYPHONY)
+        self.view.set_polyphony(self.polyphony, self.steal_policy)
+
+    # Process request from view (user interface) to choose which note is replaced when too many are playing.
+    def on_request_steal_policy(self, policy):
+        self._debug_2("In on_request_steal_policy: " + str(policy))
+        if policy in synth_polyphony.STEAL_POLICIES:
+            self.steal_policy = policy
+            self.view.set_polyphony(self.polyphony, self.steal_policy)
+
+    # Process request from view (user interface) to go back to the saved settings. All the voices are remade
+    # together, in parallel, on the model's render thread.
+    def on_request_restore_settings(self):
+        self._debug_2("In on_request_restore_settings()")
+        self.restore_settings()
+        snapshots = [params.snapshot() for params in self.voice_params]
+        self.model.post_voices(snapshots, self.num_voices)
+        for voice_index in range(const.MAX_VOICES):
+            self.view.set_voice_effects(voice_index, snapshots[voice_index])
+        self.view.set_polyphony(self.polyphony, self.steal_policy)
+        self.view.show_new_settings()
+
     def restore_settings(self):
         names, values = synth_data.read_synth_data("synth_settings.txt")
         for i in range(len(names)):
@@ -423,6 +725,11 @@ class Controller:
                 self.num_voices = min(int(values[i]), const.MAX_VOICES)
             elif names[i] == "voice_index":
                 self.voice_index = min(int(values[i]), self.num_voices - 1)
+            elif names[i] == "polyphony":
+                self.polyphony = min(max(int(values[i]), 1), const.MAX_POLYPHONY)
+            elif names[i] == "steal_policy":
+                if values[i] in synth_polyphony.STEAL_POLICIES:
+                    self.steal_policy = values[i]
             else:
                 for vi in range(self.num_voices):
                     name_prefix = "voice_" + str(vi) + "_"
@@ -446,6 +753,12 @@ class Controller:
                         self.voice_params[vi].unison_detune = int(values[i])
                     elif names[i] == name_prefix + "ring_mod_rate":
                         self.voice_params[vi].ring_mod_rate = int(values[i])
+                    elif names[i] == name_prefix + "tuning":
+                        self.voice_params[vi].tuning = values[i]
+                    elif names[i] == name_prefix + "harmonic_levels":
+                        self.voice_params[vi].harmonic_levels = _harmonic_levels(values[i].split())
+                    elif names[i] == name_prefix + "harmonic_phases":
+                        self.voice_params[vi].harmonic_phases = _harmonic_phases(values[i].split())
                     elif names[i] == name_prefix + "tremolo_rate":
                         self.voice_params[vi].tremolo_rate = int(values[i])
                     elif names[i] == name_prefix + "tremolo_depth":
@@ -458,6 +771,22 @@ class Controller:
                         self.voice_params[vi].sustain_time = int(values[i])
                     elif names[i] == name_prefix + "sustain_level":
                         self.voice_params[vi].sustain_level = int(values[i])
+                    elif names[i] == name_prefix + "filter_type":
+                        self.voice_params[vi].filter_type = values[i]
+                    elif names[i] == name_prefix + "filter_cutoff":
+                        self.voice_params[vi].filter_cutoff = int(values[i])
+                    elif names[i] == name_prefix + "filter_resonance":
+                        self.voice_params[vi].filter_resonance = int(values[i])
+                    elif names[i] == name_prefix + "filter_env_depth":
+                        self.voice_params[vi].filter_env_depth = int(values[i])
+                    elif names[i] == name_prefix + "delay_time":
+                        self.voice_params[vi].delay_time = int(values[i])
+                    elif names[i] == name_prefix + "delay_feedback":
+                        self.voice_params[vi].delay_feedback = int(values[i])
+                    elif names[i] == name_prefix + "chorus_depth":
+                        self.voice_params[vi].chorus_depth = int(values[i])
+                    elif names[i] == name_prefix + "reverb_level":
+                        self.voice_params[vi].reverb_level = int(values[i])
                     else:
                         pass # no error reporting!
                     
@@ -473,20 +802,47 @@ class Controller:
         values.append(int(self.sequence.beats_per_bar))
         names.append("sequence_tempo")
         values.append(int(self.sequence.tempo))
-        for vi in range(self.num_voices):
-            voice_name = "voice_" + str(vi) + "_"
-            for timeslot in range(self.num_timeslots):
-                timeslot_name = "timeslot_" + str(timeslot) + "_"
-                for key in range(const.NUM_KEYS):
-                    key_name = "key_" + str(key)
-                    if self.sequence.notes[vi, timeslot, key] > 0:
-                        names.append(voice_name + timeslot_name + key_name)
-                        values.append(int(self.sequence.notes[vi, timeslot, key]))
+        names.append("num_keys")
+        values.append(const.NUM_KEYS)
+        self._save_notes(names, values, self.sequence.notes)
+        # The song's patterns, then its arrangement.
+        for pi, pattern in enumerate(self.song.patterns):
+            pattern_name = "pattern_" + str(pi) + "_"
+            names.append(pattern_name + "length")
+            values.append(int(pattern.length))
+            self._save_notes(names, values, pattern.notes, pattern_name)
+        for i, entry in enumerate(self.song.arrangement):
+            for field in synth_sequence.SONG_ENTRY.names:
+                names.append("song_" + str(i) + "_" + field)
+                values.append(int(entry[field]))
         synth_data.write_synth_data("sequence.txt", names, values)
 
+    # Each note is saved as its duration. Its velocity, detune and pan are only saved if they aren't the defaults.
+    def _save_notes(self, names, values, notes, prefix=""):
+        for note in notes[notes["voice"] < self.num_voices]:
+            note_name = (prefix + "voice_" + str(note["voice"]) + "_timeslot_" + str(note["start"])
+                         + "_key_" + str(note["key"]))
+            names.append(note_name)
+            values.append(int(note["duration"]))
+            if note["velocity"] != synth_sequence.DEFAULT_VELOCITY:
+                names.append(note_name + "_velocity")
+                values.append(int(note["velocity"]))
+            if note["detune"] != 0:
+                names.append(note_name + "_detune")
+                values.append(float(note["detune"]))
+            if note["pan"] != 0:
+                names.append(note_name + "_pan")
+                values.append(float(note["pan"]))
+
 
     def restore_sequence(self):
         names, values = synth_data.read_synth_data("sequence.txt")
+        # Files saved before the keyboard was extended have no "num_keys" entry, and count keys from 110 Hz.
+        key_offset = 0 if "num_keys" in names else const.LEGACY_KEY_OFFSET
+        notes = {} # (voice, timeslot, key): note record
+        pattern_notes = {} # pattern index: notes, as above
+        pattern_lengths = {}
+        song_entries = {} # arrangement index: song entry fields
         for i in range(len(names)):
             if names[i] == "sequence_number":
                 self.sequence.number = int(values[i])
@@ -496,25 +852,61 @@ class Controller:
                 self.sequence.beats_per_bar = int(values[i])  
             if names[i] == "sequence_tempo":
                 self.sequence.tempo = int(values[i])
-            self.sequence.length = 0  # length is calulated below!          
-            for vi in range(self.num_voices):
-                voice_name = "voice_" + str(vi) + "_"
-                for timeslot in range(self.num_timeslots):
-                    timeslot_name = "timeslot_" + str(timeslot) + "_"
-                    for key in range(const.NUM_KEYS):
-                        key_name = "key_" + str(key)
-                        if names[i] == voice_name + timeslot_name + key_name:
-                            self.sequence.notes[vi, timeslot, key] = values[i]
-                            self.sequence.length = timeslot + 1
+            parts = names[i].split("_")
+            if parts[0] == "voice":
+                self._restore_note(parts, values[i], notes, key_offset)
+            elif parts[0] == "pattern" and len(parts) > 2:
+                pi = int(parts[1])
+                if parts[2] == "length":
+                    pattern_lengths[pi] = int(values[i])
+                else:
+                    self._restore_note(parts[2:], values[i], pattern_notes.setdefault(pi, {}), key_offset)
+            elif parts[0] == "song" and len(parts) == 3:
+                song_entries.setdefault(int(parts[1]), {})[parts[2]] = int(values[i])
+        self.sequence.set_notes([tuple(note) for note in notes.values()])
+        self.song.clear()
+        for pi in sorted(pattern_lengths):
+            self.song.patterns.append(synth_sequence.Pattern([tuple(note) for note in pattern_notes.get(pi, {}).values()],
+                                                             pattern_lengths[pi]))
+        for i in sorted(song_entries):
+            entry = song_entries[i]
+            if entry.get("pattern", -1) in pattern_lengths:
+                self.song.append(entry["pattern"], entry.get("repeats", 1), entry.get("transpose", 0))
+
+    # Add a saved note, or one of its fields, to a dictionary of note records by (voice, timeslot, key).
+    # Note names have the form "voice_<vi>_timeslot_<timeslot>_key_<key>", then optionally "_<field>".
+    def _restore_note(self, parts, value, notes, key_offset):
+        if not (len(parts) in [6, 7] and parts[0] == "voice" and parts[2] == "timeslot" and parts[4] == "key"):
+            return
+        vi = int(parts[1])
+        timeslot = int(parts[3])
+        key = int(parts[5]) + key_offset
+        if vi < self.num_voices and timeslot < self.num_timeslots and key < const.NUM_KEYS:
+            note = notes.setdefault((vi, timeslot, key),
+                                    [vi, timeslot, key, 1, synth_sequence.DEFAULT_VELOCITY, 0.0, 0.0])
+            if len(parts) == 6:
+                note[3] = int(value)
+            elif parts[6] == "velocity":
+                note[4] = int(value)
+            elif parts[6] == "detune":
+                note[5] = float(value)
+            elif parts[6] == "pan":
+                note[6] = float(value)
 
 
     # ------------------------------
     # Local Helper Functions
     # ------------------------------
     
-    def _change_envelope(self):
-        new_envelope = self.model.make_envelope(self.voice_index)
-        self.view.show_envelope(new_envelope)
+    # Post a snapshot of the current voice's parameters to the model, which remakes whatever has changed.
+    def _post_voice_change(self):
+        snapshot = self.voice_params[self.voice_index].snapshot()
+        self.model.post_voice_params(self.voice_index, snapshot, self._show_envelope)
+        self.view.set_voice_effects(self.voice_index, snapshot)
+
+    # Called from the model's render thread with a newly made envelope, which is shown by the GUI thread.
+    def _show_envelope(self, voice_index, envelope):
+        self.view.call_in_gui(self.view.show_envelope, envelope)
   
     def _debug_1(self, message):
         global debug_level
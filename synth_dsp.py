@@ -0,0 +1,228 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import math
+import numpy as np
+import synth_constants as const
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+# ------------------------------
+#  Notes:
+#
+#  1. This module holds the sample-by-sample loops (recurrences) of the synth, which numpy can't vectorise.
+#  2. Each loop is written once, in plain Python that Numba can also compile. If Numba is installed
+#     (and DSP_ACCELERATION_ENABLED is True) the loops are compiled when this module is imported.
+#     Otherwise the plain Python versions are used. BACKEND says which was chosen.
+#  3. Filter state arrays are updated in place, so a signal can be filtered in blocks.
+# ------------------------------
+
+# ------------------------------
+# Kernels (plain Python versions)
+# ------------------------------
+
+# Biquad bandpass filter. centre_freqs = filter centre frequency in Hz for each sample.
+# The filter coefficients are recalculated every 64 samples (1.45 milliseconds), counted across calls.
+# state = [x1, x2, R, a1, a2, rescale, count], i.e. the two filter stores, the current coefficients and the
+# number of samples since the coefficients were recalculated, so a signal filtered in blocks of any size
+# gives the same output as filtering it in one go.
+def _bandpass_kernel(tone, centre_freqs, q_factor, sample_rate, state):
+    band_pass = np.zeros(len(tone))
+    x1 = state[0]
+    x2 = state[1]
+    b2 = - state[2]
+    a1 = state[3]
+    a2 = state[4]
+    rescale = state[5]
+    count = int(state[6])
+    for i in range(len(tone)):
+        if count % 64 == 0:
+            count = 0
+            fc = centre_freqs[i]
+            R = 1 - (math.pi * fc / (q_factor * sample_rate))
+            b2 = - R
+            a1 = - 2 * R * math.cos(2 * math.pi * fc / sample_rate)
+            a2 = R * R
+            rescale = 1 - R
+        x0 = tone[i] - (a1 * x1) - (a2 * x2)
+        band_pass[i] = rescale * (x0 + (b2 * x2))
+        x2 = x1
+        x1 = x0
+        count += 1
+    state[0] = x1
+    state[1] = x2
+    state[2] = - b2
+    state[3] = a1
+    state[4] = a2
+    state[5] = rescale
+    state[6] = count
+    return band_pass
+
+# Two cascaded one-pole lowpass filters, with a highpass output made by subtracting the lowpass from the input.
+# alpha = smoothing coefficient for each sample. state = [x1, x3], the two filter stores.
+def _low_high_pass_kernel(tone, alpha, state):
+    low_pass = np.zeros(len(tone))
+    high_pass = np.zeros(len(tone))
+    x1 = state[0]
+    x3 = state[1]
+    for i in range(len(tone)):
+        x0 = (alpha[i] * tone[i]) + ((1.0 - alpha[i]) * x1)
+        x2 = (alpha[i] * x1) + ((1.0 - alpha[i]) * x3)
+        low_pass[i] = x3
+        high_pass[i] = tone[i] - x2
+        x3 = x2
+        x1 = x0
+    state[0] = x1
+    state[1] = x3
+    return low_pass, high_pass
+
+# ADSR envelope levels (before the exponential function).
+# Times are in milliseconds and the level changes are per sample.
+def _envelope_kernel(times_msec, attack, decay, sustain_time, release, sustain_level,
+                     attack_level_change, decay_level_change, release_level_change):
+    envelope = np.zeros(len(times_msec))
+    level = 0.0
+    for i in range(len(times_msec)):
+        if times_msec[i] <= attack:
+            level += attack_level_change * (1.24 - level)
+        elif times_msec[i] <= attack + decay:
+            level -= decay_level_change * (level + 0.1 - sustain_level)
+            if level < sustain_level:
+                level = sustain_level
+        elif times_msec[i] < attack + decay + sustain_time:
+            level = sustain_level
+        elif times_msec[i] < attack + decay + sustain_time + release:
+            if level > 0:
+                level -= release_level_change * (level + 0.1)
+        else:
+            level = 0.0
+        envelope[i] = max(0.0, level)
+    return envelope
+
+# ------------------------------
+# Backend selection
+# ------------------------------
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None and const.DSP_ACCELERATION_ENABLED:
+    BACKEND = "numba"
+    bandpass_kernel = numba.njit(cache=True)(_bandpass_kernel)
+    low_high_pass_kernel = numba.njit(cache=True)(_low_high_pass_kernel)
+    envelope_kernel = numba.njit(cache=True)(_envelope_kernel)
+else:
+    BACKEND = "python"
+    bandpass_kernel = _bandpass_kernel
+    low_high_pass_kernel = _low_high_pass_kernel
+    envelope_kernel = _envelope_kernel
+
+# ------------------------------
+# Functions
+# ------------------------------
+
+# Make a new, zeroed state array for bandpass_filter().
+def new_bandpass_state():
+    return np.zeros(7, dtype=float)
+
+# Make a new, zeroed state array for low_high_pass_filters().
+def new_low_high_pass_state():
+    return np.zeros(2, dtype=float)
+
+# Bandpass filter the tone. centre_freqs = array of centre frequencies in Hz (one per sample).
+# q_factor = ratio of filter centre frequency divided by 3dB bandwidth (approximately).
+def bandpass_filter(tone, centre_freqs, q_factor, sample_rate, state=None):
+    if state is None:
+        state = new_bandpass_state()
+    return bandpass_kernel(np.asarray(tone, dtype=float), np.asarray(centre_freqs, dtype=float),
+                           float(q_factor), float(sample_rate), state)
+
+# Lowpass and highpass filter the tone. alpha = array of filter coefficients (one per sample).
+def low_high_pass_filters(tone, alpha, state=None):
+    if state is None:
+        state = new_low_high_pass_state()
+    return low_high_pass_kernel(np.asarray(tone, dtype=float), np.asarray(alpha, dtype=float), state)
+
+# ADSR envelope levels, see Model.make_envelope().
+def envelope_levels(times_msec, attack, decay, sustain_time, release, sustain_level,
+                    attack_level_change, decay_level_change, release_level_change):
+    return envelope_kernel(np.asarray(times_msec, dtype=float), float(attack), float(decay), float(sustain_time),
+                           float(release), float(sustain_level), float(attack_level_change), float(decay_level_change),
+                           float(release_level_change))
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_dsp.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_dsp.py: " + message)
+
+_debug_2("DSP kernel backend = " + BACKEND)
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+
+    import time
+
+    SAMPLE_RATE = 44100
+    NUM_SAMPLES = 30870
+    CROSS_CHECK_TOLERANCE = 1e-12
+
+    # Check that a compiled kernel gives the same output as its plain Python version, failing if it doesn't.
+    def cross_check(name, kernel, python_kernel, args):
+        if kernel is python_kernel:
+            _debug_1(name + ": no compiled kernel (numba is not in use), so there is nothing to cross-check.")
+            return None
+        start = time.perf_counter()
+        compiled_output = kernel(*[np.copy(a) if isinstance(a, np.ndarray) else a for a in args])
+        finish = time.perf_counter()
+        python_output = python_kernel(*[np.copy(a) if isinstance(a, np.ndarray) else a for a in args])
+        python_finish = time.perf_counter()
+        if not isinstance(compiled_output, tuple):
+            compiled_output = (compiled_output,)
+            python_output = (python_output,)
+        difference = max(np.max(np.abs(c - p)) for c, p in zip(compiled_output, python_output))
+        _debug_1(name + ": max difference = " + str(difference) + ", " + BACKEND + " seconds = " + str(finish - start)
+                 + ", python seconds = " + str(python_finish - finish))
+        assert difference <= CROSS_CHECK_TOLERANCE, name + " output differs between backends by " + str(difference)
+        return difference
+
+    _debug_1("Backend = " + BACKEND)
+    rng = np.random.default_rng(1)
+    tone = rng.uniform(-1, 1, NUM_SAMPLES)
+    centre_freqs = np.linspace(110, 4000, NUM_SAMPLES)
+    alpha = np.linspace(0.01, 1.0, NUM_SAMPLES)
+    times_msec = np.linspace(0, 700, NUM_SAMPLES, False)
+
+    # Warm up (compile) the kernels before timing them.
+    bandpass_filter(tone[:64], centre_freqs[:64], 2, SAMPLE_RATE)
+    low_high_pass_filters(tone[:64], alpha[:64])
+    envelope_levels(times_msec[:64], 100, 100, 400, 100, 0.5, 0.01, 0.01, 0.01)
+
+    cross_check("bandpass", bandpass_kernel, _bandpass_kernel,
+                (tone, centre_freqs, 2.0, float(SAMPLE_RATE), new_bandpass_state()))
+    cross_check("low_high_pass", low_high_pass_kernel, _low_high_pass_kernel,
+                (tone, alpha, new_low_high_pass_state()))
+    cross_check("envelope", envelope_kernel, _envelope_kernel,
+                (times_msec, 100.0, 100.0, 400.0, 100.0, 0.5, 0.0004, 0.0004, 0.0004))
+
+    # Filtering in blocks of any size must give the same output as filtering in one go.
+    one_go = bandpass_filter(tone, centre_freqs, 2, SAMPLE_RATE)
+    for block_sizes in [[1024], [100, 37, 1000], [1]]:
+        state = new_bandpass_state()
+        ends = np.cumsum(np.resize(block_sizes, NUM_SAMPLES // min(block_sizes) + 1))
+        starts = np.append(0, ends[:-1])
+        blocks = [bandpass_filter(tone[s:e], centre_freqs[s:e], 2, SAMPLE_RATE, state)
+                  for s, e in zip(starts, ends) if s < NUM_SAMPLES]
+        difference = np.max(np.abs(np.concatenate(blocks) - one_go))
+        _debug_1("bandpass in blocks of " + str(block_sizes) + ": max difference = " + str(difference))
+        assert difference == 0.0, "bandpass output depends on the block sizes"
@@ -0,0 +1,267 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+import synth_filter
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+# Envelope stages
+ATTACK = 0
+DECAY = 1
+SUSTAIN = 2
+RELEASE = 3
+IDLE = 4
+
+# ------------------------------
+#  Notes:
+#
+#  1. Envelope_Generator is the ADSR envelope of Model.make_envelope() as a state machine. It sustains until its
+#     note-off (or until an optional gate length), then releases from whatever level it has reached.
+#     It makes its output one block at a time, so a held note needs no memory beyond one block.
+#  2. Each stage of the envelope is a first order recurrence, e.g. in the release stage
+#     level -= release_level_change * (level + 0.1). These have closed forms (geometric series), so each part
+#     of a block that is in one stage is calculated with numpy array operations.
+#  3. The output follows the same steps as synth_dsp.envelope_levels(), so a gated envelope with a gate length
+#     of attack + decay + sustain_time gives the same result as Model.make_envelope(). Tremolo is not part of
+#     the envelope. It is applied as the voices are mixed (see synth_modulation.py).
+#  4. Gated_Note plays a tone with an envelope generator. The tone is looped over a whole number of cycles,
+#     so a note can be held for any length of time without making a longer tone. A playback rate other than 1
+#     (e.g. for a detuned note) reads the tone at fractional positions, with linear interpolation.
+# ------------------------------
+
+class Envelope_Generator:
+    # params = voice snapshot (attack, decay, sustain_level and release).
+    # gate_length = number of samples after which the note is released, or None to wait for note_off().
+    def __init__(self, params, sample_rate=const.SAMPLE_RATE, gate_length=None):
+        self.time_step = 1000 / sample_rate # milliseconds
+        self.sustain_level = params.sustain_level / 100
+        self.attack_change = 1.6 * self.time_step / params.attack
+        self.decay_change = 1.6 * self.time_step / params.decay
+        self.release_change = 1.6 * self.time_step / params.release
+        # Stage ends, in samples from the note-on. A sample at time t (ms) is in the attack stage if t <= attack.
+        self.attack_end = int(np.floor(params.attack / self.time_step)) + 1
+        self.decay_end = max(self.attack_end, int(np.floor((params.attack + params.decay) / self.time_step)) + 1)
+        self.release_length = int(np.ceil(params.release / self.time_step))
+        self.gate_length = gate_length
+        # Highest output of the envelope, used to scale the filter's envelope control.
+        self.peak_gain = np.exp2(1.24 * (1 - np.power(1 - self.attack_change, self.attack_end))) - 1
+        self.stage = ATTACK
+        self.level = 0.0
+        self.position = 0 # samples since the note-on
+        self.release_start = None
+
+    # Start the release stage at the next sample.
+    def note_off(self):
+        if self.stage < RELEASE:
+            self.stage = RELEASE
+            self.release_start = self.position
+
+    def finished(self):
+        return self.stage == IDLE
+
+    # Envelope gains for the next num_samples samples.
+    def process(self, num_samples):
+        levels = np.zeros(num_samples)
+        done = 0
+        while done < num_samples and self.stage != IDLE:
+            if self.stage < RELEASE and not self.gate_length is None and self.position >= self.gate_length:
+                self.note_off()
+            if self.stage == ATTACK:
+                stage_end = self.attack_end
+            elif self.stage == DECAY:
+                stage_end = self.decay_end
+            elif self.stage == SUSTAIN:
+                # Without a gate length, the sustain lasts until note_off().
+                stage_end = self.position + num_samples + 1 if self.gate_length is None else self.gate_length
+            else:
+                stage_end = self.release_start + self.release_length
+            if not self.gate_length is None and self.stage < RELEASE:
+                stage_end = min(stage_end, self.gate_length)
+            count = max(0, min(num_samples - done, stage_end - self.position))
+            steps = np.arange(1, count + 1)
+            if self.stage == ATTACK:
+                stage_levels = 1.24 - (1.24 - self.level) * np.power(1 - self.attack_change, steps)
+            elif self.stage == DECAY:
+                floor = self.sustain_level - 0.1
+                stage_levels = np.maximum(floor + (self.level - floor) * np.power(1 - self.decay_change, steps),
+                                          self.sustain_level)
+            elif self.stage == SUSTAIN:
+                stage_levels = np.full(count, self.sustain_level)
+            else:
+                stage_levels = self._release_levels(steps)
+            levels[done:done + count] = stage_levels
+            if count > 0:
+                self.level = stage_levels[-1]
+            done += count
+            self.position += count
+            if self.position >= stage_end:
+                self._next_stage()
+        return np.exp2(np.maximum(levels, 0.0)) - 1
+
+    # Release levels. The level stops falling at the first step that takes it to zero or below.
+    def _release_levels(self, steps):
+        if self.level <= 0:
+            return np.full(len(steps), self.level)
+        stage_levels = (self.level + 0.1) * np.power(1 - self.release_change, steps) - 0.1
+        below_zero = stage_levels <= 0
+        if np.any(below_zero):
+            first = np.argmax(below_zero)
+            stage_levels[first:] = stage_levels[first]
+        return stage_levels
+
+    def _next_stage(self):
+        if self.stage == ATTACK:
+            self.stage = DECAY
+        elif self.stage == DECAY:
+            self.stage = SUSTAIN
+            self.level = self.sustain_level
+        elif self.stage == SUSTAIN:
+            self.note_off()
+        elif self.stage == RELEASE:
+            self.stage = IDLE
+            self.level = 0.0
+
+
+# A note played from a constant-volume tone, shaped by an envelope generator and (optionally) a filter.
+# It can be mixed like a pre-made note (see synth_mixer.Playing_Note).
+class Gated_Note:
+    # loop_start = sample where the loop (to the end of the tone) starts. vcf = Voltage_Controlled_Filter or None.
+    # rate = playback rate, i.e. the ratio of the note's pitch to the tone's pitch. gain = e.g. velocity / 127.
+    # The tone is only read, so one tone can be shared by many notes.
+    def __init__(self, tone, loop_start, envelope, key=None, vcf=None, filter_cutoff=0, filter_env_depth=0,
+                 received_time=None, rate=1.0, gain=1.0):
+        self.tone = tone
+        self.loop_start = loop_start
+        self.envelope = envelope
+        self.key = key
+        self.vcf = vcf
+        self.filter_cutoff = filter_cutoff
+        self.filter_env_depth = filter_env_depth
+        self.received_time = received_time
+        self.rate = rate
+        self.gain = gain
+        self.position = 0
+
+    def note_off(self):
+        self.envelope.note_off()
+
+    def finished(self):
+        return self.envelope.finished()
+
+    # steps = positions to read the tone at, relative to the current position, e.g. for vibrato
+    # (see synth_modulation.py), or None to read one sample on for each sample. There are num_samples + 1 steps.
+    def next_segment(self, num_samples, steps=None):
+        if steps is None:
+            steps = np.arange(num_samples + 1)
+        if self.rate == 1:
+            positions = self.position + steps
+        else:
+            positions = self.position + self.rate * steps
+        positions = wrap_positions(positions, len(self.tone), self.loop_start)
+        self.position = positions[-1]
+        positions = positions[:-1]
+        gains = self.envelope.process(num_samples)
+        if positions.dtype.kind == "i":
+            samples = self.tone[positions]
+        else:
+            samples = read_tone(self.tone, self.loop_start, positions)
+        segment = samples * (self.gain * gains)
+        if not self.vcf is None:
+            freq_control = synth_filter.envelope_freq_control(self.filter_cutoff, self.filter_env_depth, gains,
+                                                              self.envelope.peak_gain)
+            segment = self.vcf.process(segment, freq_control)
+        return segment
+
+
+# Positions past the end of a tone go round its loop again.
+def wrap_positions(positions, tone_length, loop_start):
+    loop_length = tone_length - loop_start
+    looped = positions >= tone_length
+    positions[looped] = loop_start + ((positions[looped] - loop_start) % loop_length)
+    return positions
+
+# Samples of a looped tone at fractional positions (already wrapped), with linear interpolation.
+def read_tone(tone, loop_start, positions):
+    first = positions.astype(int)
+    fraction = positions - first
+    after = first + 1
+    after[after >= len(tone)] = loop_start
+    return (1 - fraction) * tone[first] + fraction * tone[after]
+
+# Start of a loop, over the end of a tone, that holds a whole number of cycles of the given frequency
+# (as nearly as possible), so the tone can be repeated without a click. The loop is at least half the tone.
+def loop_start(frequency, num_samples, sample_rate=const.SAMPLE_RATE):
+    samples_per_cycle = sample_rate / frequency
+    num_cycles = np.arange(max(1, int(0.5 * num_samples / samples_per_cycle)), int(num_samples / samples_per_cycle) + 1)
+    if len(num_cycles) == 0:
+        return 0
+    loop_lengths = num_cycles * samples_per_cycle
+    best = np.argmin(np.abs(loop_lengths - np.rint(loop_lengths)))
+    return num_samples - int(np.rint(loop_lengths[best]))
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_envelope.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_envelope.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import time
+    import synth_dsp
+
+    class Test_Params:
+        attack = 20
+        decay = 30
+        sustain_time = 100
+        sustain_level = 50
+        release = 40
+
+    # A gated envelope, made in blocks, must match the fixed envelope made by synth_dsp.envelope_levels().
+    params = Test_Params()
+    duration = params.attack + params.decay + params.sustain_time + params.release
+    num_samples = int(const.SAMPLE_RATE * duration / 1000)
+    times_msec = np.linspace(0, duration, num_samples, False)
+    step = times_msec[1]
+    fixed = np.exp2(synth_dsp.envelope_levels(times_msec, params.attack, params.decay, params.sustain_time,
+                                              params.release, params.sustain_level / 100, 1.6 * step / params.attack,
+                                              1.6 * step / params.decay, 1.6 * step / params.release)) - 1
+    gate_length = int(np.ceil((params.attack + params.decay + params.sustain_time) / step))
+    generator = Envelope_Generator(params, const.SAMPLE_RATE, gate_length)
+    start = time.perf_counter()
+    gated = np.concatenate([generator.process(const.MIX_BLOCK_SIZE) for i in range(0, num_samples, const.MIX_BLOCK_SIZE)])
+    finish = time.perf_counter()
+    _debug_1("Gated envelope max difference = " + str(np.max(np.abs(gated[:num_samples] - fixed)))
+             + ", finished = " + str(generator.finished()) + ", seconds = " + str(finish - start))
+
+    # A held note stays at the sustain level until its note-off, then releases.
+    generator = Envelope_Generator(params)
+    held = np.concatenate([generator.process(const.MIX_BLOCK_SIZE) for i in range(100)])
+    generator.note_off()
+    released = np.concatenate([generator.process(const.MIX_BLOCK_SIZE) for i in range(4)])
+    _debug_1("Held for " + str(len(held) / const.SAMPLE_RATE) + " seconds at gain " + str(held[-1])
+             + " (sustain gain = " + str(np.exp2(params.sustain_level / 100) - 1) + ")"
+             + ", released = " + str(generator.finished()) + ", last gain = " + str(released[-1]))
+
+    # A looped tone should join up smoothly.
+    tone = np.sin(2 * np.pi * 220 * np.arange(30870) / const.SAMPLE_RATE)
+    note = Gated_Note(tone, loop_start(220, len(tone)), Envelope_Generator(params))
+    looped = np.concatenate([note.next_segment(const.MIX_BLOCK_SIZE) for i in range(40)])
+    _debug_1("Largest step in looped note = " + str(np.max(np.abs(np.diff(looped)))))
+
+    # A note detuned by 20 cents, read at a fractional rate, should also join up smoothly.
+    note = Gated_Note(tone, loop_start(220, len(tone)), Envelope_Generator(params), rate=np.exp2(20 / 1200))
+    looped = np.concatenate([note.next_segment(const.MIX_BLOCK_SIZE) for i in range(40)])
+    _debug_1("Largest step in detuned looped note = " + str(np.max(np.abs(np.diff(looped)))))
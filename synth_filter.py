@@ -0,0 +1,168 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+import synth_dsp
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+FILTER_TYPES = ["None", "Lowpass", "Highpass", "Bandpass", "Notch"]
+
+# ------------------------------
+#  Notes:
+#
+#  1. These are the filters prototyped in filter_test.py, made into a stage of the synth signal chain.
+#  2. Filter frequencies are set by a control signal, freq_control, with one unit per octave, starting with
+#     0 -> FILTER_LOWEST_TONE (110 Hz). The control signal has one value per sample, so the filter
+#     frequency can follow an envelope.
+#  3. The lowpass and highpass outputs come from two cascaded one-pole filters. Their cutoff frequencies are
+#     only approximate. The bandpass and notch outputs come from a biquad filter, whose centre frequency is
+#     set quite accurately and whose sharpness is set by the Q factor.
+#  4. Every filter type is a second order recursive filter, so its frequency response can be calculated
+#     directly from its coefficients, without running the filter (see frequency_response()).
+# ------------------------------
+
+# Lowpass filter coefficient for each value of the control signal.
+def lowpass_alpha(freq_control):
+    return np.minimum(1.0, np.power(np.maximum(freq_control, 0.0), 1.5) / 16.5)
+
+# Bandpass filter centre frequency, in Hz, for each value of the control signal.
+def centre_frequency(freq_control, sample_rate):
+    return np.minimum(0.4 * sample_rate, (const.FILTER_LOWEST_TONE * np.power(2.0, freq_control)) + 0.5)
+
+# Make a control signal for a filter whose cutoff is raised by the envelope.
+# cutoff and env_depth are in semitones. The envelope is scaled so that its peak gives the full env_depth.
+def envelope_freq_control(cutoff, env_depth, envelope, max_level=None):
+    if max_level is None:
+        max_level = np.max(envelope) if len(envelope) > 0 else 0
+    if env_depth == 0 or max_level <= 0:
+        return np.full(len(envelope), cutoff / 12.0)
+    return (cutoff + (env_depth * envelope / max_level)) / 12.0
+
+# Filter coefficients for a fixed control value, as polynomials in z^-1: output = (b / a) * input.
+# freq_control and q_factor may be arrays (e.g. one value per Q setting). They are broadcast together and
+# the returned b and a arrays have shape (broadcast shape) + (3,).
+# The coefficients match the sample loops in synth_dsp.py, including their one sample delays.
+def filter_coefficients(filter_type, freq_control, q_factor, sample_rate=const.SAMPLE_RATE):
+    freq_control, q_factor = np.broadcast_arrays(np.asarray(freq_control, dtype=float),
+                                                 np.maximum(0.5, np.asarray(q_factor, dtype=float)))
+    zero = np.zeros(freq_control.shape)
+    one = np.ones(freq_control.shape)
+    if filter_type == "Lowpass" or filter_type == "Highpass":
+        alpha = lowpass_alpha(freq_control)
+        # Two one-pole stages: a = (1 - (1 - alpha) z^-1)^2.
+        a = np.stack((one, -2 * (1 - alpha), (1 - alpha) ** 2), axis=-1)
+        if filter_type == "Lowpass":
+            b = np.stack((zero, zero, alpha ** 2), axis=-1)
+        else:
+            b = a - np.stack((zero, alpha ** 2, zero), axis=-1)
+    elif filter_type == "Bandpass" or filter_type == "Notch":
+        fc = centre_frequency(freq_control, sample_rate)
+        R = 1 - (np.pi * fc / (q_factor * sample_rate))
+        a = np.stack((one, -2 * R * np.cos(2 * np.pi * fc / sample_rate), R * R), axis=-1)
+        b = (1 - R)[..., np.newaxis] * np.stack((one, zero, -R), axis=-1)
+        if filter_type == "Notch":
+            b = a - b
+    else:
+        a = np.stack((one, zero, zero), axis=-1)
+        b = np.copy(a)
+    return b, a
+
+# Complex frequency response of a filter, from its coefficients (see filter_coefficients()).
+# The result has shape (shape of the coefficients) + (number of frequencies,).
+def frequency_response(b, a, frequencies, sample_rate=const.SAMPLE_RATE):
+    z1 = np.exp(-2j * np.pi * np.asarray(frequencies, dtype=float) / sample_rate)
+    powers = np.stack((np.ones(z1.shape), z1, z1 * z1))
+    return np.matmul(b, powers) / np.matmul(a, powers)
+
+# Filter gain, in dB, from a frequency response.
+def gain_db(response):
+    return 20 * np.log10(np.maximum(np.abs(response), 1e-12))
+
+# Frequency response of a filter stage measured from its impulse response, for checking the analytic
+# response or for stages that have no simple coefficients. One impulse response is made for each Q factor
+# and they are all transformed with one FFT. Returns the frequencies (Hz) and the responses.
+def impulse_response_spectrum(filter_type, freq_control, q_factors, sample_rate=const.SAMPLE_RATE, num_samples=8192):
+    q_factors = np.atleast_1d(q_factors)
+    impulse = np.zeros(num_samples)
+    impulse[0] = 1.0
+    control = np.full(num_samples, float(freq_control))
+    impulse_responses = np.empty((len(q_factors), num_samples))
+    for i, q_factor in enumerate(q_factors):
+        impulse_responses[i] = Voltage_Controlled_Filter(filter_type, q_factor, sample_rate).process(impulse, control)
+    frequencies = np.fft.rfftfreq(num_samples, 1.0 / sample_rate)
+    return frequencies, np.fft.rfft(impulse_responses, axis=-1)
+
+
+# Voltage Controlled Filter.
+# The filter keeps its state between calls to process(), so a signal can be filtered in blocks of any size,
+# e.g. a whole note when rendering offline, or one block at a time when streaming.
+class Voltage_Controlled_Filter:
+    def __init__(self, filter_type, q_factor, sample_rate=const.SAMPLE_RATE):
+        if not filter_type in FILTER_TYPES:
+            _debug_1("ERROR: unknown filter type = " + str(filter_type))
+            filter_type = "None"
+        self.filter_type = filter_type
+        self.q_factor = max(0.5, float(q_factor))
+        self.sample_rate = sample_rate
+        self.reset()
+
+    # Clear the filter stores, e.g. before starting a new note.
+    def reset(self):
+        self.low_high_pass_state = synth_dsp.new_low_high_pass_state()
+        self.bandpass_state = synth_dsp.new_bandpass_state()
+
+    # Filter the next block of a signal. freq_control must have (at least) one value per sample.
+    def process(self, block, freq_control):
+        if self.filter_type == "None":
+            return block
+        freq_control = freq_control[:len(block)]
+        if self.filter_type == "Lowpass" or self.filter_type == "Highpass":
+            low_pass, high_pass = synth_dsp.low_high_pass_filters(block, lowpass_alpha(freq_control),
+                                                                   self.low_high_pass_state)
+            return low_pass if self.filter_type == "Lowpass" else high_pass
+        band_pass = synth_dsp.bandpass_filter(block, centre_frequency(freq_control, self.sample_rate),
+                                              self.q_factor, self.sample_rate, self.bandpass_state)
+        return band_pass if self.filter_type == "Bandpass" else block - band_pass
+
+    # Complex frequency response of this filter at the given frequencies, for a fixed control value.
+    def frequency_response(self, freq_control, frequencies):
+        b, a = filter_coefficients(self.filter_type, freq_control, self.q_factor, self.sample_rate)
+        return frequency_response(b, a, frequencies, self.sample_rate)
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_filter.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_filter.py: " + message)
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+
+    import time
+
+    SAMPLE_RATE = 44100
+    FREQ_CONTROL = 3.0
+    Q_FACTORS = np.arange(1, 7)
+
+    # The analytic response of every filter type must match the FFT of its impulse response.
+    for filter_type in FILTER_TYPES:
+        start = time.perf_counter()
+        b, a = filter_coefficients(filter_type, FREQ_CONTROL, Q_FACTORS, SAMPLE_RATE)
+        frequencies, measured = impulse_response_spectrum(filter_type, FREQ_CONTROL, Q_FACTORS, SAMPLE_RATE)
+        finish = time.perf_counter()
+        analytic = frequency_response(b, a, frequencies, SAMPLE_RATE)
+        difference = np.max(np.abs(analytic - measured))
+        _debug_1(filter_type + ": max difference = " + str(difference) + ", seconds = " + str(finish - start))
+        if difference > 1e-6:
+            _debug_1("ERROR: " + filter_type + " analytic response differs from impulse response.")
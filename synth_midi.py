@@ -0,0 +1,305 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+import synth_sequence
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+LOWEST_MIDI_NOTE = 21 # MIDI note number of key 0 (A0).
+TICKS_PER_BEAT = 480 # Resolution of the files written.
+TIMESLOTS_PER_BEAT = 4 # One timeslot is a sixteenth note.
+DEFAULT_TEMPO = 500000 # Microseconds per beat, i.e. 120 beats per minute.
+
+# One MIDI channel message. Meta and system exclusive events are not kept.
+MIDI_EVENT = np.dtype([("tick", np.int64), ("status", np.uint8), ("data_1", np.uint8), ("data_2", np.uint8)])
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+
+# ------------------------------
+#  Notes:
+#
+#  1. MIDI channels map to voices: channel 0 plays voice 0 (Voice 1), and so on. Channels above the last
+#     voice are dropped when a file is read.
+#  2. The sequence plays tempo * beats_per_bar timeslots a minute (see Controller._play_sequence()), and
+#     TIMESLOTS_PER_BEAT timeslots fill one MIDI beat. So with 4 beats per bar the sequence tempo is
+#     the MIDI tempo in beats per minute.
+#  3. A file is read in one sequential scan, which only splits the bytes into events (variable length
+#     numbers and running status make this unavoidable). All the conversion to and from sequences is done
+#     on whole arrays of events at once, so files with many thousands of events convert quickly.
+# ------------------------------
+
+# Read a Standard MIDI File (format 0 or 1).
+# Returns (events, ticks_per_beat, tempo, beats_per_bar), where events is an array of MIDI_EVENT sorted by tick
+# and tempo is in microseconds per beat. Returns None if the file can't be read.
+def read_midi_file(filename):
+    try:
+        with open(filename, "rb") as midi_file:
+            data = midi_file.read()
+    except OSError as exception:
+        _debug_1("ERROR: file '" + filename + "' raised exception " + str(exception))
+        return None
+    if data[0:4] != b"MThd":
+        _debug_1("ERROR: not a MIDI file: " + filename)
+        return None
+    header_length = int.from_bytes(data[4:8], "big")
+    file_format = int.from_bytes(data[8:10], "big")
+    num_tracks = int.from_bytes(data[10:12], "big")
+    division = int.from_bytes(data[12:14], "big")
+    if division & 0x8000:
+        _debug_1("ERROR: SMPTE time division is not supported: " + filename)
+        return None
+    if division == 0:
+        _debug_1("ERROR: no ticks per beat in " + filename)
+        return None
+    if file_format > 1:
+        _debug_1("WARNING: MIDI file format " + str(file_format) + ", tracks will be merged.")
+    tempo = None
+    beats_per_bar = None
+    tracks = []
+    pos = 8 + header_length
+    try:
+        for track in range(num_tracks):
+            if data[pos:pos + 4] != b"MTrk":
+                _debug_1("ERROR: track " + str(track) + " not found in " + filename)
+                break
+            track_length = int.from_bytes(data[pos + 4:pos + 8], "big")
+            events, meta = _read_track(data, pos + 8, pos + 8 + track_length)
+            tracks.append(events)
+            for tick, meta_type, meta_data in meta:
+                if meta_type == 0x51 and tempo is None:
+                    tempo = int.from_bytes(meta_data[0:3], "big")
+                if meta_type == 0x58 and beats_per_bar is None:
+                    beats_per_bar = meta_data[0]
+            pos += 8 + track_length
+    # A truncated or corrupt track runs off the end of the data, or has values that don't fit an event.
+    except (IndexError, ValueError) as exception:
+        _debug_1("ERROR: bad track data in " + filename + ", raised exception " + repr(exception))
+        return None
+    if len(tracks) > 0:
+        events = np.concatenate(tracks)
+    else:
+        events = np.zeros(0, dtype=MIDI_EVENT)
+    events = events[np.argsort(events["tick"], kind="stable")]
+    _debug_2("Read " + str(len(events)) + " events from " + filename)
+    if tempo is None:
+        tempo = DEFAULT_TEMPO
+    if beats_per_bar is None:
+        beats_per_bar = 4
+    return events, division, tempo, beats_per_bar
+
+# Split one track chunk into channel events (with absolute ticks) and a list of (tick, type, data) meta events.
+def _read_track(data, pos, end):
+    ticks = []
+    statuses = []
+    data_1 = []
+    data_2 = []
+    meta = []
+    tick = 0
+    status = 0
+    while pos < end:
+        delta, pos = _read_variable_length(data, pos)
+        tick += delta
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        if status == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_variable_length(data, pos + 1)
+            meta.append((tick, meta_type, data[pos:pos + length]))
+            pos += length
+            status = 0
+            if meta_type == 0x2F:
+                break
+        elif status == 0xF0 or status == 0xF7:
+            length, pos = _read_variable_length(data, pos)
+            pos += length
+            status = 0
+        elif status >= 0x80:
+            ticks.append(tick)
+            statuses.append(status)
+            data_1.append(data[pos])
+            if (status & 0xF0) in (0xC0, 0xD0):
+                data_2.append(0)
+                pos += 1
+            else:
+                data_2.append(data[pos + 1])
+                pos += 2
+        else:
+            _debug_1("ERROR: data byte without a status byte at " + str(pos))
+            break
+    events = np.zeros(len(ticks), dtype=MIDI_EVENT)
+    events["tick"] = ticks
+    events["status"] = statuses
+    events["data_1"] = data_1
+    events["data_2"] = data_2
+    return events, meta
+
+# Read a variable length number, returning its value and the position after it.
+def _read_variable_length(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+# Write events to a format 0 Standard MIDI File, with one tempo and time signature.
+def write_midi_file(filename, events, ticks_per_beat=TICKS_PER_BEAT, tempo=DEFAULT_TEMPO, beats_per_bar=4):
+    events = events[np.argsort(events["tick"], kind="stable")]
+    deltas = np.diff(events["tick"], prepend=0)
+    # Each event is a variable length delta time (up to 4 bytes), a status byte and one or two data bytes.
+    num_data_bytes = np.where(np.isin(events["status"] & 0xF0, [0xC0, 0xD0]), 1, 2)
+    delta_bytes, delta_mask = _encode_variable_lengths(deltas)
+    message_bytes = np.stack([events["status"], events["data_1"], events["data_2"]], axis=1)
+    message_mask = np.arange(3)[np.newaxis, :] <= num_data_bytes[:, np.newaxis]
+    record_bytes = np.concatenate([delta_bytes, message_bytes], axis=1)
+    record_mask = np.concatenate([delta_mask, message_mask], axis=1)
+    event_data = record_bytes[record_mask].astype(np.uint8).tobytes()
+    tempo_event = b"\x00\xFF\x51\x03" + int(tempo).to_bytes(3, "big")
+    time_signature_event = b"\x00\xFF\x58\x04" + bytes([int(beats_per_bar), 2, 24, 8])
+    end_event = b"\x00\xFF\x2F\x00"
+    track = tempo_event + time_signature_event + event_data + end_event
+    header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big")
+    header += int(ticks_per_beat).to_bytes(2, "big")
+    try:
+        with open(filename, "wb") as midi_file:
+            midi_file.write(header + b"MTrk" + len(track).to_bytes(4, "big") + track)
+    except OSError as exception:
+        _debug_1("ERROR: file '" + filename + "' raised exception " + str(exception))
+        return False
+    _debug_2("Wrote " + str(len(events)) + " events to " + filename)
+    return True
+
+# Encode an array of numbers (below 2**28) as variable length numbers.
+# Returns an array of 4 bytes per number, and a mask of the bytes that are used.
+def _encode_variable_lengths(values):
+    values = np.asarray(values, dtype=np.int64)
+    groups = (values[:, np.newaxis] >> np.array([21, 14, 7, 0])) & 0x7F
+    # All but the last byte of each number have the top bit set.
+    groups[:, :3] |= 0x80
+    num_bytes = 1 + (values >= (1 << 7)) + (values >= (1 << 14)) + (values >= (1 << 21))
+    mask = np.arange(4)[np.newaxis, :] >= (4 - num_bytes[:, np.newaxis])
+    return groups, mask
+
+# Convert MIDI events into sequence notes (an array of synth_sequence.NOTE_RECORD).
+# Each note-on is paired with the next note-off of the same channel and note number, which gives its duration.
+# Start times and durations are rounded to whole timeslots. Returns the notes and the number that didn't fit.
+def events_to_notes(events, ticks_per_beat, num_voices=const.MAX_VOICES, num_timeslots=const.MAX_TIMESLOTS,
+                    timeslots_per_beat=TIMESLOTS_PER_BEAT):
+    message_types = events["status"] & 0xF0
+    is_on = (message_types == NOTE_ON) & (events["data_2"] > 0)
+    is_off = (message_types == NOTE_OFF) | ((message_types == NOTE_ON) & (events["data_2"] == 0))
+    notes_and_offs = events[is_on | is_off]
+    is_on = is_on[is_on | is_off]
+    channels = notes_and_offs["status"] & 0x0F
+    note_numbers = notes_and_offs["data_1"]
+    # Group the events by channel and note number, in time order, with note-offs before note-ons at the same time.
+    order = np.lexsort((is_on, notes_and_offs["tick"], note_numbers, channels))
+    ticks = notes_and_offs["tick"][order]
+    is_on = is_on[order]
+    same_note = (channels[order][1:] == channels[order][:-1]) & (note_numbers[order][1:] == note_numbers[order][:-1])
+    ended = np.append(same_note & ~is_on[1:], False)
+    on_indices = np.flatnonzero(is_on)
+    durations = np.where(ended[on_indices], ticks[np.minimum(on_indices + 1, len(ticks) - 1)] - ticks[on_indices], 0)
+    note_ons = notes_and_offs[order][on_indices]
+    notes = np.zeros(len(note_ons), dtype=synth_sequence.NOTE_RECORD)
+    notes["voice"] = note_ons["status"] & 0x0F
+    notes["start"] = np.rint(note_ons["tick"] * timeslots_per_beat / ticks_per_beat)
+    notes["key"] = note_ons["data_1"].astype(np.int64) - LOWEST_MIDI_NOTE
+    notes["duration"] = np.clip(np.rint(durations * timeslots_per_beat / ticks_per_beat), 1, np.iinfo(np.int16).max)
+    notes["velocity"] = note_ons["data_2"]
+    fits = ((notes["voice"] < num_voices) & (notes["key"] >= 0) & (notes["key"] < const.NUM_KEYS)
+            & (notes["start"] < num_timeslots))
+    notes = notes[fits]
+    return notes[np.argsort(notes["start"], kind="stable")], int(np.count_nonzero(~fits))
+
+# Convert sequence notes (an array of synth_sequence.NOTE_RECORD) into note-on and note-off events.
+def notes_to_events(notes, ticks_per_beat=TICKS_PER_BEAT, timeslots_per_beat=TIMESLOTS_PER_BEAT):
+    ticks_per_timeslot = ticks_per_beat // timeslots_per_beat
+    num_notes = len(notes)
+    events = np.zeros(2 * num_notes, dtype=MIDI_EVENT)
+    note_ons = events[:num_notes]
+    note_offs = events[num_notes:]
+    note_ons["tick"] = notes["start"] * ticks_per_timeslot
+    note_ons["status"] = NOTE_ON | notes["voice"]
+    note_ons["data_1"] = notes["key"] + LOWEST_MIDI_NOTE
+    note_ons["data_2"] = notes["velocity"]
+    note_offs["tick"] = (notes["start"] + notes["duration"]) * ticks_per_timeslot
+    note_offs["status"] = NOTE_OFF | notes["voice"]
+    note_offs["data_1"] = notes["key"] + LOWEST_MIDI_NOTE
+    # Sort by time, with note-offs before note-ons at the same time, so repeated notes aren't cut short.
+    order = np.lexsort(((events["status"] & 0xF0) == NOTE_ON, events["tick"]))
+    return events[order]
+
+# Sequence tempo (see note 2) for a MIDI tempo in microseconds per beat, and the reverse.
+def sequence_tempo(tempo, beats_per_bar, timeslots_per_beat=TIMESLOTS_PER_BEAT):
+    return int(round(60e6 * timeslots_per_beat / (tempo * beats_per_bar)))
+
+def midi_tempo(sequence_tempo, beats_per_bar, timeslots_per_beat=TIMESLOTS_PER_BEAT):
+    return int(round(60e6 * timeslots_per_beat / (sequence_tempo * beats_per_bar)))
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_midi.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_midi.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import time
+
+    debug_level = 2
+    rng = np.random.default_rng(1)
+    num_notes = 20000
+    notes = np.zeros(num_notes, dtype=synth_sequence.NOTE_RECORD)
+    notes["voice"] = rng.integers(0, const.MAX_VOICES, num_notes)
+    notes["start"] = rng.integers(0, const.MAX_TIMESLOTS, num_notes)
+    notes["key"] = rng.integers(0, const.NUM_KEYS, num_notes)
+    notes["duration"] = rng.integers(1, 8, num_notes)
+    notes["velocity"] = rng.integers(1, 128, num_notes)
+    # Overlapping notes of the same voice and key can't be told apart in a MIDI file, so leave them out.
+    notes = np.sort(notes, order=["voice", "key", "start"])
+    same_note = (notes["voice"][1:] == notes["voice"][:-1]) & (notes["key"][1:] == notes["key"][:-1])
+    overlaps = np.append(same_note & (notes["start"][1:] < notes["start"][:-1] + notes["duration"][:-1]), False)
+    notes = np.sort(notes[~overlaps], order=["start", "voice", "key"])
+    _debug_1("Notes in test sequence = " + str(len(notes)))
+
+    filename = os.path.join(tempfile.gettempdir(), "synth_midi_test.mid")
+    start = time.perf_counter()
+    events = notes_to_events(notes)
+    write_midi_file(filename, events, tempo=midi_tempo(100, 4))
+    finish = time.perf_counter()
+    _debug_1("Export in seconds = " + str(finish - start))
+
+    start = time.perf_counter()
+    events, ticks_per_beat, tempo, beats_per_bar = read_midi_file(filename)
+    new_notes, dropped = events_to_notes(events, ticks_per_beat)
+    finish = time.perf_counter()
+    _debug_1("Import in seconds = " + str(finish - start))
+    new_notes = np.sort(new_notes, order=["start", "voice", "key"])
+    _debug_1("Round trip matches = " + str(np.array_equal(notes, new_notes)) + ", notes dropped = " + str(dropped))
+    _debug_1("Tempo = " + str(sequence_tempo(tempo, beats_per_bar)) + ", beats per bar = " + str(beats_per_bar))
+    os.remove(filename)
+
+    # A track that is shorter than its length field says is reported, not raised.
+    with open(filename, "wb") as midi_file:
+        midi_file.write(b"MThd" + (6).to_bytes(4, "big") + bytes([0, 0, 0, 1, 0, 96])
+                        + b"MTrk" + (100).to_bytes(4, "big") + bytes([0x00, 0x90, 0x3C]))
+    _debug_1("Truncated file read as " + str(read_midi_file(filename)))
+    os.remove(filename)
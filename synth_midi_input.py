@@ -0,0 +1,191 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import queue
+import threading
+import time
+import synth_constants as const
+import synth_midi
+
+try:
+    import mido
+except ImportError:
+    mido = None
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+PORT_NAME = None # MIDI input port to open, or None for the system's default port.
+POLL_TIMEOUT = 0.1 # seconds. How often the input thread checks whether it should stop.
+
+# ------------------------------
+#  Notes:
+#
+#  1. MIDI messages are read by a dedicated thread, so notes don't wait for the GUI's event loop. Each message
+#     is time-stamped (time.perf_counter()) as soon as it is received, and the note-on and note-off callbacks
+#     are called from the input thread.
+#  2. Real ports need the mido package (and a backend such as python-rtmidi). Without it, live MIDI input is
+#     not available, but Loopback_Port can stand in for a port, e.g. in tests.
+#  3. Messages are handled as lists of bytes: [status, data_1, data_2]. Channels map to voices and note numbers
+#     to keys, as for MIDI files (see synth_midi.py).
+# ------------------------------
+
+# A virtual MIDI port. Messages sent to it can be received from another thread, as from a real input port.
+class Loopback_Port:
+    def __init__(self):
+        self.messages = queue.SimpleQueue()
+        self.closed = False
+
+    def send(self, message):
+        self.messages.put(list(message))
+
+    # Wait up to timeout seconds for a message. Returns the message bytes, or None.
+    def receive(self, timeout=None):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+
+
+# Adapter giving a mido input port the same receive() method as Loopback_Port.
+class Mido_Port:
+    def __init__(self, port):
+        self.port = port
+        self.closed = False
+
+    def receive(self, timeout=None):
+        end_time = time.perf_counter() + (0 if timeout is None else timeout)
+        while True:
+            message = self.port.poll()
+            if not message is None:
+                return message.bytes()
+            if time.perf_counter() >= end_time:
+                return None
+            time.sleep(0.001)
+
+    def close(self):
+        self.closed = True
+        self.port.close()
+
+
+# Open the MIDI input port called name (or the default port). Returns None if there is no MIDI input.
+def open_input_port(name=PORT_NAME):
+    if mido is None:
+        _debug_1("mido is not installed, so there is no live MIDI input.")
+        return None
+    try:
+        return Mido_Port(mido.open_input(name))
+    except (OSError, IOError, ImportError) as exception:
+        _debug_1("WARNING: no MIDI input port: " + str(exception))
+        return None
+
+
+# Reads note messages from a port on its own thread, and passes them on:
+# on_note_on(voice_index, key, velocity, received_time) and on_note_off(voice_index, key, received_time).
+class Midi_Input:
+    def __init__(self, port, on_note_on, on_note_off, num_voices=const.MAX_VOICES):
+        self.port = port
+        self.on_note_on = on_note_on
+        self.on_note_off = on_note_off
+        self.num_voices = num_voices
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._input_loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if not self.thread is None:
+            self.thread.join()
+            self.thread = None
+        self.port.close()
+
+    def _input_loop(self):
+        _debug_2("MIDI input thread started")
+        while self.running:
+            message = self.port.receive(POLL_TIMEOUT)
+            if message is None or len(message) < 3:
+                continue
+            received_time = time.perf_counter()
+            self.handle_message(message, received_time)
+        _debug_2("MIDI input thread stopped")
+
+    def handle_message(self, message, received_time):
+        status, data_1, data_2 = message[0], message[1], message[2]
+        message_type = status & 0xF0
+        voice_index = status & 0x0F
+        key = data_1 - synth_midi.LOWEST_MIDI_NOTE
+        if voice_index >= self.num_voices or key < 0 or key >= const.NUM_KEYS:
+            return
+        if message_type == synth_midi.NOTE_ON and data_2 > 0:
+            self.on_note_on(voice_index, key, data_2, received_time)
+        elif message_type == synth_midi.NOTE_OFF or message_type == synth_midi.NOTE_ON:
+            self.on_note_off(voice_index, key, received_time)
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_midi_input.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_midi_input.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import numpy as np
+    import synth_envelope
+    import synth_mixer
+
+    # Play notes through a loopback port into a mixer, with a stand-in audio thread mixing blocks in real time,
+    # and measure the input to output latency.
+    mixer = synth_mixer.Mixer()
+
+    class Test_Params:
+        attack = 10
+        decay = 10
+        sustain_level = 50
+        release = 40
+        tremolo_rate = 0
+        tremolo_depth = 0
+
+    def note_on(voice_index, key, velocity, received_time):
+        tone = (velocity / 127) * np.sin(2 * np.pi * 220 * np.arange(const.SAMPLE_RATE) / const.SAMPLE_RATE)
+        envelope = synth_envelope.Envelope_Generator(Test_Params)
+        note = synth_envelope.Gated_Note(tone, synth_envelope.loop_start(220, len(tone)), envelope, key,
+                                         received_time=received_time)
+        mixer.note_on(voice_index, note)
+
+    def note_off(voice_index, key, received_time):
+        mixer.note_off(voice_index, key)
+
+    port = Loopback_Port()
+    midi_input = Midi_Input(port, note_on, note_off)
+    midi_input.start()
+    block_secs = const.MIX_BLOCK_SIZE / const.SAMPLE_RATE
+    for i in range(20):
+        if i % 2 == 0:
+            port.send([synth_midi.NOTE_ON, 60, 100])
+        else:
+            port.send([synth_midi.NOTE_OFF, 60, 0])
+        for j in range(3):
+            mixer.mix_block()
+            time.sleep(block_secs)
+    midi_input.stop()
+    mean_latency, max_latency = mixer.note_latency()
+    _debug_1("Input to mix latency, ms: mean = " + str(1000 * mean_latency) + ", max = " + str(1000 * max_latency)
+             + ", plus up to " + str(1000 * block_secs) + " ms output queue.")
+    _debug_1("Notes still playing = " + str(mixer.allocator.num_active(0)))
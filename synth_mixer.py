@@ -0,0 +1,508 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import collections
+import queue
+import threading
+import time
+import numpy as np
+import synth_constants as const
+import synth_polyphony
+import synth_envelope
+import synth_modulation
+import synth_renderer
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+# Schroeder reverb: comb filter and allpass filter delays (milliseconds) and feedback gains.
+REVERB_COMB_DELAYS = (29.7, 37.1, 41.1, 43.7)
+REVERB_COMB_FEEDBACK = 0.80
+REVERB_ALLPASS_DELAYS = (5.0, 1.7)
+REVERB_ALLPASS_FEEDBACK = 0.7
+
+# Chorus: modulated delay (milliseconds) and modulation rate (Hz).
+CHORUS_BASE_DELAY = 15.0
+CHORUS_MAX_SWEEP = 10.0
+CHORUS_RATE = 0.8
+
+# ------------------------------
+#  Notes:
+#
+#  1. The mixer streams the sound output in blocks of MIX_BLOCK_SIZE samples. Notes are added to the
+#     mixer when they start and are mixed into the output a block at a time until they finish.
+#  2. Each voice has its own effects bus (delay, chorus and reverb). The notes of a voice are summed onto
+#     its bus first, so the effects are run once per block for each voice, however many notes are playing.
+#  3. The voices are mixed with a fixed gain (VOICE_GAIN), leaving headroom for chords, and the master bus
+#     limiter turns down any peaks that would still clip. Notes are not normalised, so quiet notes stay quiet.
+#  4. The effects are recursive, but each one only feeds back after a delay of at least a millisecond or so.
+#     The blocks are processed in chunks no longer than the shortest feedback delay, so each chunk can be
+#     calculated with numpy array operations instead of sample by sample.
+#  5. Gated notes (see synth_envelope.py), e.g. from MIDI input, are held until their note-off, then released.
+#     Note-on and note-off events are posted to a queue, which the mixer reads at the start of each block,
+#     so posting an event never waits for the mixer.
+#  6. For live notes, the time from the note-on being received to the note's first block being mixed is
+#     recorded. The block then waits behind the block being played, i.e. for up to one more block time.
+#  7. Notes are played in the fixed pool of note slots of a Note_Allocator (see synth_polyphony.py), which
+#     limits the number of notes mixed at once. A note that loses its slot is faded out over the next block.
+#  8. Gated notes are played by a Note_Renderer (see synth_renderer.py), which makes the next block of all of
+#     them at once. The blocks are summed into the voices with one matrix product. Pre-made notes are mixed
+#     one by one.
+#  9. Tremolo is applied to each voice's mix of notes, before its effects, by the voice's free-running LFO
+#     (see synth_modulation.py). Vibrato is applied as the gated notes are rendered, by reading their tones
+#     at the positions given by the voice's PITCH LFO.
+# ------------------------------
+
+# Circular buffer holding the recent history of a signal.
+class Delay_Line:
+    def __init__(self, max_delay):
+        size = 1
+        while size < max_delay + const.MIX_BLOCK_SIZE:
+            size *= 2
+        self.buffer = np.zeros(size)
+        self.mask = size - 1
+        self.write_position = 0
+
+    def clear(self):
+        self.buffer[:] = 0.0
+
+    # Read num_samples samples, starting delay samples before the next write position.
+    # Only valid for num_samples <= delay, i.e. samples that have already been written.
+    def read(self, delay, num_samples):
+        indices = (self.write_position - delay + np.arange(num_samples)) & self.mask
+        return self.buffer[indices]
+
+    # Read with a (fractional) delay for each sample, relative to the position of that sample in the block
+    # that was last written. Linear interpolation between the two nearest samples.
+    def read_fractional(self, delays):
+        positions = (self.write_position - len(delays) + np.arange(len(delays))) - delays
+        whole = np.floor(positions)
+        fraction = positions - whole
+        whole = whole.astype(np.int64)
+        return ((1.0 - fraction) * self.buffer[whole & self.mask]) + (fraction * self.buffer[(whole + 1) & self.mask])
+
+    def write(self, block):
+        indices = (self.write_position + np.arange(len(block))) & self.mask
+        self.buffer[indices] = block
+        self.write_position = (self.write_position + len(block)) & self.mask
+
+
+# Feedback comb filter: y[n] = x[n] + feedback * y[n - delay].
+# The delay can be changed later, up to max_delay samples.
+class Comb_Filter:
+    def __init__(self, delay, feedback, max_delay=0):
+        self.delay = max(1, int(delay))
+        self.feedback = feedback
+        self.line = Delay_Line(max(self.delay, int(max_delay)))
+
+    def process(self, block):
+        output = np.empty(len(block))
+        for start in range(0, len(block), self.delay):
+            chunk = block[start:start + self.delay]
+            y = chunk + self.feedback * self.line.read(self.delay, len(chunk))
+            self.line.write(y)
+            output[start:start + len(chunk)] = y
+        return output
+
+
+# Schroeder allpass filter: v[n] = x[n] + g * v[n - delay], y[n] = v[n - delay] - g * v[n].
+class Allpass_Filter:
+    def __init__(self, delay, feedback):
+        self.delay = max(1, int(delay))
+        self.feedback = feedback
+        self.line = Delay_Line(self.delay)
+
+    def process(self, block):
+        output = np.empty(len(block))
+        for start in range(0, len(block), self.delay):
+            chunk = block[start:start + self.delay]
+            delayed = self.line.read(self.delay, len(chunk))
+            v = chunk + self.feedback * delayed
+            self.line.write(v)
+            output[start:start + len(chunk)] = delayed - self.feedback * v
+        return output
+
+
+# The effects for one voice: feedback delay (echo), then chorus, then Schroeder reverb.
+# Effect settings come from a voice parameter snapshot, see set_params().
+class Effects_Bus:
+    def __init__(self, sample_rate=const.SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.delay_time = 0
+        self.chorus_sweep = 0.0
+        self.reverb_level = 0.0
+        self.echo = Comb_Filter(1, 0.0, const.MAX_DELAY_TIME * sample_rate / 1000)
+        self.chorus_line = Delay_Line(int((CHORUS_BASE_DELAY + CHORUS_MAX_SWEEP) * sample_rate / 1000) + 2)
+        self.chorus_phase = 0.0
+        self.combs = [Comb_Filter(d * sample_rate / 1000, REVERB_COMB_FEEDBACK) for d in REVERB_COMB_DELAYS]
+        self.allpasses = [Allpass_Filter(d * sample_rate / 1000, REVERB_ALLPASS_FEEDBACK) for d in REVERB_ALLPASS_DELAYS]
+        self.tail_samples = 0
+
+    def set_params(self, params):
+        delay_time = int(params.delay_time * self.sample_rate / 1000)
+        if max(1, delay_time) != self.echo.delay:
+            self.echo.line.clear()
+        self.delay_time = delay_time if params.delay_feedback > 0 else 0
+        self.echo.delay = max(1, delay_time)
+        self.echo.feedback = params.delay_feedback / 100
+        self.chorus_sweep = params.chorus_depth * CHORUS_MAX_SWEEP / 100
+        self.reverb_level = params.reverb_level / 100
+
+    def is_active(self):
+        return self.delay_time > 0 or self.chorus_sweep > 0 or self.reverb_level > 0
+
+    # Number of samples the effects keep sounding after their input stops.
+    def tail_length(self):
+        tail = 0
+        if self.delay_time > 0:
+            # Echoes die away to -60dB.
+            tail += int(self.delay_time * np.log(0.001) / np.log(self.echo.feedback))
+        if self.chorus_sweep > 0:
+            tail += int((CHORUS_BASE_DELAY + CHORUS_MAX_SWEEP) * self.sample_rate / 1000)
+        if self.reverb_level > 0:
+            tail += int(max(REVERB_COMB_DELAYS) * self.sample_rate / 1000 * np.log(0.001) / np.log(REVERB_COMB_FEEDBACK))
+        return tail
+
+    # Process the next block of the voice's mix. silent = True if no notes fed the bus in this block.
+    def process(self, block, silent=False):
+        if silent:
+            if self.tail_samples <= 0:
+                return block
+            self.tail_samples -= len(block)
+        else:
+            self.tail_samples = self.tail_length()
+        if self.delay_time > 0:
+            block = self.echo.process(block)
+        if self.chorus_sweep > 0:
+            block = self._chorus(block)
+        if self.reverb_level > 0:
+            wet = self.combs[0].process(block)
+            for comb in self.combs[1:]:
+                wet += comb.process(block)
+            wet /= len(self.combs)
+            for allpass in self.allpasses:
+                wet = allpass.process(wet)
+            block = block + self.reverb_level * wet
+        return block
+
+    def _chorus(self, block):
+        self.chorus_line.write(block)
+        phases = self.chorus_phase + (2 * np.pi * CHORUS_RATE / self.sample_rate) * np.arange(len(block))
+        self.chorus_phase = (phases[-1] + (2 * np.pi * CHORUS_RATE / self.sample_rate)) % (2 * np.pi)
+        delays = (CHORUS_BASE_DELAY + 0.5 * self.chorus_sweep * (1 + np.sin(phases))) * self.sample_rate / 1000
+        return 0.7 * (block + self.chorus_line.read_fractional(delays))
+
+
+# Master output stage: a look-ahead peak limiter and a peak/RMS level meter, run on each mixed block.
+class Master_Bus:
+    def __init__(self, sample_rate=const.SAMPLE_RATE):
+        self.look_ahead = max(1, int(const.LIMITER_LOOK_AHEAD * sample_rate / 1000))
+        self.threshold_db = 20 * np.log10(const.LIMITER_THRESHOLD)
+        # Gain changes, in dB per sample.
+        self.attack_rate = const.LIMITER_ATTACK_DB / self.look_ahead
+        self.release_rate = const.LIMITER_RELEASE_DB * 1000 / (const.LIMITER_RELEASE_TIME * sample_rate)
+        self.meter_decay_db = const.METER_DECAY_DB * const.MIX_BLOCK_SIZE / sample_rate
+        # The last look_ahead input samples, and their target gains, are held back for the next block.
+        self.held_samples = np.zeros(self.look_ahead)
+        self.held_target_db = np.zeros(self.look_ahead)
+        self.gain_db = 0.0
+        self.peak_level_db = -100.0
+        self.rms_level_db = -100.0
+        self.gain_reduction_db = 0.0
+
+    def process(self, block):
+        num_samples = len(block)
+        # Gain (dB) needed to keep each sample under the threshold.
+        target_db = np.minimum(0.0, self.threshold_db - 20 * np.log10(np.maximum(np.abs(block), 1e-9)))
+        samples = np.concatenate((self.held_samples, block))
+        target_db = np.concatenate((self.held_target_db, target_db))
+        self.held_samples = samples[num_samples:]
+        self.held_target_db = target_db[num_samples:]
+        # Attack: the gain ramps down over the look-ahead time to reach each sample's target in time.
+        # gain[j] = min over k in [j, j + look_ahead] of (target[k] + attack_rate * (k - j)).
+        ramp = self.attack_rate * np.arange(len(target_db))
+        windows = np.lib.stride_tricks.sliding_window_view(target_db + ramp, self.look_ahead + 1)
+        gain_db = np.min(windows, axis=1) - ramp[:num_samples]
+        # Release: the gain rises by at most release_rate per sample,
+        # i.e. gain[j] = min(gain[j], gain[j-1] + release_rate), which is a running minimum of a sloping line.
+        gain_db[0] = min(gain_db[0], self.gain_db + self.release_rate)
+        ramp = self.release_rate * np.arange(num_samples)
+        gain_db = np.minimum.accumulate(gain_db - ramp) + ramp
+        self.gain_db = gain_db[-1]
+        output = samples[:num_samples] * np.power(10.0, gain_db / 20)
+        self._update_meter(output, gain_db)
+        return output
+
+    # Peak and RMS levels (dBFS) of the output, and the largest gain reduction. Peaks fall back slowly.
+    def _update_meter(self, output, gain_db):
+        peak = 20 * np.log10(max(np.max(np.abs(output)), 1e-5))
+        rms = 20 * np.log10(max(np.sqrt(np.mean(output * output)), 1e-5))
+        self.peak_level_db = max(peak, self.peak_level_db - self.meter_decay_db)
+        self.rms_level_db = rms
+        self.gain_reduction_db = - np.min(gain_db)
+
+
+# A pre-made note being mixed. Gated notes (synth_envelope.Gated_Note) are mixed in the same way.
+class Playing_Note:
+    def __init__(self, wave):
+        self.wave = wave
+        self.position = 0
+        self.key = None
+        self.received_time = None
+
+    # Next part of the note, up to num_samples long.
+    def next_segment(self, num_samples):
+        segment = self.wave[self.position:self.position + num_samples]
+        self.position += len(segment)
+        return segment
+
+    # A pre-made note has its release built in.
+    def note_off(self):
+        pass
+
+    def finished(self):
+        return self.position >= len(self.wave)
+
+
+# Streaming mixer. Notes can be added from any thread; the blocks are made by the audio output thread.
+class Mixer:
+    def __init__(self, sample_rate=const.SAMPLE_RATE, block_size=const.MIX_BLOCK_SIZE):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        # Active notes (Playing_Note or Gated_Note objects), in note slots shared by all the voices (see note 7).
+        self.allocator = synth_polyphony.Note_Allocator()
+        self.renderer = synth_renderer.Note_Renderer(self.allocator.num_slots)
+        self.rendered = np.zeros(self.allocator.num_slots, dtype=bool) # slots played by the renderer
+        self.voice_mixes = np.zeros((const.MAX_VOICES, block_size))
+        # Stolen notes fading out, already mixed for the next block, and the voices that have them.
+        self.fade_mixes = np.zeros((const.MAX_VOICES, block_size))
+        self.fading = np.zeros(const.MAX_VOICES, dtype=bool)
+        self.fade_ramp = np.linspace(1.0, 0.0, block_size, endpoint=False)
+        # Live note-on and note-off events, applied at the start of the next block (see note 5).
+        self.events = queue.SimpleQueue()
+        # Recent live note latencies, in seconds (see note 6).
+        self.latencies = collections.deque(maxlen=100)
+        self.buses = [Effects_Bus(sample_rate) for vi in range(const.MAX_VOICES)]
+        self.modulation = synth_modulation.Modulation_Matrix(const.MAX_VOICES, sample_rate)
+        self.voice_gains = np.full(const.MAX_VOICES, const.VOICE_GAIN)
+        self.master = Master_Bus(sample_rate)
+
+    # Notes are mixed at their own level (full scale = 1.0), scaled by the fixed voice gain.
+    def add_note(self, voice_index, wave):
+        if wave.ndim > 1:
+            wave = np.mean(wave, axis=1)
+        with self.lock:
+            self._start_note(voice_index, Playing_Note(wave))
+
+    # Start a gated note, which is held until note_off() is called for its key (or its gate length ends).
+    def note_on(self, voice_index, note):
+        if note.received_time is None:
+            note.received_time = time.perf_counter()
+        self.events.put(("on", voice_index, note))
+
+    def note_off(self, voice_index, key):
+        self.events.put(("off", voice_index, key))
+
+    # Input to mix latencies of recent live notes: mean and maximum, in seconds, or None if there are none.
+    def note_latency(self):
+        latencies = list(self.latencies)
+        if len(latencies) == 0:
+            return None
+        return float(np.mean(latencies)), float(np.max(latencies))
+
+    # Limit the number of notes that can play at once, and choose which note a new note replaces (see note 7).
+    def set_polyphony(self, polyphony, policy=None):
+        with self.lock:
+            self.allocator.set_polyphony(polyphony, policy)
+
+    def _start_note(self, voice_index, note):
+        slot, stolen_voice, stolen = self.allocator.allocate(voice_index, note)
+        if not stolen is None:
+            if self.rendered[slot]:
+                steps = self.modulation.steps([stolen_voice], self.block_size)
+                segment = self.renderer.render([slot], self.block_size, steps)[0][0]
+            else:
+                segment = stolen.next_segment(self.block_size)
+            self.fade_mixes[stolen_voice, :len(segment)] += segment * self.fade_ramp[:len(segment)]
+            self.fading[stolen_voice] = True
+        self.rendered[slot] = isinstance(note, synth_envelope.Gated_Note)
+        if self.rendered[slot]:
+            self.renderer.start(slot, note)
+        # Live notes are started at the beginning of a block, so this is when their first block is mixed.
+        if not note.received_time is None:
+            self.latencies.append(time.perf_counter() - note.received_time)
+
+    def _apply_events(self):
+        while True:
+            try:
+                event, voice_index, value = self.events.get_nowait()
+            except queue.Empty:
+                return
+            if event == "on":
+                self._start_note(voice_index, value)
+                continue
+            for slot in self.allocator.key_slots(voice_index, value):
+                if self.rendered[slot]:
+                    self.renderer.note_off(slot)
+                else:
+                    self.allocator.notes[slot].note_off()
+
+    def set_effects(self, voice_index, params):
+        with self.lock:
+            self.buses[voice_index].set_params(params)
+
+    # Set the LFOs of a voice, e.g. its tremolo (see note 9).
+    def set_modulation(self, voice_index, params):
+        with self.lock:
+            self.modulation.set_voice(voice_index, params)
+
+    # Mix the next block of output, in the range -1.0 to +1.0.
+    def mix_block(self):
+        output = np.zeros(self.block_size)
+        with self.lock:
+            self._apply_events()
+            # Stolen notes' fade outs were mixed when they were stolen.
+            allocator = self.allocator
+            voice_mixes = self.voice_mixes
+            voice_mixes[:] = self.fade_mixes
+            self.fade_mixes[:] = 0.0
+            sounding = self.fading.copy()
+            self.fading[:] = False
+            active_slots = allocator.active_slots()
+            slots = active_slots[self.rendered[active_slots]]
+            if len(slots) > 0:
+                voices = allocator.voices[slots]
+                steps = None
+                if np.any(self.modulation.depths[synth_modulation.PITCH, voices] > 0):
+                    steps = self.modulation.steps(voices, self.block_size)
+                notes, finished = self.renderer.render(slots, self.block_size, steps)
+                voice_mixes += (voices == np.arange(const.MAX_VOICES)[:, np.newaxis]) @ notes
+                allocator.levels[slots] = np.max(np.abs(notes), axis=1)
+                sounding[voices] = True
+                for slot in slots[finished]:
+                    allocator.release(slot)
+            for slot in active_slots[~self.rendered[active_slots]]:
+                note = allocator.notes[slot]
+                vi = allocator.voices[slot]
+                segment = note.next_segment(self.block_size)
+                voice_mixes[vi, :len(segment)] += segment
+                allocator.levels[slot] = np.max(np.abs(segment)) if len(segment) > 0 else 0.0
+                sounding[vi] = True
+                if note.finished():
+                    allocator.release(slot)
+            self.modulation.apply_amplitude(voice_mixes)
+            self.modulation.advance(self.block_size)
+            for vi in range(const.MAX_VOICES):
+                bus = self.buses[vi]
+                if not sounding[vi] and (bus.tail_samples <= 0 or not const.EFFECTS_ENABLED):
+                    continue
+                voice_mix = voice_mixes[vi]
+                silent = not sounding[vi]
+                if const.EFFECTS_ENABLED and bus.is_active():
+                    voice_mix = bus.process(voice_mix, silent)
+                output += self.voice_gains[vi] * voice_mix
+        return np.clip(self.master.process(output), -1.0, 1.0)
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_mixer.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_mixer.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+
+    import time
+
+    class Test_Params:
+        delay_time = 120
+        delay_feedback = 50
+        chorus_depth = 50
+        reverb_level = 30
+        tremolo_rate = 5
+        tremolo_depth = 10
+        vibrato_rate = 50
+        vibrato_depth = 20
+
+    # Check the block processed filters against direct sample by sample calculations.
+    rng = np.random.default_rng(1)
+    signal = rng.uniform(-1, 1, 5 * const.MIX_BLOCK_SIZE)
+    comb = Comb_Filter(300, 0.8)
+    allpass = Allpass_Filter(75, 0.7)
+    comb_output = np.concatenate([comb.process(signal[i:i + const.MIX_BLOCK_SIZE])
+                                  for i in range(0, len(signal), const.MIX_BLOCK_SIZE)])
+    allpass_output = np.concatenate([allpass.process(signal[i:i + const.MIX_BLOCK_SIZE])
+                                     for i in range(0, len(signal), const.MIX_BLOCK_SIZE)])
+    y = np.zeros(len(signal))
+    v = np.zeros(len(signal))
+    z = np.zeros(len(signal))
+    for n in range(len(signal)):
+        y[n] = signal[n] + (0.8 * y[n - 300] if n >= 300 else 0)
+        v[n] = signal[n] + (0.7 * v[n - 75] if n >= 75 else 0)
+        z[n] = (v[n - 75] if n >= 75 else 0) - 0.7 * v[n]
+    _debug_1("Comb filter max difference = " + str(np.max(np.abs(comb_output - y))))
+    _debug_1("Allpass filter max difference = " + str(np.max(np.abs(allpass_output - z))))
+
+    # A loud chord must be limited without clipping, and reach the limiter threshold.
+    master = Master_Bus()
+    chord = sum(np.sin(2 * np.pi * f * np.arange(4 * const.MIX_BLOCK_SIZE) / const.SAMPLE_RATE) for f in [220, 277, 330])
+    limited = np.concatenate([master.process(chord[i:i + const.MIX_BLOCK_SIZE])
+                              for i in range(0, len(chord), const.MIX_BLOCK_SIZE)])
+    _debug_1("Limited chord: input peak = " + str(np.max(np.abs(chord))) + ", output peak = " + str(np.max(np.abs(limited)))
+             + ", gain reduction dB = " + str(master.gain_reduction_db))
+
+    # Time the mixer with every voice playing through all its effects.
+    mixer = Mixer()
+    for vi in range(const.MAX_VOICES):
+        mixer.set_effects(vi, Test_Params)
+        mixer.set_modulation(vi, Test_Params)
+    for num_notes in [1, 10]:
+        for vi in range(const.MAX_VOICES):
+            for i in range(num_notes):
+                mixer.add_note(vi, 0.1 * np.sin(2 * np.pi * 220 * np.arange(const.SAMPLE_RATE) / const.SAMPLE_RATE))
+        num_blocks = 20
+        start = time.perf_counter()
+        for i in range(num_blocks):
+            mixer.mix_block()
+        finish = time.perf_counter()
+        _debug_1(str(num_notes) + " notes per voice: milliseconds per block = " + str(1000 * (finish - start) / num_blocks)
+                 + ", block length, ms = " + str(1000 * const.MIX_BLOCK_SIZE / const.SAMPLE_RATE))
+
+    # A dense chord of gated notes: the notes beyond the polyphony limit steal slots, so the mixing time is bounded.
+    import synth_envelope
+
+    class Test_Envelope_Params:
+        attack = 10
+        decay = 10
+        sustain_level = 50
+        release = 40
+        tremolo_rate = 0
+        tremolo_depth = 0
+
+    tone = np.sin(2 * np.pi * 220 * np.arange(const.SAMPLE_RATE) / const.SAMPLE_RATE)
+    for policy in synth_polyphony.STEAL_POLICIES:
+        mixer = Mixer()
+        mixer.set_polyphony(const.MAX_POLYPHONY, policy)
+        for vi in range(const.MAX_VOICES):
+            mixer.set_modulation(vi, Test_Params)
+        for key in range(200):
+            envelope = synth_envelope.Envelope_Generator(Test_Envelope_Params)
+            mixer.note_on(key % const.MAX_VOICES, synth_envelope.Gated_Note(tone, synth_envelope.loop_start(220, len(tone)),
+                                                                            envelope, key % 20, gain=0.05))
+        start = time.perf_counter()
+        for i in range(num_blocks):
+            mixer.mix_block()
+        finish = time.perf_counter()
+        _debug_1(policy + ": 200 notes started, notes playing = " + str(mixer.allocator.num_active())
+                 + ", stolen = " + str(mixer.allocator.num_stolen)
+                 + ", milliseconds per block = " + str(1000 * (finish - start) / num_blocks))
@@ -1,14 +1,130 @@
 
+import collections
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
 import numpy as np
 import synth_constants as const
+import synth_dsp
+import synth_envelope
+import synth_filter
+import synth_modulation
+import synth_pitch
 
 ######################### Global variables #########################
 
 # Debug levels: 0 = none, 1 = basic, 2 = long-winded.
 debug_level = 1
 
+# Names of the voice parameters used to make tones and envelopes respectively.
+TONE_PARAMETERS = ("waveform", "width", "harmonic_boost", "unison_voices", "unison_detune", "ring_mod_rate", "tuning",
+                   "harmonic_levels", "harmonic_phases")
+ENVELOPE_PARAMETERS = ("attack", "decay", "sustain_time", "sustain_level", "release")
+# Keys whose tones are rendered (base tones). Every other key is resampled from the next base tone above it,
+# so resampling only ever lowers the pitch.
+BASE_KEYS = np.unique(np.append(np.arange(0, const.NUM_KEYS, const.BASE_TONE_INTERVAL), const.NUM_KEYS - 1))
+NUM_BASE_TONES = len(BASE_KEYS)
+BASE_INDEX_OF_KEY = np.searchsorted(BASE_KEYS, np.arange(const.NUM_KEYS))
+
+FILTER_PARAMETERS = ("filter_type", "filter_cutoff", "filter_resonance", "filter_env_depth")
+EFFECTS_PARAMETERS = ("delay_time", "delay_feedback", "chorus_depth", "reverb_level")
+# LFOs, applied as the voices are mixed (see synth_modulation.py).
+MODULATION_PARAMETERS = ("tremolo_rate", "tremolo_depth", "vibrato_rate", "vibrato_depth")
+# Q factor of the bandpass response used to suppress the fundamental for harmonic boost (see harmonic_table()).
+BOOST_Q_FACTOR = 2
+
 ####################################################################
 
+# An immutable copy of the sound-making parameters of one voice.
+# The GUI thread posts these to the render thread, so the render thread never sees a half-edited voice.
+# Every render function takes the snapshot of the voice it is making, so voices can be made in any order,
+# or at the same time, and always give the same result. tone_key() doubles as the key of cached tones.
+@dataclass(frozen=True, slots=True)
+class Voice_Snapshot:
+    waveform: str = "Sine"
+    width: float = 100
+    harmonic_boost: int = 0
+    vibrato_rate: int = 0
+    vibrato_depth: int = 0
+    unison_voices: int = 1
+    unison_detune: int = 0
+    ring_mod_rate: int = 0
+    tuning: str = "Equal"
+    # Harmonics of the "Additive" waveform: levels in %, phases in degrees, from the fundamental up.
+    harmonic_levels: tuple = const.DEFAULT_HARMONIC_LEVELS
+    harmonic_phases: tuple = ()
+    attack: int = const.DEFAULT_ATTACK
+    decay: int = const.DEFAULT_DECAY
+    sustain_time: int = const.DEFAULT_SUSTAIN
+    sustain_level: int = const.DEFAULT_SUSTAIN_LEVEL
+    release: int = const.DEFAULT_RELEASE
+    tremolo_rate: int = 0
+    tremolo_depth: int = 0
+    filter_type: str = "None"
+    filter_cutoff: int = const.DEFAULT_FILTER_CUTOFF
+    filter_resonance: int = const.DEFAULT_FILTER_RESONANCE
+    filter_env_depth: int = 0
+    delay_time: int = 0
+    delay_feedback: int = 0
+    chorus_depth: int = 0
+    reverb_level: int = 0
+
+    # Copy the matching attributes of any voice parameters object, e.g. the controller's Voice_Parameters.
+    @classmethod
+    def from_params(cls, voice_params):
+        names = TONE_PARAMETERS + ENVELOPE_PARAMETERS + FILTER_PARAMETERS + EFFECTS_PARAMETERS + MODULATION_PARAMETERS
+        return cls(**{name: getattr(voice_params, name) for name in names})
+
+    def tone_settings(self):
+        return tuple(getattr(self, name) for name in TONE_PARAMETERS)
+
+    # Tones made with equal keys are identical.
+    def tone_key(self):
+        return self.tone_settings()
+
+    def envelope_settings(self):
+        return tuple(getattr(self, name) for name in ENVELOPE_PARAMETERS)
+
+    # Notes made with equal sound keys sound the same, before the voice's LFOs and effects.
+    def sound_key(self):
+        return tuple(getattr(self, name) for name in TONE_PARAMETERS + ENVELOPE_PARAMETERS + FILTER_PARAMETERS)
+
+
+# Least recently used store of envelopes, keyed by their settings (Voice_Snapshot.envelope_settings()).
+# Voices with the same settings share one envelope, and moving a slider back to an earlier setting finds
+# the envelope already made. The arrays are read-only, as they may be shared.
+class Envelope_Bank:
+    def __init__(self, size=const.ENVELOPE_BANK_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        # The render thread and the GUI thread can both ask for envelopes.
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # The (levels, envelope) pair for some settings, made by calling make() if the bank doesn't have it.
+    def fetch(self, settings, make):
+        with self.lock:
+            entry = self.entries.get(settings)
+            if not entry is None:
+                self.entries.move_to_end(settings)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = make()
+            for array in entry:
+                array.flags.writeable = False
+            self.entries[settings] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            return entry
+
+
 class Model:
     def __init__(self, controller, sample_rate, max_duration=const.MAX_ENVELOPE_TIME,
                  duration=const.MAX_ENVELOPE_TIME, stereo=const.STEREO):
@@ -17,156 +133,264 @@ class Model:
         self.max_duration = max_duration   # milliseconds
         self.duration = duration           # milliseconds
         self.stereo = stereo               # Boolean
-        self.envelopes = []
-        self.frequencies = np.zeros((const.MAX_VOICES, const.NUM_KEYS), dtype=int)
-        self.voices = np.zeros((const.MAX_VOICES, const.NUM_KEYS, (int(sample_rate * const.MAX_ENVELOPE_TIME / 1000))), dtype=float)
+        # Parameter snapshots owned by the model. These are only replaced (never modified) by the render thread.
+        self.voice_params = [Voice_Snapshot()] * const.MAX_VOICES
+        # The snapshot each voice's tones should be made from. Replacing it marks tones with a different key as obsolete.
+        self.tone_params = list(self.voice_params)
+        # Envelopes and tones are double-buffered: new arrays are made in full, then swapped in by reference.
+        self.envelopes = [None] * const.MAX_VOICES
+        self.envelope_bank = Envelope_Bank()
+        self.frequencies = np.zeros((const.MAX_VOICES, const.NUM_KEYS), dtype=float)
+        # Pitch bend, in semitones, applied to every note. Bent notes are made on demand, not kept in the voices list.
+        self.pitch_bend = 0.0
+        # Each base tone is stored as a (tone key, tone array) pair, or None if not made yet.
+        self.voices = [[None] * NUM_BASE_TONES for voice_index in range(const.MAX_VOICES)]
+        # Held while the tones, frequencies and tone_params of the voices are read or swapped, as tones are fetched
+        # from the render thread, the sequence thread and the test thread. Re-entrant, as fetching can make tones.
+        self.tone_lock = threading.RLock()
+        # Requests from the GUI are handled in order by a single render thread.
+        self.render_queue = queue.SimpleQueue()
+        self.render_thread = None
 
 
     def main(self, num_voices=const.MAX_VOICES):
+        for voice_index in range(const.MAX_VOICES):
+            snapshot = Voice_Snapshot.from_params(self.controller.voice_params[voice_index])
+            self.voice_params[voice_index] = snapshot
+            self.tone_params[voice_index] = snapshot
+        self.render_voices(range(num_voices))
         for voice_index in range(num_voices):
-            self.make_voice(voice_index)
+            self.make_envelope(voice_index)
+        self.start_render_thread()
+
+    # A model of its own for fixed voice snapshots and pitch bend, which makes its tones as they are needed.
+    # Nothing else changes it, so another thread can make notes from it while the voices are edited, e.g. to
+    # bounce a song (see synth_bounce.py).
+    @classmethod
+    def from_snapshots(cls, snapshots, pitch_bend=0.0, sample_rate=const.SAMPLE_RATE, max_duration=const.MAX_ENVELOPE_TIME):
+        model = cls(None, sample_rate, max_duration)
+        model.voice_params = list(snapshots)
+        model.tone_params = list(snapshots)
+        model.pitch_bend = float(pitch_bend)
+        return model
+
+    # Stop the render thread.
+    def shutdown(self):
+        self.stop_render_thread()
+
+    # ------------------------------
+    # Parallel voice rendering
+    # ------------------------------
+
+    # Make all the base tones of several voices, sharing the work between a pool of processes.
+    # Each job makes a range of base tones for one voice and writes the tones straight into a shared-memory
+    # tone bank, indexed [voice, base tone, sample], so no tone arrays are pickled back to this process.
+    # The tones are copied out of the bank before it is released, as notes hold on to their tones while they play,
+    # and an array over shared memory that has been released reads whatever is there (or crashes).
+    # Worker processes come from a fork server (or are spawned where there is none), not forked from this process,
+    # as this process has other threads running (audio, GUI, MIDI) that may hold locks a forked child would never
+    # see released. So the main module needs a main guard (see main.py).
+    def render_voices(self, voice_indices):
+        self._debug_2("In render_voices()")
+        voice_indices = list(voice_indices)
+        num_processes = min(os.cpu_count() or 1, const.MAX_RENDER_PROCESSES)
+        if not const.PARALLEL_RENDER_ENABLED or num_processes < 2 or len(voice_indices) == 0:
+            for voice_index in voice_indices:
+                self.make_voice(voice_index)
+            return
+        shape = (len(voice_indices), NUM_BASE_TONES, self._tone_length())
+        bank_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(float).itemsize)
+        try:
+            bank = np.ndarray(shape, dtype=float, buffer=bank_memory.buf)
+            jobs = []
+            for row, voice_index in enumerate(voice_indices):
+                for first_base in range(0, NUM_BASE_TONES, const.RENDER_CHUNK_KEYS):
+                    last_base = min(first_base + const.RENDER_CHUNK_KEYS, NUM_BASE_TONES)
+                    jobs.append((bank_memory.name, shape, row, first_base, last_base, self.tone_params[voice_index],
+                                 self.sample_rate, self.max_duration))
+            self._debug_1("Rendering " + str(len(voice_indices)) + " voices with " + str(num_processes) + " processes.")
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            with ProcessPoolExecutor(max_workers=num_processes,
+                                     mp_context=multiprocessing.get_context(start_method)) as pool:
+                # Wait for all jobs, and pass on any exception raised in a worker.
+                for result in pool.map(_render_tone_job, jobs):
+                    pass
+            # Swap in copies of each voice's tones from its rows of the bank.
+            with self.tone_lock:
+                for row, voice_index in enumerate(voice_indices):
+                    tone_key = self.tone_params[voice_index].tone_key()
+                    self.frequencies[voice_index] = self.key_frequency(np.arange(const.NUM_KEYS), self.tone_params[voice_index])
+                    for base_index in range(NUM_BASE_TONES):
+                        self.voices[voice_index][base_index] = (tone_key, bank[row, base_index].copy())
+            del bank
+        finally:
+            bank_memory.close()
+            bank_memory.unlink()
+
+    # ------------------------------
+    # Render thread
+    # ------------------------------
+
+    def start_render_thread(self):
+        if self.render_thread is None:
+            self.render_thread = threading.Thread(target=self._render_loop, daemon=True)
+            self.render_thread.start()
+
+    def stop_render_thread(self):
+        if not self.render_thread is None:
+            self.render_queue.put(None)
+            self.render_thread.join()
+            self.render_thread = None
+
+    # Post new parameters for a voice. on_envelope(voice_index, envelope) is called from the render
+    # thread if the envelope had to be remade.
+    def post_voice_params(self, voice_index, snapshot, on_envelope=None):
+        self.render_queue.put(("params", voice_index, snapshot, on_envelope))
+
+    # Set the pitch bend, in semitones, for notes made from now on.
+    def set_pitch_bend(self, pitch_bend):
+        self.pitch_bend = float(pitch_bend)
+
+    # Post new parameters for all the voices at once, e.g. when the settings are restored. The render thread
+    # makes the tones of the first num_voices voices together, in parallel (see render_voices()).
+    def post_voices(self, snapshots, num_voices):
+        self.render_queue.put(("voices", list(snapshots), num_voices))
+
+    # Post a request to make a note. on_note(voice_index, note, frequency) is called from the render thread.
+    # preview = True for a note that only illustrates a change of settings, so only the latest one is worth playing.
+    # Other notes, e.g. key presses, are all played.
+    def post_note(self, voice_index, key, on_note, preview=False):
+        self.render_queue.put(("note", voice_index, key, on_note, preview))
+
+    def _render_loop(self):
+        self._debug_2("In _render_loop()")
+        while True:
+            events = [self.render_queue.get()]
+            # Collect everything else that was posted while the last batch was being rendered.
+            while True:
+                try:
+                    events.append(self.render_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in events:
+                self._debug_2("Render thread stopped")
+                return
+            # This is the only render thread, so it carries on with the next batch whatever goes wrong.
+            try:
+                self._render_batch(events)
+            except Exception as exception:
+                self._debug_1("ERROR: render thread raised exception " + repr(exception))
+
+    def _render_batch(self, events):
+        # New parameters for all the voices replace everything posted before them.
+        loads = [i for i, event in enumerate(events) if event[0] == "voices"]
+        if len(loads) > 0:
+            self._load_voices(*events[loads[-1]][1:])
+            events = events[loads[-1] + 1:]
+        # Only the latest parameters for each voice, and the latest preview note, are worth rendering.
+        latest_params = {}
+        notes = []
+        for event in events:
+            if event[0] == "params":
+                latest_params[event[1]] = event[2:]
+            elif event[0] == "note":
+                if event[4]:
+                    notes = [note for note in notes if not note[3]]
+                notes.append(event[1:])
+        self._debug_2("Render batch: events, voices changed = " + str(len(events)) + ", " + str(len(latest_params)))
+        for voice_index, (snapshot, on_envelope) in latest_params.items():
+            self._apply_voice_params(voice_index, snapshot, on_envelope)
+        for voice_index, key, on_note, preview in notes:
+            tone, frequency = self.fetch_tone(voice_index, key)
+            note = self.apply_envelope(voice_index, tone, frequency=frequency)
+            on_note(voice_index, note, frequency)
+
+    # Swap in new parameters for every voice, and make the tones of the first num_voices voices in parallel.
+    # Notes still playing keep the old tones, as tones are swapped by reference (never changed in place).
+    def _load_voices(self, snapshots, num_voices):
+        self._debug_2("In _load_voices()")
+        with self.tone_lock:
+            for voice_index, snapshot in enumerate(snapshots):
+                self.voice_params[voice_index] = snapshot
+                self.tone_params[voice_index] = snapshot
+        self.render_voices(range(num_voices))
+        for voice_index in range(num_voices):
+            self.make_envelope(voice_index)
+
+    # Swap in new parameters for a voice, and remake or scratch whatever they affect.
+    def _apply_voice_params(self, voice_index, snapshot, on_envelope):
+        old_snapshot = self.voice_params[voice_index]
+        self.voice_params[voice_index] = snapshot
+        if snapshot.tone_settings() != old_snapshot.tone_settings():
+            self.scratch_voice(voice_index)
+        if snapshot.envelope_settings() != old_snapshot.envelope_settings():
             envelope = self.make_envelope(voice_index)
-            self.envelopes.append(envelope)
-        pass
+            if not on_envelope is None:
+                on_envelope(voice_index, envelope)
         
-    # Create a unit-amplitude sine wave with vibrato.
+    # Number of samples in a tone.
+    def _tone_length(self):
+        return int(self.sample_rate * self.max_duration / 1000)
+
+    # Oscillator phase, in cycles, for each sample of a tone (see synth_pitch.py).
+    def _oscillator_phase(self, frequency):
+        return synth_pitch.phase_accumulator(frequency, self._tone_length(), self.sample_rate)
+
+    # Create a unit-amplitude sine wave. Vibrato is applied as the tone is played (see synth_modulation.py).
     def _sine_wave(self, frequency):
         self._debug_2("Sine wave freq, max duration (ms) = " + str(frequency) + ", " + str(self.max_duration))
-        # Generate array with duration*sample_rate steps, ranging between 0 and duration
-        times_sec = np.linspace(0, self.max_duration / 1000, int(self.sample_rate * self.max_duration / 1000), False)
-        self._debug_2("No. of samples = " + str(len(times_sec)))
-        # Generate a sine wave for the vibrato signal
-        time_step = times_sec[1]
-        vibrato_rate = self.controller.voice_params[self.controller.voice_index].vibrato_rate
-        vibrato_depth = self.controller.voice_params[self.controller.voice_index].vibrato_depth
-        vibrato_radians_per_sec = 2 * np.pi * vibrato_rate * frequency / 500
-        vibrato_tone = vibrato_depth * time_step * np.sin(vibrato_radians_per_sec * times_sec)
-        
-        times_with_vibrato = times_sec + vibrato_tone
-        
-        # Generate a sine wave
-        radians_per_sec = 2 * np.pi * frequency
-        if const.VIBRATO_ENABLED:
-            tone = np.sin(radians_per_sec * times_with_vibrato)
-        else:
-            tone = np.sin(radians_per_sec * times_sec)
-        
-        return tone
+        phase = self._oscillator_phase(frequency)
+        self._debug_2("No. of samples = " + str(len(phase)))
+        return np.sin(2 * np.pi * phase)
 
 
-    # Create a unit-amplitude triangle wave with vibrato and harmonic boost.
+    # Create a unit-amplitude triangle wave.
     def _triangle_wave(self, frequency):
         self._debug_2("Triangle wave freq, max duration (ms) = " + str(frequency) + ", " + str(self.max_duration))
-        # Generate array with duration*sample_rate steps, ranging between 0 and duration (converted to seconds)
-        times_sec = np.linspace(0, self.max_duration / 1000, int(self.sample_rate * self.max_duration / 1000), False)
-        # Generate linear ramp with duration*sample_rate steps, ranging between 0 and 2*frequency*duration
-        ramp = 2 * frequency * times_sec # e.g. from 0 to 2 * 110 * 0.1 for 110Hz over 0.1 seconds 
-        # Generate a sine wave for the vibrato signal
-        vibrato_rate = self.controller.voice_params[self.controller.voice_index].vibrato_rate
-        vibrato_depth = self.controller.voice_params[self.controller.voice_index].vibrato_depth / 200
-        time_step = times_sec[1]
-        self._debug_2("time_step = " + str(time_step))
-        vibrato_radians_per_sec = 2 * np.pi * vibrato_rate * frequency / 500
-        vibrato_tone = vibrato_depth * 2 * np.sin(vibrato_radians_per_sec * times_sec)
-        self._debug_2("Vibrato tone (min, max) = (" + str(min(vibrato_tone)) + ", " + str(max(vibrato_tone)) + ")") 
-        # Generate a triangle wave
-        ramp_with_vibrato = ramp + vibrato_tone
-        if const.VIBRATO_ENABLED:
-            tone = abs(((2 * ramp_with_vibrato + 3 ) % 4.0) - 2) - 1
-        else:
-            tone = abs(((2 * ramp + 3 ) % 4.0) - 2) - 1
-        return tone
-    
-    # Create a unit-amplitude sawtooth wave with pulse width control, vibrato and harmonic boost.
+        return _triangle(self._oscillator_phase(frequency))
+
+    # Create a unit-amplitude sawtooth wave with pulse width control.
     def _pwm_sawtooth_wave(self, frequency, width):
         self._debug_2("Sawtooth wave: freq, width = " + str(frequency) + ", " + str(width))
-        width = float(width)
-        # Generate linear ramp with total of duration*sample_rate steps.
-        ramp = np.linspace(2.0 - width/100, (2 * frequency * self.max_duration/1000) + 2 - width/100,
-                           int(self.sample_rate * self.max_duration / 1000), False)
-        
-        # Generate a sine wave for the vibrato signal
-        vibrato_rate = self.controller.voice_params[self.controller.voice_index].vibrato_rate
-        vibrato_depth = self.controller.voice_params[self.controller.voice_index].vibrato_depth
-        vibrato_radians_per_msec = 2 * np.pi * vibrato_rate / 1000
-        time_step = ramp[1]
-        vibrato_tone = vibrato_depth * time_step * np.sin(vibrato_radians_per_msec * ramp) / 100
-        
-        # Generate a sawtooth wave
-        if const.VIBRATO_ENABLED:
-            tone = np.clip((100/width) * (((ramp + vibrato_tone) % 2.0) + width/100 - 2.0), -1.0, 1.0)
-        else:
-            tone = np.clip((100/width) * ((ramp % 2.0) + width/100 - 2.0), -1.0, 1.0)
-        return tone
-    
+        return _pwm_sawtooth(self._oscillator_phase(frequency), float(width))
     
-    # Create a unit-amplitude square wave with pulse width control, vibrato and harmonic boost.
+    # Create a unit-amplitude square wave with pulse width control.
     def _pwm_square_wave(self, frequency, width):
         self._debug_2("Square wave: freq, width = " + str(frequency) + ", " + str(width))
-        width = float(width)
-        # Generate linear ramp with total of duration*sample_rate steps.
-        ramp = np.linspace(2.0 - width/100, (2 * frequency * self.max_duration / 1000) + 2 - width/100,
-                           int(self.sample_rate * self.max_duration / 1000), False)
-
-        # Generate a sine wave for the vibrato signal
-        vibrato_rate = self.controller.voice_params[self.controller.voice_index].vibrato_rate
-        vibrato_depth = self.controller.voice_params[self.controller.voice_index].vibrato_depth
-        vibrato_radians_per_msec = 2 * np.pi * vibrato_rate / 1000
-        time_step = ramp[1]
-        vibrato_tone = vibrato_depth * time_step * np.sin(vibrato_radians_per_msec * ramp) / 100
-        
-        # Generate a square wave, clip sine to avoid using scipy library.
-        if const.VIBRATO_ENABLED:
-            tone = np.clip(1000 * (((ramp + vibrato_tone) % 2.0) + (width/100) - 2.0), -1.0, 1.0)
-        else:
-            tone = np.clip(1000 * ((ramp % 2.0) + (width/100) - 2.0), -1.0, 1.0)
-        return tone
-    
-    # Suppress the fundamental frequency and amplify the result to boost the harmonics.
-    def _suppress_fundamental(self, tone, frequency):
-        harmonic_boost = self.controller.voice_params[self.controller.voice_index].harmonic_boost 
-        # Make a frequency control waveform
-        freq_control = frequency * np.ones(len(tone), dtype=float)
-        filter_q_factor = 2 # Magic number
-        filtered_tone = self._bandpass_filter(tone, freq_control, filter_q_factor)
-        # Compensate for settling time of filter, by merging more stable cycles with the early samples.
-        two_cycles = int(2 * self.sample_rate / frequency)
-        one_over_two_cycles = 1 / two_cycles # do division outside loop, to cut processor load.
-        for i in range(two_cycles):
-            filtered_tone[i] = (((two_cycles-i) * filtered_tone[i+two_cycles]) + (i * filtered_tone[i])) * one_over_two_cycles
-        boost_ratio = harmonic_boost / 100
-        tone = tone - (boost_ratio * filtered_tone)
-        boost_factor = 1 / max(tone)
-        tone = tone * boost_factor
-        return tone
-            
-    # Bandpass Filter.
-    # tone = input waveform to be filtered, freq_control = control signal to set filter centre frequency. 
-    # q_factor = ratio of filter centre frequency divided by 3dB bandwidth (approximately).
-    def _bandpass_filter(self, tone, freq_control, q_factor):
-        
-        # Bandpass and bandstop (notch) biquadratic filters.
-        band_pass = np.zeros(len(tone))
-        #notch = np.zeros(len(tone))
-        x0 = x1 = x2 = 0
-        for i in range(len(tone)):
-            # Recalculate filter coefficients, every 1.45 milliseconds.
-            if i % 64 == 0:
-                fc = freq_control[i]
-                R = 1 - (np.pi * fc / (q_factor * self.sample_rate))
-                b2 = - R
-                a1 = - 2 * R * np.cos(2 * np.pi * fc / self.sample_rate)
-                a2 = R * R            
-                rescale = 1 - R
-            
-            # Calculate biquad filter.
-            x0 = tone[i] - (a1 * x1) - (a2 * x2)
-            band_pass[i] = rescale * (x0 + (b2 * x2))
-            #notch[i] = tone[i] - band_pass[i]
-            x2 = x1
-            x1 = x0
-        
-        return band_pass
+        return _pwm_square(self._oscillator_phase(frequency), float(width))
+
+    # Create a unit-amplitude wave with its harmonics boosted, from a single cycle of it (see harmonic_table()).
+    def _boosted_wave(self, waveform, frequency, width, harmonic_boost):
+        self._debug_2("Boosted wave: freq, boost = " + str(frequency) + ", " + str(harmonic_boost))
+        return self._read_wavetable(harmonic_table(waveform, float(width), harmonic_boost), frequency)
+
+    # Create a wave from a voice's harmonic levels and phases, using the wavetable with only the harmonics
+    # below the Nyquist frequency (see additive_tables()), so the tone doesn't alias at any key.
+    def _additive_wave(self, frequency, harmonic_levels, harmonic_phases):
+        self._debug_2("Additive wave: freq, levels = " + str(frequency) + ", " + str(harmonic_levels))
+        tables = additive_tables(harmonic_levels, harmonic_phases)
+        num_harmonics = int(0.5 * self.sample_rate / frequency)
+        return self._read_wavetable(tables[min(max(num_harmonics, 1), len(tables)) - 1], frequency)
+
+    # Read a single cycle wavetable at the oscillator phase, with linear interpolation.
+    def _read_wavetable(self, table, frequency):
+        positions = (self._oscillator_phase(frequency) % 1.0) * const.WAVETABLE_SIZE
+        return np.interp(positions, np.arange(const.WAVETABLE_SIZE + 1), table)
+
+    # Create a unit-amplitude tone of any waveform, with harmonic_boost % boost of its harmonics.
+    def _wave(self, waveform, frequency, width, harmonic_boost=0):
+        if harmonic_boost > 0 and waveform != "Sine":
+            return self._boosted_wave(waveform, frequency, width, harmonic_boost)
+        if waveform == "Sine":
+            return self._sine_wave(frequency)
+        elif waveform == "Triangle":
+            return self._triangle_wave(frequency)
+        elif waveform == "Sawtooth":
+            return self._pwm_sawtooth_wave(frequency, width)
+        elif waveform == "Square":
+            return self._pwm_square_wave(frequency, width)
+        self._debug_1("ERROR: invalid waveform in render_frequency() = " + str(waveform))
+        return np.zeros(self._tone_length(), dtype=float)
 
 
     # Multiply input tone by ring modulator tone if selected
@@ -180,7 +404,8 @@ class Model:
         return output
     
     # Apply the envelope amplitude to the tone to make a note, and convert it to stereo.
-    def apply_envelope(self, voice_index, tone, stereo=True):
+    # frequency = the tone's fundamental frequency, needed to loop the tone for vibrato.
+    def apply_envelope(self, voice_index, tone, stereo=True, frequency=None):
         self._debug_2("In apply_envelope() ")
         if tone is None:
             self._debug_1("ERROR: tone is None in apply_envelope().")
@@ -189,41 +414,73 @@ class Model:
             self._debug_1("ERROR: voice_index = " + str(voice_index))
             return None
         self.stereo = stereo
+        # Take one reference to the envelope, in case the render thread swaps in a new one meanwhile.
+        envelope = self.envelopes[voice_index]
+        if envelope is None:
+            self.make_envelope(voice_index)
+            envelope = self.envelopes[voice_index]
         
-        self._debug_2("No. of samples = " + str(len(self.envelopes[voice_index])))
+        self._debug_2("No. of samples = " + str(len(envelope)))
         self._debug_2("Tone shape = " + str(tone.shape))
-        self._debug_2("Envelope shape = " + str(self.envelopes[voice_index].shape))       
+        self._debug_2("Envelope shape = " + str(envelope.shape))       
 
-        if (len(self.envelopes[voice_index]) > len(tone)):
+        if (len(envelope) > len(tone)):
             self._debug_1("Error: Tone is shorter than envelope in apply_envelope.")
             return None
         else:
+            # The note is made in full before it is played, so its vibrato starts with the note.
+            params = self.voice_params[voice_index]
+            if not frequency is None and synth_modulation.is_modulated(params, synth_modulation.PITCH):
+                modulation = synth_modulation.Modulation_Matrix(1, self.sample_rate)
+                modulation.set_voice(0, params)
+                loop_start = synth_envelope.loop_start(frequency, len(tone), self.sample_rate)
+                positions = synth_envelope.wrap_positions(modulation.steps([0], len(envelope) - 1)[0], len(tone), loop_start)
+                tone = synth_envelope.read_tone(tone, loop_start, positions)
             # Truncate input tone to match length of the envelope.
-            tone = tone[:len(self.envelopes[voice_index])]
+            tone = tone[:len(envelope)]
             # Multiply each tone sample by the matching envelope sample.
-            note = np.multiply(tone, self.envelopes[voice_index])
+            note = np.multiply(tone, envelope)
+            # Pass the note through the voice's filter, if it has one.
+            if const.VCF_ENABLED:
+                note = self.apply_filter(voice_index, note, envelope)
             
         # Duplicate note to make left and right channels if required.
         if stereo == True:
             note = np.column_stack((note, note))
         return note
     
-        
+    # Pass a note through the voltage controlled filter of the given voice, with the cutoff raised by its envelope.
+    def apply_filter(self, voice_index, note, envelope):
+        params = self.voice_params[voice_index]
+        if params.filter_type == "None":
+            return note
+        self._debug_2("In apply_filter(): " + params.filter_type)
+        vcf = synth_filter.Voltage_Controlled_Filter(params.filter_type, params.filter_resonance, self.sample_rate)
+        freq_control = synth_filter.envelope_freq_control(params.filter_cutoff, params.filter_env_depth, envelope)
+        return vcf.process(note, freq_control)
+
+    # Swap in the envelope for a voice's settings, from the envelope bank. Returns its levels before the
+    # exponential function is applied, for display.
     def make_envelope(self, voice_index):
         self._debug_2("In make_envelope() ")
-        voice = self.controller.voice_params[voice_index]
+        voice = self.voice_params[voice_index]
+        levels, envelope = self.envelope_bank.fetch(voice.envelope_settings(), lambda: self._envelope_levels(voice))
+        self.envelopes[voice_index] = envelope
+        return levels
+
+    # Make the (levels, envelope) pair for a voice's envelope settings.
+    def _envelope_levels(self, voice):
         attack = voice.attack
         decay = voice.decay
         sustain_time = voice.sustain_time
         sustain_level = voice.sustain_level / 100
         release = voice.release
-        self.duration = voice.attack + voice.decay + voice.sustain_time + voice.release
-        self._debug_2("Envelope duration, ms = " + str(self.duration))
-        new_envelope_length = int(self.sample_rate * self.duration/1000)
+        duration = voice.attack + voice.decay + voice.sustain_time + voice.release
+        self._debug_2("Envelope duration, ms = " + str(duration))
+        new_envelope_length = int(self.sample_rate * duration/1000)
         self._debug_2("Envelope length, samples = " + str(new_envelope_length))
-        new_envelope = np.zeros(int(new_envelope_length), dtype=float)
         # Generate array with duration*sample_rate steps, ranging between 0 and duration (milli-seconds)
-        times_msec = np.linspace(0, self.duration, int(new_envelope_length), False)
+        times_msec = np.linspace(0, duration, int(new_envelope_length), False)
         self._debug_2("No. of samples = " + str(len(times_msec)))
             
         attack_level_change = 1.6 * times_msec[1] / attack  
@@ -233,120 +490,149 @@ class Model:
         self._debug_2("Decay level change = " + str(decay_level_change))
         self._debug_2("Release level change = " + str(release_level_change))
         self._debug_2("Time step, milliseconds = " + str(times_msec[1]))
-                
-        # Generate a tremolo cosine wave
-        radians_per_msec = 2 * np.pi * voice.tremolo_rate / 1000
-        tremolo = (voice.tremolo_depth / 100) * np.cos(radians_per_msec * times_msec)
-        
-        level = 0.0
-        for i in range(len(times_msec)):
-            if times_msec[i] <= attack:
-                level += attack_level_change * (1.24 - level)
-                # print(str(i) + " Attack")
-            elif times_msec[i] <= attack + decay:
-                #print(str(i) + " Decay")
-                level -= decay_level_change * (level + 0.1 - sustain_level)
-                if level < sustain_level:
-                    level = sustain_level
-            elif times_msec[i] < attack + decay + sustain_time:
-                #print(str(i) + " Sustain")
-                level = sustain_level
-            elif times_msec[i] < attack + decay + sustain_time + release:
-                #print(str(i) + " Release")
-                if level > 0:
-                    level -= release_level_change * (level + 0.1)
-            else:
-                level = 0              
-            new_envelope[i] = max(0, level + tremolo[i])
+
+        # Step through the ADSR stages sample by sample (compiled if possible, see synth_dsp.py).
+        # Tremolo is not part of the envelope, so changing it doesn't remake the envelope (see synth_modulation.py).
+        new_envelope = synth_dsp.envelope_levels(times_msec, attack, decay, sustain_time, release, sustain_level,
+                                                 attack_level_change, decay_level_change, release_level_change)
             
-        # Replace old envelope with new one
-        if len(self.envelopes) <= voice_index:
-            # (Note: this warning is always given on program start up.)
-            self._debug_1("WARNING: list of envelopes length = " + str(len(self.envelopes)))
-        else:
-            self.envelopes.pop(voice_index)
-        # Apply an exponential function to the envelope and store it in the model.
-        self.envelopes.insert(voice_index, np.exp2(new_envelope) - 1)
-        return new_envelope
+        # Apply an exponential function to the envelope.
+        return new_envelope, np.exp2(new_envelope) - 1
     
+    # Make a gated note, which sustains until its note-off (or for gate_length samples), then releases.
+    # The note is shaped block by block as it is mixed (see synth_envelope.py), so it can be held for any time.
+    # The velocity (1 to 127) scales the note.
+    # detune = pitch offset in cents, e.g. from a sequence note, played by changing the tone's playback rate.
+    def make_gated_note(self, voice_index, key, velocity=127, gate_length=None, received_time=None, detune=0.0):
+        self._debug_2("In make_gated_note()")
+        return self._gated_note(voice_index, key, gate_length, received_time, np.exp2(detune / 1200), velocity / 127)
+
+    # Gated notes for all the notes of a timeslot at once. notes = array of synth_sequence.NOTE_RECORD, and
+    # gate_lengths = samples each note is held for. The playback rates and gains are worked out for all the notes
+    # together, and the tones are all fetched under one hold of the tone lock, so a timeslot never mixes old and new
+    # tones of a voice. Each note still gets its own envelope and filter, as those keep state while it plays.
+    def make_gated_notes(self, notes, gate_lengths):
+        self._debug_2("In make_gated_notes()")
+        rates = np.exp2(notes["detune"].astype(float) / 1200)
+        gains = notes["velocity"] / 127
+        with self.tone_lock:
+            return [self._gated_note(int(notes["voice"][i]), int(notes["key"][i]), int(gate_lengths[i]), None,
+                                     rates[i], gains[i]) for i in range(len(notes))]
+
+    def _gated_note(self, voice_index, key, gate_length, received_time, rate, gain):
+        tone, frequency = self.fetch_tone(voice_index, key)
+        params = self.voice_params[voice_index]
+        envelope = synth_envelope.Envelope_Generator(params, self.sample_rate, gate_length)
+        vcf = None
+        if const.VCF_ENABLED and params.filter_type != "None":
+            vcf = synth_filter.Voltage_Controlled_Filter(params.filter_type, params.filter_resonance, self.sample_rate)
+        loop_start = synth_envelope.loop_start(frequency, len(tone), self.sample_rate)
+        return synth_envelope.Gated_Note(tone, loop_start, envelope, key, vcf, params.filter_cutoff,
+                                         params.filter_env_depth, received_time, rate, gain)
+
     # Mark all the tones for this voice as obsolete. Obsolete tones should be remade before being played.
     def scratch_voice(self, voice_index):
         self._debug_2("In scratch_voice() ")
         if voice_index >= const.MAX_VOICES:
             self._debug_1("ERROR: invalid voice number in scratch_voice() = " + str(voice_index))
             return
-        for key in range(const.NUM_KEYS):
-            self.voices[voice_index, key, 0] = -5 # Set first sample to an invalid value
+        # Tones made from any other snapshot are obsolete.
+        with self.tone_lock:
+            self.tone_params[voice_index] = self.voice_params[voice_index]
         
     def make_voice(self, voice_index):
         self._debug_1("In make_voice() - making voice:  " + str(voice_index))
         if voice_index >= const.MAX_VOICES:
             self._debug_1("ERROR: invalid voice number in make_voice() = " + str(voice_index))
             return
-        for key in range(const.NUM_KEYS):
-            self.make_tone(voice_index, key)         
+        for base_index in range(NUM_BASE_TONES):
+            self.make_base_tone(voice_index, base_index)         
             
-    # Calculate a constant-volume sound wave for the given voice and key, and save the result in the 'voices' array. 
-    def make_tone(self, voice_index, key):
-        self._debug_2("In make_tone() ")
+    # Calculate a constant-volume sound wave for the given voice and base tone, and save the result in the 'voices' list. 
+    def make_base_tone(self, voice_index, base_index):
+        self._debug_2("In make_base_tone() ")
         if voice_index >= const.MAX_VOICES:
-            self._debug_1("ERROR: invalid voice number in make_tone() = " + str(voice_index))
-            return
-        if key >= const.NUM_KEYS:
-            self._debug_1("ERROR: invalid key in make_tone() = " + str(key))
+            self._debug_1("ERROR: invalid voice number in make_base_tone() = " + str(voice_index))
             return
-        waveform = self.controller.voice_params[voice_index].waveform
-        width = self.controller.voice_params[voice_index].width
-        centre_frequency = int((const.LOWEST_TONE * np.power(2, key/12)) + 0.5)
-        unison_voices = self.controller.voice_params[voice_index].unison_voices
-        unison_detune = self.controller.voice_params[voice_index].unison_detune
+        with self.tone_lock:
+            params = self.tone_params[voice_index]
+            tone_key = params.tone_key()
+            # Share the tone of any other voice that was made with the same settings.
+            tone = None
+            for voice_tones in self.voices:
+                entry = voice_tones[base_index]
+                if not entry is None and entry[0] == tone_key:
+                    tone = entry[1]
+                    break
+            if tone is None:
+                tone = self.render_tone(params, BASE_KEYS[base_index])
+            # Save frequencies for all the keys made from this voice's tones.
+            self.frequencies[voice_index] = self.key_frequency(np.arange(const.NUM_KEYS), params)
+            # Swap the new tone into the voices list, labelled with the key of the settings it was made from.
+            self.voices[voice_index][base_index] = (tone_key, tone)
+            return tone
+
+    # Make the tone for any key by resampling the base tone above it.
+    def make_tone(self, voice_index, key):
+        self._debug_2("In make_tone() ")
+        base_index = BASE_INDEX_OF_KEY[key]
+        with self.tone_lock:
+            entry = self.voices[voice_index][base_index]
+            # Check if the base tone needs to be regenerated
+            if entry is None or entry[0] != self.tone_params[voice_index].tone_key():
+                base_tone = self.make_base_tone(voice_index, base_index)
+            else:
+                base_tone = entry[1]
+            base_key = BASE_KEYS[base_index]
+            ratio = self.frequencies[voice_index, key] / self.frequencies[voice_index, base_key]
+        if key == base_key:
+            return base_tone
+        return synth_pitch.resample(base_tone, ratio)
+
+    # Frequency, in Hz, of the tone for a key, in the tuning of the given voice parameters.
+    def key_frequency(self, key, params=None, pitch_bend=0.0):
+        tuning = "Equal" if params is None else params.tuning
+        return synth_pitch.key_frequency(key, tuning, pitch_bend)
+
+    # Calculate a constant-volume sound wave for the given voice parameters and key.
+    # This depends only on its inputs, so it is safe to call from any thread.
+    def render_tone(self, params, key, pitch_bend=0.0):
+        self._debug_2("In render_tone() ")
+        return self.render_frequency(params, self.key_frequency(key, params, pitch_bend))
+
+    # Calculate a constant-volume sound wave for the given voice parameters at any frequency (Hz).
+    def render_frequency(self, params, centre_frequency):
+        waveform = params.waveform
+        width = params.width
+        unison_voices = params.unison_voices
+        unison_detune = params.unison_detune
         gain_adjustment = 1.0 / unison_voices
+        # Boosted harmonics are part of the waveform, so each unison voice is boosted at its own frequency.
+        harmonic_boost = params.harmonic_boost if const.HARMONIC_BOOST_ENABLED else 0
         if const.UNISON_ENABLED and waveform in ["Sawtooth", "Square"] and unison_voices > 1 and unison_detune > 0:
-            frequency_step = int((centre_frequency * unison_detune * const.UNISON_SCALE_FACTOR / (100 * (unison_voices - 1))) + 0.5)
-            start_frequency = int((centre_frequency - (0.5 * frequency_step * unison_voices)) + 0.5)
+            frequency_step = centre_frequency * unison_detune * const.UNISON_SCALE_FACTOR / (100 * (unison_voices - 1))
+            start_frequency = centre_frequency - (0.5 * frequency_step * unison_voices)
             # Make an array of zeros for the separate voices to be added into.
-            tone = np.zeros(((int(const.SAMPLE_RATE * const.MAX_ENVELOPE_TIME / 1000))), dtype=float)
+            tone = np.zeros(self._tone_length(), dtype=float)
             for i in range(unison_voices):
-                frequency = int(start_frequency + (i * frequency_step))
-                if waveform == "Sawtooth":
-                    unison_tone = self._pwm_sawtooth_wave(frequency, width)
-                elif waveform == "Square":
-                    unison_tone = self._pwm_square_wave(frequency, width)
-                else:
-                    self._debug_1("ERROR: invalid waveform in make_tone() = " + str(waveform))
-                tone += gain_adjustment * unison_tone
+                frequency = start_frequency + (i * frequency_step)
+                tone += gain_adjustment * self._wave(waveform, frequency, width, harmonic_boost)
         else:
             frequency = centre_frequency
-            if waveform == "Sine":
-                tone = self._sine_wave(frequency)
-            elif waveform == "Triangle":
-                tone = self._triangle_wave(frequency)
-            elif waveform == "Sawtooth":
-                tone = self._pwm_sawtooth_wave(frequency, width)
-            elif waveform == "Square":
-                tone = self._pwm_square_wave(frequency, width)
+            if waveform == "Additive":
+                tone = self._additive_wave(frequency, params.harmonic_levels, params.harmonic_phases)
             else:
-                self._debug_1("ERROR: invalid waveform in make_tone() = " + str(waveform))            
-            
-        # If boosting harmonics, suppress the tone fundamental frequency.
-        if const.HARMONIC_BOOST_ENABLED:
-            harmonic_boost = self.controller.voice_params[self.controller.voice_index].harmonic_boost 
-            if waveform != "Sine" and harmonic_boost > 0:
-                tone = self._suppress_fundamental(tone, frequency)
+                tone = self._wave(waveform, frequency, width, harmonic_boost)
 
         # Multiply tone by a sine wave proportional to the base tone frequency
         if const.RING_MODULATION_ENABLED:
-            ring_mod_rate = self.controller.voice_params[self.controller.voice_index].ring_mod_rate
-            if ring_mod_rate > 0:
-                tone = self._apply_ring_modulation(tone, frequency, ring_mod_rate)
+            if params.ring_mod_rate > 0:
+                tone = self._apply_ring_modulation(tone, frequency, params.ring_mod_rate)
         
-        # Save frequency for this tone
-        self.frequencies[voice_index, key] = centre_frequency
-        # Save tone in voices array    
-        self.voices[voice_index, key] = tone
+        return tone
             
-    # Fetch a constant volume sound wave from the 'voices' array of pre-calculated waveforms.
-    # Also return the fundamental frequency.
+    # Fetch a constant volume sound wave, made from the 'voices' array of pre-calculated base tones.
+    # Also return the fundamental frequency. If the pitch is bent, the tone is rendered on demand instead.
     def fetch_tone(self, voice_index, key):
         self._debug_2("In fetch_tone()")
         if voice_index >= const.MAX_VOICES:
@@ -355,12 +641,15 @@ class Model:
         if key >= const.NUM_KEYS:
             self._debug_1("ERROR: invalid key number in fetch_tone() = " + str(key))
             return None
-        tone = self.voices[voice_index, key]
-        # Check if tone needs to be regenerated
-        if tone[0] < -2:
-            self.make_tone(voice_index, key)
-            tone = self.voices[voice_index, key]            
-        frequency = self.frequencies[voice_index, key]
+        pitch_bend = self.pitch_bend
+        if pitch_bend != 0.0:
+            params = self.tone_params[voice_index]
+            frequency = self.key_frequency(key, params, pitch_bend)
+            return self.render_frequency(params, frequency), frequency
+        # The tone and its frequency must come from the same settings, even if another thread is swapping them.
+        with self.tone_lock:
+            tone = self.make_tone(voice_index, key)
+            frequency = self.frequencies[voice_index, key]
         return tone, frequency       
                 
     def _debug_1(self, message):
@@ -373,6 +662,91 @@ class Model:
         if debug_level >= 2:
             print("synth_model.py: " + message)
 
+######################### Module functions #########################
+
+# Waveforms as functions of the oscillator phase, in cycles.
+def _triangle(phase):
+    return abs(((4 * phase + 3) % 4.0) - 2) - 1
+
+# Linear ramp for the sawtooth and square waves, in half cycles, offset by the pulse width.
+def _pwm_ramp(phase, width):
+    return (2 * phase) + 2.0 - width/100
+
+def _pwm_sawtooth(phase, width):
+    ramp = _pwm_ramp(phase, width)
+    return np.clip((100/width) * ((ramp % 2.0) + width/100 - 2.0), -1.0, 1.0)
+
+def _pwm_square(phase, width):
+    ramp = _pwm_ramp(phase, width)
+    # Generate a square wave, clip sine to avoid using scipy library.
+    return np.clip(1000 * ((ramp % 2.0) + (width/100) - 2.0), -1.0, 1.0)
+
+# One cycle of a waveform with its fundamental suppressed, normalised to a peak of 1 to boost the harmonics.
+# The cycle has WAVETABLE_SIZE samples, and the first sample again at the end for interpolation.
+# Each harmonic is reduced as by a bandpass filter (Q = 2) tuned to the fundamental, i.e. by
+# harmonic_boost % of the filter's response 1 / (1 + jQ(k - 1/k)) at harmonic k. This is the filter's steady
+# state, worked out once in the frequency domain, so there is no settling time at the start of a tone.
+# Tables are kept for re-use, as they only depend on the waveform, width and boost.
+@functools.lru_cache(maxsize=64)
+def harmonic_table(waveform, width, harmonic_boost):
+    phase = np.arange(const.WAVETABLE_SIZE) / const.WAVETABLE_SIZE
+    if waveform == "Triangle":
+        cycle = _triangle(phase)
+    elif waveform == "Sawtooth":
+        cycle = _pwm_sawtooth(phase, width)
+    else:
+        cycle = _pwm_square(phase, width)
+    harmonics = np.arange(1, const.WAVETABLE_SIZE // 2 + 1)
+    response = np.zeros(len(harmonics) + 1, dtype=complex) # The filter blocks DC.
+    response[1:] = 1 / (1 + 1j * BOOST_Q_FACTOR * (harmonics - 1 / harmonics))
+    spectrum = np.fft.rfft(cycle) * (1 - (harmonic_boost / 100) * response)
+    boosted = np.fft.irfft(spectrum, const.WAVETABLE_SIZE)
+    table = np.append(boosted, boosted[0]) / np.max(boosted)
+    table.flags.writeable = False
+    return table
+
+
+# Render job run in a worker process by Model.render_voices().
+# Makes base tones first_base to last_base - 1 of one voice, and writes them into its row of the shared tone bank.
+def _render_tone_job(job):
+    bank_name, bank_shape, row, first_base, last_base, params, sample_rate, max_duration = job
+    bank_memory = shared_memory.SharedMemory(name=bank_name)
+    try:
+        bank = np.ndarray(bank_shape, dtype=float, buffer=bank_memory.buf)
+        model = Model(None, sample_rate, max_duration)
+        for base_index in range(first_base, last_base):
+            bank[row, base_index] = model.render_tone(params, BASE_KEYS[base_index])
+        del bank
+    finally:
+        bank_memory.close()
+    return row, first_base
+
+# Wavetables of a harmonic series, one for each number of harmonics kept, from the fundamental alone up to all of
+# them, so each key can use the table with only the harmonics it can play without aliasing.
+# harmonic_levels = level of each harmonic in %, harmonic_phases = phase of each harmonic in degrees (0 if missing).
+# Harmonic k is level * sin(2 pi k phase + harmonic phase). All the tables are made with one inverse FFT, of a
+# stack of spectra, and all are scaled by the same factor so that the loudest peak is 1, so the keys of a voice
+# match in level. Each table has the first sample again at the end for interpolation.
+# Tables are kept for re-use, as they only depend on the harmonics (not on the key, tuning or pitch bend).
+@functools.lru_cache(maxsize=16)
+def additive_tables(harmonic_levels, harmonic_phases=()):
+    num_harmonics = max(1, min(len(harmonic_levels), const.MAX_HARMONICS))
+    levels = np.zeros(num_harmonics)
+    phases = np.zeros(num_harmonics)
+    levels[:len(harmonic_levels[:num_harmonics])] = np.array(harmonic_levels[:num_harmonics]) / 100
+    phases[:len(harmonic_phases[:num_harmonics])] = np.radians(harmonic_phases[:num_harmonics])
+    # Row n - 1 of the stack holds the first n harmonics. Multiplying by -j makes each harmonic a sine.
+    spectra = np.zeros((num_harmonics, const.WAVETABLE_SIZE // 2 + 1), dtype=complex)
+    spectra[:, 1:num_harmonics + 1] = np.tril(np.broadcast_to(-1j * levels * np.exp(1j * phases),
+                                                              (num_harmonics, num_harmonics)))
+    tables = np.fft.irfft(spectra, const.WAVETABLE_SIZE, axis=1)
+    peak = np.max(np.abs(tables))
+    if peak > 0:
+        tables /= peak
+    tables = np.concatenate((tables, tables[:, :1]), axis=1)
+    tables.flags.writeable = False
+    return tables
+
 #------------------------- Module Test Funcctions -------------------------
 if __name__ == "__main__":
 
@@ -385,9 +759,6 @@ if __name__ == "__main__":
     STEREO = True
     
     MAX_VOICES = 12
-    NUM_OCTAVES = 3
-    NUM_KEYS = (12 * NUM_OCTAVES) + 1
-    LOWEST_TONE = 110
     
     DEFAULT_FREQUENCY = 440
     DEFAULT_ATTACK = 20
@@ -405,6 +776,12 @@ if __name__ == "__main__":
             self.harmonic_boost = 0
             self.vibrato_rate = 0
             self.vibrato_depth = 0
+            self.unison_voices = 1
+            self.unison_detune = 0
+            self.ring_mod_rate = 0
+            self.tuning = "Equal"
+            self.harmonic_levels = const.DEFAULT_HARMONIC_LEVELS
+            self.harmonic_phases = ()
             self.tremolo_rate = 0
             self.tremolo_depth = 0
             self.attack = DEFAULT_ATTACK
@@ -412,13 +789,21 @@ if __name__ == "__main__":
             self.sustain_time = DEFAULT_SUSTAIN
             self.sustain_level = DEFAULT_SUSTAIN_LEVEL
             self.release = DEFAULT_RELEASE
+            self.filter_type = "None"
+            self.filter_cutoff = const.DEFAULT_FILTER_CUTOFF
+            self.filter_resonance = const.DEFAULT_FILTER_RESONANCE
+            self.filter_env_depth = 0
+            self.delay_time = 0
+            self.delay_feedback = 0
+            self.chorus_depth = 0
+            self.reverb_level = 0
         
     class TestController:
         def __init__(self):
             self.sample_rate = SAMPLE_RATE
             self.frequency = DEFAULT_FREQUENCY
             self.num_voices = 1
-            self.voices = []
+            self.voice_params = []
             self.voice_index = 0
             self.model = Model(self, SAMPLE_RATE)
         
@@ -426,8 +811,8 @@ if __name__ == "__main__":
             self.model._debug_2("In main of test controller")
             for voice_index in range(MAX_VOICES):
                 voice_params = Voice_Parameters()
-                self.voices.append(voice_params)
-            self.model.main()
+                self.voice_params.append(voice_params)
+            self.model.main(self.num_voices)
 
           
     debug_level = 2       
@@ -446,6 +831,7 @@ if __name__ == "__main__":
     
     model.duration = DURATION
     width = 50
+    snapshot = Voice_Snapshot.from_params(voice_params)
     sine_tone = model._sine_wave(FREQUENCY)
     triangle_tone = model._triangle_wave(FREQUENCY)
     sawtooth_tone = model._pwm_sawtooth_wave(FREQUENCY, width)
@@ -454,6 +840,40 @@ if __name__ == "__main__":
     finish = time.perf_counter()
     model._debug_1("No of samples / tone = " +str(len(sine_tone)))
     model._debug_1("Calculation of 4 tones in seconds = " + str(finish - start))
+
+    # Boosted tones are read from a single cycle table, so cost about the same as plain ones.
+    boosted_tone = model._boosted_wave("Sawtooth", FREQUENCY, width, 80)
+    start = time.perf_counter()
+    boosted_tone = model._boosted_wave("Sawtooth", FREQUENCY, width, 80)
+    finish = time.perf_counter()
+    cycles = int(FREQUENCY * len(boosted_tone) / SAMPLE_RATE)
+    period = int(cycles * SAMPLE_RATE / FREQUENCY)
+    plain_spectrum = np.abs(np.fft.rfft(sawtooth_tone[:period]))
+    boosted_spectrum = np.abs(np.fft.rfft(boosted_tone[:period]))
+    model._debug_1("Boosted sawtooth in seconds = " + str(finish - start) + ", fundamental / 2nd harmonic plain = "
+                   + str(plain_spectrum[cycles] / plain_spectrum[2 * cycles]) + ", boosted = "
+                   + str(boosted_spectrum[cycles] / boosted_spectrum[2 * cycles]) + ", first sample = "
+                   + str(boosted_tone[0]) + ", peak = " + str(np.max(boosted_tone)))
+
+    # Additive tones match a sum of sines, and keep only the harmonics below the Nyquist frequency.
+    levels = (100, 0, 33, 0, 20, 0, 14)
+    phases = (0, 0, 90)
+    start = time.perf_counter()
+    additive_tables(levels, phases)
+    finish = time.perf_counter()
+    model._debug_1("Additive wavetables in seconds = " + str(finish - start))
+    for key_frequency in [FREQUENCY, SAMPLE_RATE / 7]:
+        start = time.perf_counter()
+        additive_tone = model._additive_wave(key_frequency, levels, phases)
+        finish = time.perf_counter()
+        phase = model._oscillator_phase(key_frequency)
+        expected = np.zeros(len(phase))
+        for k in range(1, min(len(levels), int(0.5 * SAMPLE_RATE / key_frequency)) + 1):
+            harmonic_phase = np.radians(phases[k - 1]) if k <= len(phases) else 0.0
+            expected += (levels[k - 1] / 100) * np.sin(2 * np.pi * k * phase + harmonic_phase)
+        scale = np.dot(additive_tone, expected) / np.dot(additive_tone, additive_tone)
+        model._debug_1("Additive tone at " + str(key_frequency) + " Hz in seconds = " + str(finish - start)
+                       + ", largest difference from sum of sines = " + str(np.max(np.abs(scale * additive_tone - expected))))
     
     model._debug_1("\nCalculating envelope waveform.")
     
@@ -464,6 +884,15 @@ if __name__ == "__main__":
     finish = time.perf_counter()
     
     model._debug_1("Envelope calculation in seconds = " + str(finish - start))
+
+    # A second voice with the same settings shares the first voice's envelope, without remaking it.
+    model.voice_params[1] = model.voice_params[0]
+    start = time.perf_counter()
+    model.make_envelope(1)
+    finish = time.perf_counter()
+    model._debug_1("Envelope from the bank in seconds = " + str(finish - start) + ", shared = "
+                   + str(model.envelopes[1] is model.envelopes[0]) + ", bank hits, misses = "
+                   + str((model.envelope_bank.hits, model.envelope_bank.misses)))
            
     model._debug_1("\nDoing mono amplitude modulation")
     
@@ -478,6 +907,17 @@ if __name__ == "__main__":
     finish = time.perf_counter()
     
     model._debug_1("Modulation in mono and stereo in seconds = " + str(finish - start))
+
+    # Vibrato is applied as the note is made, so changing it leaves the tone as it was.
+    old_snapshot = model.voice_params[0]
+    model.voice_params[0] = Voice_Snapshot(vibrato_rate=50, vibrato_depth=20)
+    start = time.perf_counter()
+    vibrato_note = model.apply_envelope(0, sine_tone, False, FREQUENCY)
+    finish = time.perf_counter()
+    model._debug_1("Note with vibrato in seconds = " + str(finish - start) + ", tone settings unchanged = "
+                   + str(model.voice_params[0].tone_settings() == old_snapshot.tone_settings())
+                   + ", largest difference from the plain note = " + str(np.max(np.abs(vibrato_note - sine_note_1))))
+    model.voice_params[0] = old_snapshot
     
     model._debug_1("\nDoing make_voice()")
     
@@ -487,6 +927,24 @@ if __name__ == "__main__":
     
     model._debug_1("Make 1 voice in seconds = " + str(finish - start))
     
+    model._debug_1("\nFetching a key resampled from its base tone")
+    
+    start = time.perf_counter()
+    tone, frequency = model.fetch_tone(0, const.DEFAULT_KEY + 1)
+    finish = time.perf_counter()
+    
+    model._debug_1("Resampled tone at " + str(frequency) + " Hz in seconds = " + str(finish - start))
+    
+    model._debug_1("\nMaking a note with pitch bend")
+    
+    model.set_pitch_bend(0.5)
+    start = time.perf_counter()
+    tone, frequency = model.fetch_tone(0, 12)
+    finish = time.perf_counter()
+    model.set_pitch_bend(0.0)
+    
+    model._debug_1("Bent tone at " + str(frequency) + " Hz in seconds = " + str(finish - start))
+    
 #---------------------------- References and Acknowledgements --------------------------------
 #
 # The Fourier Series by Erik Cheever of Swathmore College. https://lpsa.swarthmore.edu/Fourier/Series/WhyFS.html
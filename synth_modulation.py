@@ -0,0 +1,173 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+# Modulation destinations, i.e. what an LFO can change.
+AMPLITUDE = 0 # gain of the voice, in octaves of level (as the envelope levels before the exponential function)
+PITCH = 1 # pitch of the voice's notes, in cents
+DESTINATIONS = ["Amplitude", "Pitch"]
+
+# ------------------------------
+#  Notes:
+#
+#  1. Each voice has one low frequency oscillator (LFO) for each modulation destination. The LFOs are
+#     routed from the voice parameters by voice_routes(): tremolo to AMPLITUDE and vibrato to PITCH.
+#  2. The LFO rates, depths and phases are kept in arrays indexed [destination, voice]. The LFOs are moved
+#     on once per block, and their outputs for a block are made for all the modulated voices at once.
+#  3. The LFOs run all the time, whether or not a voice is playing, so the modulation is not tied to the
+#     start of each note. All the notes of a voice share its LFOs, so amplitude modulation is applied to the
+#     voice's mix of notes, once per block, instead of to each note.
+#  4. The modulation is applied as the notes are mixed, so changing an LFO is just a change to the arrays.
+#     No envelope or tone has to be remade.
+#  5. Vibrato is phase modulation of the tone: the PITCH LFO changes how fast each note's tone is read, so the
+#     notes are read at the positions given by steps(), instead of one sample further on for each sample.
+#     The PITCH LFO is a sine, so the pitch swings evenly either side of the note's pitch, starting on it.
+# ------------------------------
+
+class Modulation_Matrix:
+    def __init__(self, num_voices=const.MAX_VOICES, sample_rate=const.SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.rates = np.zeros((len(DESTINATIONS), num_voices)) # Hz
+        self.depths = np.zeros((len(DESTINATIONS), num_voices))
+        self.phases = np.zeros((len(DESTINATIONS), num_voices)) # cycles, at the start of the next block
+
+    # Route a voice's LFOs from a snapshot of its parameters. The phases carry on, so there is no click.
+    def set_voice(self, voice_index, params):
+        self.rates[:, voice_index] = 0.0
+        self.depths[:, voice_index] = 0.0
+        for destination, rate, depth in voice_routes(params):
+            self.rates[destination, voice_index] = rate
+            self.depths[destination, voice_index] = depth
+
+    # Voices that have an LFO routed to a destination.
+    def modulated(self, destination):
+        return np.flatnonzero(self.depths[destination] > 0)
+
+    # LFO outputs for a destination over num_samples samples, starting start samples from now, indexed [voice, sample].
+    def values(self, destination, voices, num_samples, start=0):
+        cycles = (self.phases[destination, voices, np.newaxis]
+                  + self.rates[destination, voices, np.newaxis] * (start + np.arange(num_samples)) / self.sample_rate)
+        shape = np.sin if destination == PITCH else np.cos
+        return self.depths[destination, voices, np.newaxis] * shape(2 * np.pi * cycles)
+
+    # LFO phases of a destination, in cycles, start samples from now.
+    def phases_at(self, destination, voices, start=0):
+        return np.mod(self.phases[destination, voices] + self.rates[destination, voices] * start / self.sample_rate, 1.0)
+
+    # Gains of the given voices over the next num_samples samples, from their AMPLITUDE LFOs.
+    def gains(self, voices, num_samples):
+        return np.exp2(self.values(AMPLITUDE, voices, num_samples))
+
+    # Apply the AMPLITUDE LFOs to the next block of voice mixes, indexed [voice, sample], in place.
+    def apply_amplitude(self, voice_mixes):
+        voices = self.modulated(AMPLITUDE)
+        if len(voices) > 0:
+            voice_mixes[voices] *= self.gains(voices, voice_mixes.shape[1])
+
+    # Tone read positions of notes of the given voices over num_samples samples, starting start samples from now,
+    # from the voices' PITCH LFOs (see note 5). Indexed [note, sample], relative to where each note's tone is read
+    # from now, with num_samples + 1 positions, the last being where the next block starts.
+    def steps(self, voices, num_samples, start=0):
+        voices, rows = np.unique(voices, return_inverse=True)
+        steps = np.zeros((len(voices), num_samples + 1))
+        np.cumsum(np.exp2(self.values(PITCH, voices, num_samples, start) / 1200), axis=1, out=steps[:, 1:])
+        return steps[rows]
+
+    # Move every LFO on by num_samples samples.
+    def advance(self, num_samples):
+        self.phases = np.mod(self.phases + self.rates * num_samples / self.sample_rate, 1.0)
+
+
+# The LFOs set by a voice's parameters, as (destination, rate in Hz, depth) routes.
+def voice_routes(params):
+    routes = []
+    if params.tremolo_depth > 0:
+        routes.append((AMPLITUDE, params.tremolo_rate, params.tremolo_depth / 100))
+    # Without a rate the LFO stands still, so it would only hold the pitch off the note.
+    if const.VIBRATO_ENABLED and params.vibrato_depth > 0 and params.vibrato_rate > 0:
+        routes.append((PITCH, const.VIBRATO_TOP_RATE * params.vibrato_rate / 100,
+                       const.VIBRATO_TOP_DEPTH * params.vibrato_depth / 100))
+    return routes
+
+# True if a voice's parameters route an LFO to the destination, so its notes sound different depending on when
+# they start.
+def is_modulated(params, destination):
+    return any(route[0] == destination for route in voice_routes(params))
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_modulation.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_modulation.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import time
+
+    class Test_Params:
+        tremolo_rate = 7
+        tremolo_depth = 10
+        vibrato_rate = 50
+        vibrato_depth = 20
+
+    # Gains made block by block must follow one continuous LFO.
+    matrix = Modulation_Matrix()
+    for vi in range(0, const.MAX_VOICES, 2):
+        matrix.set_voice(vi, Test_Params)
+    voices = matrix.modulated(AMPLITUDE)
+    num_blocks = 100
+    start = time.perf_counter()
+    blocks = []
+    for i in range(num_blocks):
+        blocks.append(matrix.gains(voices, const.MIX_BLOCK_SIZE))
+        matrix.advance(const.MIX_BLOCK_SIZE)
+    finish = time.perf_counter()
+    gains = np.concatenate(blocks, axis=1)
+    times = np.arange(gains.shape[1]) / const.SAMPLE_RATE
+    expected = np.exp2(0.1 * np.cos(2 * np.pi * Test_Params.tremolo_rate * times))
+    _debug_1("Modulated voices = " + str(voices) + ", max difference from one LFO = "
+             + str(np.max(np.abs(gains - expected))) + ", milliseconds per block = "
+             + str(1000 * (finish - start) / num_blocks))
+
+    # Changing the rate carries on from the same phase.
+    phase = matrix.phases[AMPLITUDE, 0]
+    Test_Params.tremolo_rate = 3
+    matrix.set_voice(0, Test_Params)
+    _debug_1("Phase kept after a rate change = " + str(matrix.phases[AMPLITUDE, 0] == phase))
+
+    # Vibrato steps made block by block must join up, and average one sample per sample.
+    steps = []
+    position = 0.0
+    for i in range(num_blocks):
+        block_steps = matrix.steps([0, 0, 1], const.MIX_BLOCK_SIZE)
+        steps.append(position + block_steps[0, :-1])
+        position += block_steps[0, -1]
+        matrix.advance(const.MIX_BLOCK_SIZE)
+    steps = np.concatenate(steps)
+    rate = const.VIBRATO_TOP_RATE * Test_Params.vibrato_rate / 100
+    cents = 1200 * np.log2(np.diff(steps))
+    _debug_1("Vibrato: rate Hz = " + str(rate) + ", cents (min, max) = " + str((float(np.min(cents)), float(np.max(cents))))
+             + ", unmodulated voice steps = " + str(block_steps[2, :4]) + ", mean step = "
+             + str(steps[-1] / (len(steps) - 1)))
+
+    # A vibrato rate of 0 routes no PITCH LFO, so the notes are read one sample on for each sample.
+    Test_Params.vibrato_rate = 0
+    matrix.set_voice(0, Test_Params)
+    steps = matrix.steps([0], const.MIX_BLOCK_SIZE)
+    assert np.all(np.diff(steps[0]) == 1.0), "vibrato rate 0 changed the pitch"
+    _debug_1("Vibrato rate 0: PITCH voices = " + str(matrix.modulated(PITCH)) + ", steps all 1.0 = "
+             + str(bool(np.all(np.diff(steps[0]) == 1.0))))
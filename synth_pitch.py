@@ -0,0 +1,113 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+# Tuning tables: the pitch of each key in a repeating group of keys, in cents above the first key of the group,
+# and the pitch interval (cents) from one group to the next. Most tables cover the 12 keys of an octave.
+TUNINGS = {
+    "Equal": ([0, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 1100], 1200),
+    "Just": ([0, 111.73, 203.91, 315.64, 386.31, 498.04, 590.22, 701.96, 813.69, 884.36, 1017.60, 1088.27], 1200),
+    "Pythagorean": ([0, 90.22, 203.91, 294.13, 407.82, 498.04, 611.73, 701.96, 792.18, 905.87, 996.09, 1109.78], 1200),
+    "Meantone": ([0, 76.05, 193.16, 310.26, 386.31, 503.42, 579.47, 696.58, 772.63, 889.74, 1006.84, 1082.89], 1200),
+    # Microtonal: every key is a quarter tone above the one before, so 24 keys span an octave.
+    "Quarter tone": ([0, 50, 100, 150, 200, 250, 300, 350, 400, 450, 500, 550], 600),
+}
+TUNING_NAMES = list(TUNINGS.keys())
+
+# ------------------------------
+#  Notes:
+#
+#  1. Frequencies are floating point numbers, in Hz. Pitch bend is in semitones (which may be fractional).
+#  2. Oscillators are driven by a phase accumulator, which adds frequency / sample_rate to the phase (in cycles)
+#     for each sample. Any frequency can be played this way, and the frequency can change from sample to sample.
+# ------------------------------
+
+# Frequency (Hz) of a key, or of an array of keys, in the given tuning, raised by pitch_bend semitones.
+# Key 0 is the lowest keyboard tone (LOWEST_TONE).
+def key_frequency(key, tuning="Equal", pitch_bend=0.0):
+    if not tuning in TUNINGS:
+        _debug_1("ERROR: unknown tuning = " + str(tuning))
+        tuning = "Equal"
+    table, period = TUNINGS[tuning]
+    group, degree = np.divmod(np.asarray(key), len(table))
+    cents = (group * period) + np.asarray(table, dtype=float)[degree] + (100.0 * pitch_bend)
+    frequency = const.LOWEST_TONE * np.power(2.0, cents / 1200)
+    return float(frequency) if np.ndim(frequency) == 0 else frequency
+
+# True for each key (in an array of keys) that is a black key on the keyboard.
+def is_black_key(keys):
+    return np.isin((np.asarray(keys) + const.LOWEST_KEY_NOTE) % 12, [1, 3, 6, 8, 10])
+
+# True for each key that is a C, i.e. the first key of an octave.
+def is_octave_key(keys):
+    return (np.asarray(keys) + const.LOWEST_KEY_NOTE) % 12 == 0
+
+# Resample a tone to play it ratio times faster (ratio <= 1 lowers the pitch), keeping num_samples samples.
+# Cubic (Catmull-Rom) interpolation between the four nearest samples. Lowering the pitch moves every
+# harmonic down, so no new aliasing is made.
+def resample(tone, ratio, num_samples=None):
+    if num_samples is None:
+        num_samples = len(tone)
+    positions = ratio * np.arange(num_samples)
+    whole = np.floor(positions).astype(np.int64)
+    t = positions - whole
+    last = len(tone) - 1
+    p0 = tone[np.clip(whole - 1, 0, last)]
+    p1 = tone[np.clip(whole, 0, last)]
+    p2 = tone[np.clip(whole + 1, 0, last)]
+    p3 = tone[np.clip(whole + 2, 0, last)]
+    return p1 + 0.5 * t * ((p2 - p0) + t * ((2 * p0 - 5 * p1 + 4 * p2 - p3) + t * (3 * (p1 - p2) + p3 - p0)))
+
+# Phase accumulator. Returns the phase, in cycles, of an oscillator for each of num_samples samples.
+# frequency = frequency in Hz, either a number or an array with (at least) one value per sample.
+def phase_accumulator(frequency, num_samples, sample_rate=const.SAMPLE_RATE, start_phase=0.0):
+    if np.ndim(frequency) == 0:
+        # Constant frequency: the accumulated phase is a straight line, calculated directly to avoid rounding errors.
+        return start_phase + (frequency / sample_rate) * np.arange(num_samples)
+    increments = np.asarray(frequency[:num_samples], dtype=float) / sample_rate
+    phase = np.empty(num_samples)
+    phase[0] = start_phase
+    np.cumsum(increments[:-1], out=phase[1:])
+    phase[1:] += start_phase
+    return phase
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_pitch.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_pitch.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+
+    keys = np.arange(const.NUM_KEYS)
+    _debug_1("Black keys in the first octave: " + str(keys[:12][is_black_key(keys[:12])]))
+    for tuning in TUNING_NAMES:
+        frequencies = key_frequency(keys, tuning)
+        _debug_1(tuning + ": key 12 = " + str(frequencies[12]) + " Hz, key 7 = " + str(frequencies[7]) + " Hz")
+    _debug_1("Key 9 bent up 0.5 semitones = " + str(key_frequency(9, "Equal", 0.5)) + " Hz")
+
+    # A gliding phase must end where the sum of its frequencies says.
+    glide = np.linspace(110, 220, 44100)
+    phase = phase_accumulator(glide, len(glide))
+    _debug_1("Glide phase error, cycles = " + str(phase[-1] + glide[-1] / 44100 - np.sum(glide) / 44100))
+
+    # Resampling a sine wave down by a semitone should match a sine wave made at the lower pitch.
+    base = np.sin(2 * np.pi * phase_accumulator(440.0, 26460))
+    resampled = resample(base, np.power(2.0, -1 / 12))
+    direct = np.sin(2 * np.pi * phase_accumulator(440.0 * np.power(2.0, -1 / 12), 26460))
+    _debug_1("Resampled sine max error = " + str(np.max(np.abs(resampled - direct))))
@@ -0,0 +1,142 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+STEAL_POLICIES = ["Oldest", "Quietest", "Same key"]
+FREE = -1 # Voice index of an unused slot.
+
+# ------------------------------
+#  Notes:
+#
+#  1. The mixer plays notes in a fixed pool of note slots, shared by all the voices. The pool is made once,
+#     so the number of notes being mixed, and the time taken to mix a block, can't grow without limit.
+#  2. The state of each slot (voice, key, start order and level) is kept in numpy arrays, one element per slot,
+#     so free slots and notes to steal are found with array operations.
+#  3. When all the slots (up to the polyphony limit) are in use, a new note takes the slot of another note:
+#     "Oldest" = the note that started first, "Quietest" = the note with the lowest level in the last block,
+#     "Same key" = a note of the same voice and key, if there is one, otherwise the oldest. With "Same key",
+#     a repeated key always takes over its previous slot, even when there are free slots.
+#  4. The mixer fades out a stolen note over one block, so it doesn't stop with a click.
+# ------------------------------
+
+class Note_Allocator:
+    def __init__(self, num_slots=const.MAX_POLYPHONY, policy=const.STEAL_POLICY):
+        self.num_slots = num_slots
+        self.polyphony = num_slots
+        self.policy = policy
+        self.notes = [None] * num_slots
+        self.voices = np.full(num_slots, FREE, dtype=np.int16)
+        self.keys = np.full(num_slots, -1, dtype=np.int16)
+        self.start_order = np.zeros(num_slots, dtype=np.int64)
+        self.levels = np.zeros(num_slots)
+        self.num_started = 0
+        self.num_stolen = 0
+
+    # Limit the number of slots used for new notes. Notes already playing in higher slots carry on.
+    def set_polyphony(self, polyphony, policy=None):
+        self.polyphony = max(1, min(int(polyphony), self.num_slots))
+        if not policy is None:
+            if policy in STEAL_POLICIES:
+                self.policy = policy
+            else:
+                _debug_1("ERROR: unknown note stealing policy: " + str(policy))
+
+    # Put a note in a slot. Returns the slot, and the voice index and note that it replaced (or None, None).
+    def allocate(self, voice_index, note):
+        key = -1 if note.key is None else note.key
+        slot = -1
+        if self.policy == "Same key" and key >= 0:
+            slot = self._oldest(np.flatnonzero((self.voices == voice_index) & (self.keys == key)))
+        if slot < 0:
+            free = np.flatnonzero(self.voices[:self.polyphony] == FREE)
+            if len(free) > 0:
+                slot = int(free[0])
+        if slot < 0:
+            slot = self._choose_victim()
+        stolen_voice = None if self.voices[slot] == FREE else int(self.voices[slot])
+        stolen = self.notes[slot]
+        if not stolen is None:
+            self.num_stolen += 1
+            _debug_2("Note stolen from slot " + str(slot))
+        self.notes[slot] = note
+        self.voices[slot] = voice_index
+        self.keys[slot] = key
+        self.start_order[slot] = self.num_started
+        self.levels[slot] = np.inf # not mixed yet, so not the quietest
+        self.num_started += 1
+        return slot, stolen_voice, stolen
+
+    def release(self, slot):
+        self.notes[slot] = None
+        self.voices[slot] = FREE
+        self.keys[slot] = -1
+        self.levels[slot] = 0.0
+
+    def active_slots(self):
+        return np.flatnonzero(self.voices != FREE)
+
+    # Slots playing the given key of a voice.
+    def key_slots(self, voice_index, key):
+        return np.flatnonzero((self.voices == voice_index) & (self.keys == key))
+
+    def num_active(self, voice_index=None):
+        if voice_index is None:
+            return int(np.count_nonzero(self.voices != FREE))
+        return int(np.count_nonzero(self.voices == voice_index))
+
+    # All the slots up to the polyphony limit are in use, so pick a note to replace.
+    def _choose_victim(self):
+        if self.policy == "Quietest":
+            return int(np.argmin(self.levels[:self.polyphony]))
+        return self._oldest(np.arange(self.polyphony))
+
+    def _oldest(self, slots):
+        if len(slots) == 0:
+            return -1
+        return int(slots[np.argmin(self.start_order[slots])])
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_polyphony.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_polyphony.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+
+    class Test_Note:
+        def __init__(self, key):
+            self.key = key
+
+    for policy in STEAL_POLICIES:
+        allocator = Note_Allocator(8, policy)
+        # The quietest note is the one in slot 5.
+        for key in range(8):
+            allocator.allocate(0, Test_Note(key))
+        allocator.levels[:] = 1.0
+        allocator.levels[5] = 0.1
+        slot, stolen_voice, stolen = allocator.allocate(0, Test_Note(20))
+        same_slot, stolen_voice, same_stolen = allocator.allocate(0, Test_Note(3))
+        _debug_1(policy + ": new key took slot " + str(slot) + " from key " + str(stolen.key)
+                 + ", repeated key 3 took slot " + str(same_slot) + " from key " + str(same_stolen.key)
+                 + ", notes active = " + str(allocator.num_active()) + ", stolen = " + str(allocator.num_stolen))
+
+    # A polyphony limit below the number of slots.
+    allocator = Note_Allocator(8)
+    allocator.set_polyphony(2)
+    slots = [allocator.allocate(1, Test_Note(key))[0] for key in range(5)]
+    _debug_1("Polyphony 2: slots used = " + str(slots) + ", notes active = " + str(allocator.num_active(1)))
@@ -0,0 +1,289 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import numpy as np
+import synth_constants as const
+import synth_filter
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+NOT_RELEASED = np.iinfo(np.int64).max // 4 # Release start of a note that is still held.
+
+# ------------------------------
+#  Notes:
+#
+#  1. Note_Renderer plays gated notes (see synth_envelope.Gated_Note) in the mixer's note slots. The state
+#     of every note (tone phase and increment, envelope times and levels, and gain) is kept in arrays with
+#     one element per slot, and each block is made for all the notes at once, as a 2D array [note, sample].
+#  2. Each note's tone is copied into its slot's row of one tone table when the note starts, so the tones of
+#     all the notes are read with one gather. Tones are read at fractional phases with linear interpolation,
+#     and looped as in Gated_Note.
+#  3. The envelope stages are the closed forms of the recurrences in synth_envelope.Envelope_Generator, as
+#     functions of the time since the note-on, so the result matches Envelope_Generator. A note-off (or the
+#     end of the gate) fixes the release start time and the level the release falls from.
+#  4. The filter of a filtered note is recursive, so it is run note by note after the rest of the block.
+#  5. The tones can be read at positions given for each sample, e.g. for vibrato (see synth_modulation.py),
+#     instead of moving on by the note's playback rate every sample.
+# ------------------------------
+
+class Note_Renderer:
+    def __init__(self, num_slots=const.MAX_POLYPHONY):
+        self.num_slots = num_slots
+        self.tone_table = np.zeros((num_slots, 0))
+        # Oscillator
+        self.tone_lengths = np.ones(num_slots, dtype=np.int64)
+        self.loop_starts = np.zeros(num_slots, dtype=np.int64)
+        self.phases = np.zeros(num_slots)
+        self.increments = np.ones(num_slots)
+        self.gains = np.zeros(num_slots)
+        # Envelope, with times in samples since the note-on.
+        self.positions = np.zeros(num_slots, dtype=np.int64)
+        self.attack_ends = np.zeros(num_slots, dtype=np.int64)
+        self.decay_ends = np.zeros(num_slots, dtype=np.int64)
+        self.release_starts = np.full(num_slots, NOT_RELEASED, dtype=np.int64)
+        self.release_lengths = np.zeros(num_slots, dtype=np.int64)
+        self.log_attack = np.zeros(num_slots)
+        self.log_decay = np.zeros(num_slots)
+        self.log_release = np.zeros(num_slots)
+        self.attack_levels = np.zeros(num_slots) # level at the end of the attack
+        self.sustain_levels = np.zeros(num_slots)
+        self.release_levels = np.zeros(num_slots) # level the release falls from
+        self.release_floors = np.zeros(num_slots) # level the release stops falling at
+        # Filters
+        self.filters = [None] * num_slots
+        self.filter_cutoffs = np.zeros(num_slots)
+        self.filter_env_depths = np.zeros(num_slots)
+        self.peak_gains = np.ones(num_slots)
+
+    # Start playing a gated note, from its beginning, in a slot.
+    def start(self, slot, note):
+        tone_length = len(note.tone)
+        if tone_length > self.tone_table.shape[1]:
+            table = np.zeros((self.num_slots, tone_length))
+            table[:, :self.tone_table.shape[1]] = self.tone_table
+            self.tone_table = table
+        self.tone_table[slot, :tone_length] = note.tone
+        self.tone_lengths[slot] = tone_length
+        self.loop_starts[slot] = note.loop_start
+        self.phases[slot] = 0.0
+        self.increments[slot] = note.rate
+        self.gains[slot] = note.gain
+        envelope = note.envelope
+        self.positions[slot] = 0
+        self.attack_ends[slot] = envelope.attack_end
+        self.decay_ends[slot] = envelope.decay_end
+        self.release_lengths[slot] = envelope.release_length
+        self.log_attack[slot] = _log_ratio(envelope.attack_change)
+        self.log_decay[slot] = _log_ratio(envelope.decay_change)
+        self.log_release[slot] = _log_ratio(envelope.release_change)
+        self.attack_levels[slot] = 1.24 - 1.24 * np.exp(envelope.attack_end * self.log_attack[slot])
+        self.sustain_levels[slot] = envelope.sustain_level
+        self.release_starts[slot] = NOT_RELEASED
+        if not envelope.gate_length is None:
+            self._release(slot, envelope.gate_length)
+        self.filters[slot] = note.vcf
+        self.filter_cutoffs[slot] = note.filter_cutoff
+        self.filter_env_depths[slot] = note.filter_env_depth
+        self.peak_gains[slot] = envelope.peak_gain
+
+    # Release the note in a slot from the next sample.
+    def note_off(self, slot):
+        self._release(slot, self.positions[slot])
+
+    # Make the next num_samples samples of the notes in the given slots.
+    # steps = tone read positions of each note, in units of its playback rate, indexed [note, sample], as made by
+    # synth_modulation.Modulation_Matrix.steps(), or None to move on one step per sample.
+    # Returns the samples, indexed [note, sample], and which of the notes have finished.
+    def render(self, slots, num_samples, steps=None):
+        slots = np.asarray(slots)
+        samples = self._oscillator(slots, num_samples, steps)
+        env_gains = self._envelope(slots, num_samples)
+        output = samples * (self.gains[slots, np.newaxis] * env_gains)
+        for i, slot in enumerate(slots):
+            vcf = self.filters[slot]
+            if not vcf is None:
+                freq_control = synth_filter.envelope_freq_control(self.filter_cutoffs[slot], self.filter_env_depths[slot],
+                                                                  env_gains[i], self.peak_gains[slot])
+                output[i] = vcf.process(output[i], freq_control)
+        self.positions[slots] += num_samples
+        finished = self.positions[slots] >= self.release_starts[slots] + self.release_lengths[slots]
+        return output, finished
+
+    # Read each note's tone, with linear interpolation between samples, looping over the end of the tone.
+    def _oscillator(self, slots, num_samples, steps=None):
+        tone_lengths = self.tone_lengths[slots, np.newaxis]
+        loop_starts = self.loop_starts[slots, np.newaxis]
+        if steps is None:
+            steps = np.arange(num_samples + 1)
+        phases = self.phases[slots, np.newaxis] + self.increments[slots, np.newaxis] * steps
+        # Only the notes that reach the end of their tone in this block need wrapping.
+        rows = np.flatnonzero(phases[:, -1] >= tone_lengths[:, 0])
+        if len(rows) > 0:
+            row_phases = phases[rows]
+            row_loop_starts = loop_starts[rows]
+            phases[rows] = np.where(row_phases >= tone_lengths[rows],
+                                    row_loop_starts + np.mod(row_phases - row_loop_starts, tone_lengths[rows] - row_loop_starts),
+                                    row_phases)
+        self.phases[slots] = phases[:, -1]
+        phases = phases[:, :-1]
+        first = phases.astype(np.int64)
+        fraction = phases - first
+        after = np.where(first + 1 >= tone_lengths, loop_starts, first + 1)
+        rows = slots[:, np.newaxis] * self.tone_table.shape[1]
+        table = self.tone_table.reshape(-1)
+        return (1.0 - fraction) * table[rows + first] + fraction * table[rows + after]
+
+    # Envelope gains of each note, as in Envelope_Generator.process().
+    # Most notes spend most blocks in one stage, so each stage is only calculated for the notes that reach it.
+    def _envelope(self, slots, num_samples):
+        starts = self.positions[slots]
+        ends = starts + num_samples
+        times = starts[:, np.newaxis] + np.arange(num_samples)
+        levels = np.repeat(self.sustain_levels[slots, np.newaxis], num_samples, axis=1)
+        rows = np.flatnonzero(starts < self.decay_ends[slots])
+        if len(rows) > 0:
+            levels[rows] = self._held_levels(slots[rows, np.newaxis], times[rows])
+        rows = np.flatnonzero(ends > self.release_starts[slots])
+        if len(rows) > 0:
+            # level = (release_level + 0.1) * (1 - release_change) ** steps - 0.1, down to the release floor.
+            row_slots = slots[rows, np.newaxis]
+            release_starts = self.release_starts[row_slots]
+            steps = np.maximum(times[rows] - release_starts + 1, 0)
+            release = np.maximum((self.release_levels[row_slots] + 0.1) * np.exp(steps * self.log_release[row_slots])
+                                 - 0.1, self.release_floors[row_slots])
+            levels[rows] = np.where(times[rows] >= release_starts, release, levels[rows])
+        release_ends = self.release_starts[slots] + self.release_lengths[slots]
+        rows = np.flatnonzero(ends > release_ends)
+        if len(rows) > 0:
+            levels[rows] = np.where(times[rows] < release_ends[rows, np.newaxis], levels[rows], 0.0)
+        return np.exp2(np.maximum(levels, 0.0)) - 1
+
+    # Attack, decay and sustain levels at the given times (samples since the note-on).
+    def _held_levels(self, slots, times):
+        attack_ends = self.attack_ends[slots]
+        sustain_levels = self.sustain_levels[slots]
+        attack = 1.24 - 1.24 * np.exp((times + 1) * self.log_attack[slots])
+        floor = sustain_levels - 0.1
+        decay_steps = np.maximum(times - attack_ends + 1, 0)
+        decay = np.maximum(floor + (self.attack_levels[slots] - floor) * np.exp(decay_steps * self.log_decay[slots]),
+                           sustain_levels)
+        return np.where(times < attack_ends, attack, np.where(times < self.decay_ends[slots], decay, sustain_levels))
+
+    # Start the release of the note in a slot at the given time, unless it has already been released.
+    def _release(self, slot, release_start):
+        if release_start >= self.release_starts[slot]:
+            return
+        self.release_starts[slot] = release_start
+        if release_start <= 0:
+            level = 0.0
+        elif release_start >= self.decay_ends[slot]:
+            level = self.sustain_levels[slot]
+        else:
+            level = float(self._held_levels(slot, release_start - 1))
+        self.release_levels[slot] = level
+        # The release stops falling at the first step that takes it to zero or below.
+        if level <= 0:
+            self.release_floors[slot] = level
+        else:
+            first_step = max(1, int(np.ceil(np.log(0.1 / (level + 0.1)) / min(self.log_release[slot], -1e-12))))
+            self.release_floors[slot] = (level + 0.1) * np.exp(first_step * self.log_release[slot]) - 0.1
+
+
+# Natural log of (1 - change), the ratio between the distances from the target level of successive samples.
+def _log_ratio(change):
+    return np.log(max(1.0 - change, 1e-300))
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_renderer.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_renderer.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import time
+    import synth_envelope
+    import synth_modulation
+
+    class Test_Params:
+        attack = 20
+        decay = 30
+        sustain_level = 50
+        release = 40
+
+    rng = np.random.default_rng(1)
+    tone = np.sin(2 * np.pi * 220 * np.arange(30870) / const.SAMPLE_RATE)
+    loop = synth_envelope.loop_start(220, len(tone))
+
+    # Notes with a mixture of gates, note-offs, detuning, velocities and filters. The renderer must match
+    # each note played on its own by Gated_Note.
+    def make_notes():
+        notes = []
+        for i in range(8):
+            gate_length = [None, 3000, 20000][i % 3]
+            envelope = synth_envelope.Envelope_Generator(Test_Params, const.SAMPLE_RATE, gate_length)
+            vcf = synth_filter.Voltage_Controlled_Filter("Lowpass", 2) if i % 4 == 1 else None
+            notes.append(synth_envelope.Gated_Note(tone, loop, envelope, i, vcf, 50, 50, rate=[1.0, 1.01][i % 2],
+                                                   gain=(i + 1) / 8))
+        return notes
+
+    class Test_Vibrato_Params:
+        tremolo_depth = 0
+        vibrato_rate = 60
+        vibrato_depth = 30
+
+    modulation = synth_modulation.Modulation_Matrix(2)
+    modulation.set_voice(0, Test_Vibrato_Params)
+    renderer = Note_Renderer(8)
+    for slot, note in enumerate(make_notes()):
+        renderer.start(slot, note)
+    reference_notes = make_notes()
+    slots = np.arange(8)
+    max_difference = 0.0
+    for block in range(40):
+        if block == 10:
+            renderer.note_off(0)
+            renderer.note_off(5)
+            reference_notes[0].note_off()
+            reference_notes[5].note_off()
+        # Notes 0 to 3 have vibrato.
+        steps = modulation.steps(slots // 4, const.MIX_BLOCK_SIZE)
+        modulation.advance(const.MIX_BLOCK_SIZE)
+        output, finished = renderer.render(slots, const.MIX_BLOCK_SIZE, steps)
+        reference = np.array([note.next_segment(const.MIX_BLOCK_SIZE, steps[i]) for i, note in enumerate(reference_notes)])
+        max_difference = max(max_difference, np.max(np.abs(output - reference)))
+    _debug_1("Max difference from Gated_Note = " + str(max_difference) + ", finished = " + str(finished)
+             + ", Gated_Note finished = " + str([note.finished() for note in reference_notes]))
+
+    # Block time against the number of notes, compared with playing each note on its own.
+    for num_notes in [1, 8, 32]:
+        renderer = Note_Renderer(num_notes)
+        notes = []
+        for slot in range(num_notes):
+            envelope = synth_envelope.Envelope_Generator(Test_Params)
+            note = synth_envelope.Gated_Note(tone, loop, envelope, slot, rate=1 + 0.01 * slot)
+            renderer.start(slot, note)
+            notes.append(synth_envelope.Gated_Note(tone, loop, synth_envelope.Envelope_Generator(Test_Params), slot,
+                                                   rate=1 + 0.01 * slot))
+        slots = np.arange(num_notes)
+        num_blocks = 50
+        start = time.perf_counter()
+        for i in range(num_blocks):
+            renderer.render(slots, const.MIX_BLOCK_SIZE)
+        middle = time.perf_counter()
+        for i in range(num_blocks):
+            for note in notes:
+                note.next_segment(const.MIX_BLOCK_SIZE)
+        finish = time.perf_counter()
+        _debug_1(str(num_notes) + " notes: milliseconds per block = " + str(1000 * (middle - start) / num_blocks)
+                 + ", note by note = " + str(1000 * (finish - middle) / num_blocks))
@@ -0,0 +1,210 @@
+# ------------------------------
+# Imports
+# ------------------------------
+import hashlib
+import numpy as np
+import synth_constants as const
+
+# ------------------------------
+# Variables
+# ------------------------------
+# Debug levels: 0 = none, 1 = basic, 2 = long-winded.
+debug_level = 1
+
+DEFAULT_VELOCITY = 127 # Full level, as notes were played before they had a velocity.
+
+# One note of a sequence. start and duration are in timeslots, velocity is 1 to 127 (as MIDI),
+# detune is in cents and pan is from -1.0 (left) to +1.0 (right).
+NOTE_RECORD = np.dtype([("voice", np.int16), ("start", np.int32), ("key", np.int16), ("duration", np.int16),
+                        ("velocity", np.uint8), ("detune", np.float32), ("pan", np.float32)])
+
+# One entry of a song arrangement: a pattern, played repeats times, transposed by some semitones.
+SONG_ENTRY = np.dtype([("pattern", np.int16), ("repeats", np.int16), ("transpose", np.int16)])
+
+# ------------------------------
+#  Notes:
+#
+#  1. The notes of a sequence are kept in one structured numpy array of NOTE_RECORDs, sorted by start time.
+#     Only the notes that exist take any memory (19 bytes each).
+#  2. The notes starting in a timeslot are found with a binary search, and are returned as an array, so they
+#     can be scheduled together with array operations.
+#  3. A song is an arrangement of patterns. Each pattern is a fixed copy of the notes of a sequence, and is
+#     stored once however many times the song uses it. The song is expanded into timeslots as it is played,
+#     so a long song needs no more memory than its patterns.
+# ------------------------------
+
+class Sequence:
+    def __init__(self):
+        self.number = 0
+        self.name = "Blank"
+        self.beats_per_bar = 4
+        self.tempo = 100
+        self.length = 0
+        self.seq_offset = 0
+        self.notes = np.zeros(0, dtype=NOTE_RECORD)
+
+    # Replace all the notes, e.g. with notes read from a file.
+    def set_notes(self, notes):
+        self.notes = np.sort(np.asarray(notes, dtype=NOTE_RECORD), order="start", kind="stable")
+        self._update_length()
+
+    def add_note(self, voice, start, key, duration=1, velocity=DEFAULT_VELOCITY, detune=0.0, pan=0.0):
+        note = np.array([(voice, start, key, duration, velocity, detune, pan)], dtype=NOTE_RECORD)
+        index = np.searchsorted(self.notes["start"], start, side="right")
+        self.notes = np.insert(self.notes, index, note)
+        self._update_length()
+        return index
+
+    # Index of the note of a voice and key that starts in the given timeslot, or -1 if there isn't one.
+    def find_note(self, voice, start, key):
+        first, last = self._timeslot_range(start)
+        notes = self.notes[first:last]
+        matches = np.flatnonzero((notes["voice"] == voice) & (notes["key"] == key))
+        return -1 if len(matches) == 0 else first + int(matches[0])
+
+    def remove_note(self, voice, start, key):
+        index = self.find_note(voice, start, key)
+        if index >= 0:
+            self.notes = np.delete(self.notes, index)
+            self._update_length()
+        return index >= 0
+
+    # The notes that start in a timeslot.
+    def notes_at(self, timeslot):
+        first, last = self._timeslot_range(timeslot)
+        return self.notes[first:last]
+
+    # The notes of one voice.
+    def voice_notes(self, voice):
+        return self.notes[self.notes["voice"] == voice]
+
+    def _timeslot_range(self, timeslot):
+        return _timeslot_range(self.notes, timeslot)
+
+    # The sequence is played up to its last note start.
+    def _update_length(self):
+        self.length = 0 if len(self.notes) == 0 else int(self.notes["start"][-1]) + 1
+
+
+# A fixed block of notes, length timeslots long, that can be used any number of times in a song.
+class Pattern:
+    def __init__(self, notes, length):
+        self.notes = np.sort(np.array(notes, dtype=NOTE_RECORD), order="start", kind="stable")
+        self.notes.flags.writeable = False
+        self.length = length
+        # Identifies the notes and length, e.g. for caching the pattern's audio.
+        self.content_hash = hashlib.sha1(self.notes.tobytes() + str(length).encode()).hexdigest()
+
+    def notes_at(self, timeslot, transpose=0):
+        first, last = _timeslot_range(self.notes, timeslot)
+        notes = self.notes[first:last]
+        if transpose != 0 and len(notes) > 0:
+            notes = notes.copy()
+            notes["key"] += transpose
+            notes = notes[(notes["key"] >= 0) & (notes["key"] < const.NUM_KEYS)]
+        return notes
+
+    def same_as(self, notes, length):
+        return self.length == length and np.array_equal(self.notes, np.sort(np.asarray(notes, dtype=NOTE_RECORD),
+                                                                              order="start", kind="stable"))
+
+
+class Song:
+    def __init__(self):
+        self.patterns = []
+        self.arrangement = np.zeros(0, dtype=SONG_ENTRY)
+
+    def clear(self):
+        self.patterns = []
+        self.arrangement = np.zeros(0, dtype=SONG_ENTRY)
+
+    # Add a pattern, unless the song already has the same one. Returns the pattern's index.
+    def add_pattern(self, notes, length):
+        for index, pattern in enumerate(self.patterns):
+            if pattern.same_as(notes, length):
+                return index
+        self.patterns.append(Pattern(notes, length))
+        return len(self.patterns) - 1
+
+    def append(self, pattern_index, repeats=1, transpose=0):
+        entry = np.array([(pattern_index, repeats, transpose)], dtype=SONG_ENTRY)
+        self.arrangement = np.append(self.arrangement, entry)
+
+    # Length of the song in timeslots.
+    def length(self):
+        if len(self.arrangement) == 0:
+            return 0
+        pattern_lengths = np.array([pattern.length for pattern in self.patterns])
+        return int(np.sum(pattern_lengths[self.arrangement["pattern"]] * self.arrangement["repeats"]))
+
+    # Each time a pattern is played: (start timeslot, pattern index, transpose), made as they are needed.
+    def occurrences(self):
+        start = 0
+        for entry in self.arrangement:
+            pattern_index = int(entry["pattern"])
+            for repeat in range(entry["repeats"]):
+                yield start, pattern_index, int(entry["transpose"])
+                start += self.patterns[pattern_index].length
+
+    # The notes of each timeslot of the song: (timeslot, timeslot in its pattern, notes), made as they are needed.
+    def timeslot_notes(self):
+        for start, pattern_index, transpose in self.occurrences():
+            pattern = self.patterns[pattern_index]
+            for timeslot in range(pattern.length):
+                yield start + timeslot, timeslot, pattern.notes_at(timeslot, transpose)
+
+
+# Indices of the first note starting in a timeslot, and of the first note after them, in notes sorted by start.
+def _timeslot_range(notes, timeslot):
+    starts = notes["start"]
+    return np.searchsorted(starts, timeslot, side="left"), np.searchsorted(starts, timeslot, side="right")
+
+
+def _debug_1(message):
+    global debug_level
+    if debug_level >= 1:
+        print("synth_sequence.py: " + message)
+
+def _debug_2(message):
+    global debug_level
+    if debug_level >= 2:
+        print("synth_sequence.py: " + message)
+
+
+#------------------------- Module Test Functions -------------------------
+if __name__ == "__main__":
+    import time
+
+    sequence = Sequence()
+    rng = np.random.default_rng(1)
+    num_notes = 20000
+    notes = np.zeros(num_notes, dtype=NOTE_RECORD)
+    notes["voice"] = rng.integers(0, const.MAX_VOICES, num_notes)
+    notes["start"] = rng.integers(0, const.MAX_TIMESLOTS, num_notes)
+    notes["key"] = rng.integers(0, const.NUM_KEYS, num_notes)
+    notes["duration"] = rng.integers(1, 8, num_notes)
+    notes["velocity"] = rng.integers(1, 128, num_notes)
+    sequence.set_notes(notes)
+    _debug_1("Notes = " + str(len(sequence.notes)) + ", bytes = " + str(sequence.notes.nbytes)
+             + ", length = " + str(sequence.length))
+
+    start = time.perf_counter()
+    count = sum(len(sequence.notes_at(timeslot)) for timeslot in range(sequence.length))
+    finish = time.perf_counter()
+    _debug_1("Notes found by timeslot = " + str(count) + ", seconds = " + str(finish - start))
+
+    sequence.add_note(3, 10, 40, 2)
+    _debug_1("Added note found at " + str(sequence.find_note(3, 10, 40)) + ", removed = "
+             + str(sequence.remove_note(3, 10, 40)) + ", found after removal = " + str(sequence.find_note(3, 10, 40)))
+
+    # A song of two patterns, one repeated and transposed.
+    song = Song()
+    pattern_notes = sequence.notes[sequence.notes["start"] < 16]
+    first = song.add_pattern(pattern_notes, 16)
+    second = song.add_pattern(sequence.notes[(sequence.notes["start"] >= 16) & (sequence.notes["start"] < 32)], 32)
+    song.append(first, 4)
+    song.append(second, 2, 5)
+    song.append(song.add_pattern(pattern_notes, 16), 1, -12)
+    count = sum(len(notes) for timeslot, pattern_timeslot, notes in song.timeslot_notes())
+    _debug_1("Song: patterns = " + str(len(song.patterns)) + ", length = " + str(song.length())
+             + ", notes played = " + str(count))
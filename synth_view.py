@@ -1,10 +1,12 @@
 # ------------------------------
 # Imports
 # ------------------------------
+import queue
 import guizero
 import numpy as np
 import synth_constants as const
 import synth_audio
+import synth_polyphony
 import voice_editor
 import seq_editor
 
@@ -13,6 +15,8 @@ import seq_editor
 # ------------------------------
 # Debug levels: 0 = none, 1 = basic, 2 = long-winded.
 sv_debug_level = 2
+METER_INTERVAL = 100 # milliseconds between output level meter updates.
+GUI_CALL_INTERVAL = 20 # milliseconds between runs of the calls posted from other threads.
 # ------------------------------
 #  Notes:
 #  
@@ -24,6 +28,9 @@ sv_debug_level = 2
 #  6. All the commands called by GUI widgets are event handler methods in the View class.
 #     This enables the appropriate data to be sent to the controller, independent of any
 #     Widget peculiarities or limitations.
+#  7. Tk is not thread-safe, so only the GUI thread may touch the widgets. Other threads (e.g. the model's
+#     render thread, or the sequence player) post what they want shown with call_in_gui(), and the GUI
+#     thread runs the posted calls every GUI_CALL_INTERVAL.
 # ------------------------------
 class View:
     def __init__(self, controller):
@@ -31,12 +38,16 @@ class View:
         self.voice_window_open = False
         self.sequence_window_open = False
         self.displayed_frequency = const.LOWEST_TONE
+        self.gui_calls = queue.SimpleQueue()
         
 
     def main(self):
         self._debug_1("In view.main()")
         
         synth_audio.initialise_audio()
+        for vi in range(const.MAX_VOICES):
+            synth_audio.set_voice_effects(vi, self.controller.voice_params[vi])
+        synth_audio.set_polyphony(self.controller.polyphony, self.controller.steal_policy)
 
         self.app = guizero.App("Mini-synth", width = 940, height = 350)
         
@@ -46,6 +57,21 @@ class View:
         
         self.sequence_editor_button = guizero.PushButton(self.top_menu, grid=[1,0], text="Sequence editor", command=self.open_sequence_editor)
 
+        self.restore_button = guizero.PushButton(self.top_menu, grid=[2,0], text="Restore settings",
+                                                 command=self._handle_restore_settings)
+
+        guizero.Text(self.top_menu, grid=[3,0], text="  Polyphony: ")
+        self.polyphony_slider = guizero.Slider(self.top_menu, grid=[4,0], start=1, end=const.MAX_POLYPHONY,
+                                               command=self._handle_set_polyphony)
+        self.polyphony_slider.value = self.controller.polyphony
+        self.steal_policy_combo = guizero.Combo(self.top_menu, grid=[5,0], options=synth_polyphony.STEAL_POLICIES,
+                                                command=self._handle_set_steal_policy)
+        self.update_combo(self.steal_policy_combo, self.controller.steal_policy)
+        
+        self.level_display = guizero.Text(self.app, text="")
+        self.app.repeat(METER_INTERVAL, self._show_output_levels)
+        self.app.repeat(GUI_CALL_INTERVAL, self._run_gui_calls)
+
         # set up exit function
         self.app.when_closed = self._handle_close_app
         
@@ -53,6 +79,20 @@ class View:
         self.app.display()
         
         
+    def _handle_restore_settings(self):
+        self._debug_2("In _handle_restore_settings()")
+        self.controller.on_request_restore_settings()
+        self.polyphony_slider.value = self.controller.polyphony
+        self.update_combo(self.steal_policy_combo, self.controller.steal_policy)
+
+    def _handle_set_polyphony(self, value):
+        self._debug_2("In _handle_set_polyphony()")
+        self.controller.on_request_polyphony(int(value))
+
+    def _handle_set_steal_policy(self, value):
+        self._debug_2("In _handle_set_steal_policy()")
+        self.controller.on_request_steal_policy(value)
+
     def open_voice_editor(self):
         if not self.voice_window_open:
             self.voice_editor = voice_editor.Voice_Editor(self)
@@ -62,6 +102,18 @@ class View:
             self._debug_1("WARNING: Voice editor window already exists.")
         
         
+    # Post a call of function(*args) to be run on the GUI thread (see note 7). Safe to call from any thread.
+    def call_in_gui(self, function, *args):
+        self.gui_calls.put((function, args))
+
+    def _run_gui_calls(self):
+        while True:
+            try:
+                function, args = self.gui_calls.get_nowait()
+            except queue.Empty:
+                return
+            function(*args)
+
     def show_new_settings(self):
         self._debug_2("In show_new_settings()")
         if self.voice_window_open == True:
@@ -111,15 +163,46 @@ class View:
             self.seq_editor.show_sequence()   
 
 
+    def show_song(self):
+        self._debug_2("In show_song()")
+        if self.sequence_window_open == True:
+            self.seq_editor.show_song()
+
+    def show_bounce_status(self, status):
+        self._debug_2("In show_bounce_status: " + status)
+        if self.sequence_window_open == True:
+            self.seq_editor.show_bounce_status(status)
+
     def show_cursor(self, timeslot):
         self._debug_2("In show_cursor: timeslot = " + str(timeslot))
         if self.sequence_window_open == True:
             self.seq_editor.show_cursor(timeslot)           
 
         
-    def play_sound(self, wave):
+    def play_sound(self, wave, voice_index=0):
         self._debug_2("In play_sound()")
-        synth_audio.play_sound(wave)
+        synth_audio.play_sound(wave, voice_index)
+
+
+    def set_voice_effects(self, voice_index, params):
+        synth_audio.set_voice_effects(voice_index, params)
+
+
+    def set_polyphony(self, polyphony, policy):
+        synth_audio.set_polyphony(polyphony, policy)
+
+
+    # Gated notes go straight to the audio output, without waiting for the GUI, e.g. from the MIDI input thread.
+    def note_on(self, voice_index, note):
+        synth_audio.note_on(voice_index, note)
+
+
+    def note_off(self, voice_index, key):
+        synth_audio.note_off(voice_index, key)
+
+
+    def get_note_latency(self):
+        return synth_audio.get_note_latency()
         
         
     def shutdown(self):
@@ -128,6 +211,13 @@ class View:
         self.app.destroy()
 
 
+    # Show the output meter readings.
+    def _show_output_levels(self):
+        peak, rms, gain_reduction = synth_audio.get_output_levels()
+        self.level_display.value = ("Output peak: {:6.1f} dB   RMS: {:6.1f} dB   Limiter: {:5.1f} dB"
+                                    .format(peak, rms, -gain_reduction))
+
+
     # Put the selected option at the top of the Combo list.    
     def update_combo(self, combo, option):
         self._debug_2("In update_combo()")
@@ -160,11 +250,11 @@ class View:
 
 #--------------------------- Test Functions ------------------------------
 if __name__ == "__main__":
+    import synth_sequence
 
     const.SAMPLE_RATE = 44100
     MAX_VOICES = 12
     MAX_TIMESLOTS = 60
-    LOWEST_TONE = 110
     DEFAULT_FREQUENCY = 440
     DEFAULT_ATTACK = 20
     DEFAULT_DECAY = 20
@@ -195,26 +285,33 @@ if __name__ == "__main__":
             self.harmonic_boost = 0
             self.unison_voices = 1
             self.unison_detune = 0
+            self.tuning = "Equal"
+            self.harmonic_levels = const.DEFAULT_HARMONIC_LEVELS
+            self.harmonic_phases = ()
+            self.filter_type = "None"
+            self.filter_cutoff = const.DEFAULT_FILTER_CUTOFF
+            self.filter_resonance = const.DEFAULT_FILTER_RESONANCE
+            self.filter_env_depth = 0
+            self.delay_time = 0
+            self.delay_feedback = 0
+            self.chorus_depth = 0
+            self.reverb_level = 0
             
-    class Sequence:
-        def __init__(self):
-            self.number = 0 
-            self.name = "Blank"
-            self.beats_per_bar = 4
-            self.tempo = 100
-            self.notes = np.zeros((MAX_VOICES, MAX_TIMESLOTS, const.NUM_KEYS), dtype=int)
-        
     class TestController:
         def __init__(self):
             self.sample_rate = const.SAMPLE_RATE
             self.frequency = DEFAULT_FREQUENCY
+            self.pitch_bend = 0.0
             self.num_voices = 4
             self.voice_params = []
             self.voice_index = 0
-            self.current_key = 12
+            self.current_key = const.DEFAULT_KEY
             self.num_timeslots = 60
+            self.polyphony = const.MAX_POLYPHONY
+            self.steal_policy = const.STEAL_POLICY
             self.view = View(self)
-            self.sequence = Sequence()
+            self.sequence = synth_sequence.Sequence()
+            self.song = synth_sequence.Song()
         
         def main(self):
             self.view._debug_2("In main of test controller")
@@ -223,6 +320,15 @@ if __name__ == "__main__":
                 self.voice_params.append(voice_params)
             self.view.main()
 
+        def on_request_restore_settings(self):
+            self.view._debug_2("Restore settings requested")
+
+        def on_request_polyphony(self, value):
+            self.view._debug_2("Set polyphony to " + str(value))
+
+        def on_request_steal_policy(self, value):
+            self.view._debug_2("Set steal policy to " + str(value))
+
         def on_request_new_voice(self):
             self._debug_2("New voice requested.")
             
@@ -241,7 +347,7 @@ if __name__ == "__main__":
             self.view._debug_2("Set key to " + str(key))
             # Calculate frequency to display
             self.current_key = key
-            self.displayed_frequency = int((LOWEST_TONE * np.power(2, key/12)) + 0.5)
+            self.displayed_frequency = int((const.LOWEST_TONE * np.power(2, key/12)) + 0.5)
             self.view.show_new_settings()
         
         def on_request_width(self, width):
@@ -279,6 +385,42 @@ if __name__ == "__main__":
 
         def on_request_ring_mod_rate(self, value):
             self.view._debug_2("Set ring_mod_rate to " + str(value))
+
+        def on_request_tuning(self, value):
+            self.view._debug_2("Set tuning to " + str(value))
+
+        def on_request_harmonic_levels(self, levels):
+            self.view._debug_2("Set harmonic_levels to " + str(levels))
+
+        def on_request_harmonic_phases(self, phases):
+            self.view._debug_2("Set harmonic_phases to " + str(phases))
+
+        def on_request_pitch_bend(self, value):
+            self.view._debug_2("Set pitch_bend to " + str(value))
+
+        def on_request_filter_type(self, value):
+            self.view._debug_2("Set filter_type to " + str(value))
+
+        def on_request_filter_cutoff(self, value):
+            self.view._debug_2("Set filter_cutoff to " + str(value))
+
+        def on_request_filter_resonance(self, value):
+            self.view._debug_2("Set filter_resonance to " + str(value))
+
+        def on_request_filter_env_depth(self, value):
+            self.view._debug_2("Set filter_env_depth to " + str(value))
+
+        def on_request_delay_time(self, value):
+            self.view._debug_2("Set delay_time to " + str(value))
+
+        def on_request_delay_feedback(self, value):
+            self.view._debug_2("Set delay_feedback to " + str(value))
+
+        def on_request_chorus_depth(self, value):
+            self.view._debug_2("Set chorus_depth to " + str(value))
+
+        def on_request_reverb_level(self, value):
+            self.view._debug_2("Set reverb_level to " + str(value))
            
         def on_request_play(self):
             self.view._debug_2("Play note requested")
@@ -301,6 +443,27 @@ if __name__ == "__main__":
         def on_request_play_sequence(self):
             self.view._debug_2("Play sequence requested")
             
+        def on_request_set_note_length(self, value):
+            self.view._debug_2("Set note length to " + str(value))
+            
+        def on_request_import_midi(self, filename):
+            self.view._debug_2("Import MIDI file requested: " + filename)
+            
+        def on_request_export_midi(self, filename):
+            self.view._debug_2("Export MIDI file requested: " + filename)
+
+        def on_request_add_to_song(self, repeats, transpose):
+            self.view._debug_2("Add to song requested: " + str(repeats) + " times, transpose " + str(transpose))
+
+        def on_request_clear_song(self):
+            self.view._debug_2("Clear song requested")
+
+        def on_request_play_song(self):
+            self.view._debug_2("Play song requested")
+
+        def on_request_bounce_song(self, filename):
+            self.view._debug_2("Bounce song requested: " + filename)
+            
         def save_settings(self):
             self.view._debug_2("Save settings requested")
             
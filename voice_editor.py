@@ -5,15 +5,22 @@
 import guizero
 import numpy as np
 import synth_constants as const
+import synth_filter
+import synth_pitch
 
 # ------------------------------
 # Module globals
 # ------------------------------
 # Keyboard constants
 
-white_keys = [0, 2, 4, 5, 7, 9, 11]
-black_keys = [1, 3, -1000, 6, 8, 10, -1000]
-NUM_WHITE_KEYS = int((7 * const.NUM_OCTAVES) + 1)
+# Each key's position is the number of white keys to its left, so a black key sits between positions.
+IS_BLACK_KEY = synth_pitch.is_black_key(np.arange(const.NUM_KEYS))
+KEY_POSITIONS = np.cumsum(~IS_BLACK_KEY) - 1
+NUM_WHITE_KEYS = int(np.count_nonzero(~IS_BLACK_KEY))
+# Key numbers of the white keys, and of the black key after each white key (-1 if there is none).
+white_keys = np.flatnonzero(~IS_BLACK_KEY)
+black_keys = np.full(NUM_WHITE_KEYS, -1)
+black_keys[KEY_POSITIONS[IS_BLACK_KEY]] = np.flatnonzero(IS_BLACK_KEY)
 KEY_X_SPACING = int(min(40, (1200 / NUM_WHITE_KEYS)))
 WK_X0 = 25
 WK_Y0 = 25
@@ -23,23 +30,60 @@ WK_HEIGHT = 60
 WK_WIDTH = int(0.75 * KEY_X_SPACING)
 BK_HEIGHT = 30
 BK_WIDTH = int(0.75 * KEY_X_SPACING)
-KEYBOARD_WIDTH = (7 * const.NUM_OCTAVES  * KEY_X_SPACING) + WK_WIDTH + (2 * WK_X0)
+KEYBOARD_WIDTH = ((NUM_WHITE_KEYS - 1) * KEY_X_SPACING) + WK_WIDTH + (2 * WK_X0)
 KEYBOARD_HEIGHT = WK_HEIGHT + (2 *  WK_Y0)
-NUM_WHITE_KEYS = (const.NUM_OCTAVES * 7) + 1
-NUM_BLACK_KEYS = (const.NUM_OCTAVES * 7) - 1
-NUM_KEYS = (12 * const.NUM_OCTAVES) + 1
 
 # Widget sizes
 
 VOICE_EDITOR_WIDTH = KEYBOARD_WIDTH + 50
 SCOPE_HEIGHT = 280
 SCOPE_WIDTH = VOICE_EDITOR_WIDTH - 440
-NUM_TONE_SLIDERS = 3 + (2 * const.UNISON_ENABLED) + const.HARMONIC_BOOST_ENABLED + const.RING_MODULATION_ENABLED
-NUM_ENVELOPE_SLIDERS = 5 + (2 * const.TREMOLO_ENABLED)
+NUM_TONE_SLIDERS = 3 + (2 * const.UNISON_ENABLED) + const.HARMONIC_BOOST_ENABLED + const.RING_MODULATION_ENABLED + (4 * const.VCF_ENABLED)
+NUM_ENVELOPE_SLIDERS = 5 + (2 * const.TREMOLO_ENABLED) + (4 * const.EFFECTS_ENABLED)
 VOICE_EDITOR_HEIGHT = 200 + max(50 + (NUM_TONE_SLIDERS * 40), SCOPE_HEIGHT) + max(NUM_ENVELOPE_SLIDERS * 40, SCOPE_HEIGHT)
 
+# Scope redraw timing
+
+REDRAW_INTERVAL = 40 # milliseconds, i.e. at most 25 scope redraws per second.
+
 debug_level = 2
 
+# ------------------------------
+# Module functions
+# ------------------------------
+
+# Reduce a trace to a minimum and a maximum value for each plotted column, so that
+# peaks are not lost when thousands of samples are squeezed into a few hundred pixels.
+# Returns x (column) and y arrays with two points per column, ready to draw as one polyline.
+def min_max_decimate(trace, num_columns):
+    num_columns = max(1, min(int(num_columns), len(trace)))
+    bin_size = len(trace) // num_columns
+    bins = np.reshape(trace[:bin_size * num_columns], (num_columns, bin_size))
+    plot_y = np.empty(2 * num_columns, dtype=float)
+    plot_y[0::2] = np.min(bins, axis=1)
+    plot_y[1::2] = np.max(bins, axis=1)
+    plot_x = np.repeat(np.arange(num_columns, dtype=float), 2)
+    return plot_x, plot_y
+
+# Round the length of a trace up to a tidy timescale: steps of 20 ms up to 100 ms, then steps of 50 ms.
+def _timescale_length(num_samples):
+    num_points = const.SAMPLE_RATE * 0.020
+    while num_points < num_samples:
+        if num_points < const.SAMPLE_RATE * 0.1:
+            num_points += const.SAMPLE_RATE * 0.020 # add 20 msec to timescale
+        else:
+            num_points += const.SAMPLE_RATE * 0.050 # add 50 msec to timescale
+    return int(num_points)
+
+# Draw a whole trace as a single canvas item, rather than one line item per point.
+def _draw_polyline(drawing, plot_x, plot_y, colour, width):
+    coords = np.column_stack((plot_x, plot_y)).astype(int).ravel().tolist()
+    drawing.tk.create_line(*coords, fill=colour, width=width)
+
+# Whole numbers typed into a text box, ignoring anything else, e.g. "100 50, 33" gives [100, 50, 33].
+def _numbers(text):
+    return [int(word) for word in text.replace(",", " ").split() if word.lstrip("-").isdigit()]
+
 # ------------------------------
 # Module class
 # ------------------------------
@@ -49,6 +93,10 @@ class Voice_Editor:
         self.view = view
         self.previous_key = 0
         self.displayed_frequency = const.LOWEST_TONE
+        self.voice_window_open = False
+        self.redraw_scheduled = False
+        self.pending_sound = None
+        self.pending_envelope = None
        
 
     def main(self):
@@ -83,6 +131,10 @@ class Voice_Editor:
         guizero.Text(self.panel_1, grid=[5,0], text="  ")      
         self.play_button = guizero.PushButton(self.panel_1, grid=[6,0], text="Play note", command=self._handle_request_play)
         self.sequence_button = guizero.PushButton(self.panel_1, grid=[7,0], text="100 notes", command=self._handle_request_test)
+        guizero.Text(self.panel_1, grid=[8,0], text="  Pitch bend, cents: ")
+        self.pitch_bend_slider = guizero.Slider(self.panel_1, grid=[9,0], start=-const.MAX_PITCH_BEND, end=const.MAX_PITCH_BEND,
+                                     width=200, command=self._handle_set_pitch_bend)
+        self.pitch_bend_slider.value = int(100 * self.view.controller.pitch_bend)
                
         self.keyboard = guizero.Drawing(self.window, KEYBOARD_WIDTH, KEYBOARD_HEIGHT)
         self._draw_keyboard()
@@ -103,8 +155,10 @@ class Voice_Editor:
             voice_name_list.append(voice_name)
         self.voice_combo = guizero.Combo(self.voice_controls_panel, grid=[1,0], options=voice_name_list,
                                      height="fill", command=self._handle_select_voice)                
-        self.waveform_combo = guizero.Combo(self.voice_controls_panel, grid=[2,0], options=["Sine","Triangle","Sawtooth","Square"],
+        self.waveform_combo = guizero.Combo(self.voice_controls_panel, grid=[2,0], options=["Sine","Triangle","Sawtooth","Square","Additive"],
                                      height="fill", command=self._handle_set_waveform)
+        self.tuning_combo = guizero.Combo(self.voice_controls_panel, grid=[3,0], options=synth_pitch.TUNING_NAMES,
+                                     height="fill", command=self._handle_set_tuning)
         
         self.voice_sliders_panel = guizero.Box(self.tone_settings_panel, layout="grid", grid=[0,1])
         self.width_label = guizero.Text(self.voice_sliders_panel, grid=[0,1], text="Width, % ")
@@ -142,6 +196,36 @@ class Voice_Editor:
                                      width=200, command=self._handle_set_ring_mod_rate)
         self.ring_mod_rate_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].ring_mod_rate
         
+        self.filter_type_label = guizero.Text(self.voice_sliders_panel, grid=[0,8], text="Filter: ")
+        self.filter_type_combo = guizero.Combo(self.voice_sliders_panel, grid=[1,8], options=synth_filter.FILTER_TYPES,
+                                     command=self._handle_set_filter_type)
+        
+        self.filter_cutoff_label = guizero.Text(self.voice_sliders_panel, grid=[0,9], text="Filter frequency, semitones: ")
+        self.filter_cutoff_slider = guizero.Slider(self.voice_sliders_panel, grid=[1,9], start=0, end=const.MAX_FILTER_CUTOFF,
+                                     width=200, command=self._handle_set_filter_cutoff)
+        self.filter_cutoff_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_cutoff
+        
+        self.filter_resonance_label = guizero.Text(self.voice_sliders_panel, grid=[0,10], text="Filter resonance (Q): ")
+        self.filter_resonance_slider = guizero.Slider(self.voice_sliders_panel, grid=[1,10], start=1, end=const.MAX_FILTER_RESONANCE,
+                                     width=200, command=self._handle_set_filter_resonance)
+        self.filter_resonance_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_resonance
+        
+        self.filter_env_depth_label = guizero.Text(self.voice_sliders_panel, grid=[0,11], text="Filter envelope, semitones: ")
+        self.filter_env_depth_slider = guizero.Slider(self.voice_sliders_panel, grid=[1,11], start=0, end=const.MAX_FILTER_ENV_DEPTH,
+                                     width=200, command=self._handle_set_filter_env_depth)
+        self.filter_env_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_env_depth
+        
+        # Harmonics of the additive waveform, as lists of numbers from the fundamental up.
+        self.harmonic_levels_label = guizero.Text(self.voice_sliders_panel, grid=[0,12], text="Harmonic levels, %: ")
+        self.harmonic_levels_box = guizero.TextBox(self.voice_sliders_panel, grid=[1,12], width=30)
+        self.harmonic_phases_label = guizero.Text(self.voice_sliders_panel, grid=[0,13], text="Harmonic phases, degrees: ")
+        self.harmonic_phases_box = guizero.TextBox(self.voice_sliders_panel, grid=[1,13], width=30)
+        # TextBox commands run on every key, so apply the harmonics only when typing is finished (Enter or focus out).
+        for event in ["<Return>", "<FocusOut>"]:
+            self.harmonic_levels_box.tk.bind(event, self._handle_set_harmonic_levels)
+            self.harmonic_phases_box.tk.bind(event, self._handle_set_harmonic_phases)
+        self._show_harmonics(self.view.controller.voice_params[self.view.controller.voice_index].waveform)
+
         if not const.HARMONIC_BOOST_ENABLED:
             self.harmonic_boost_label.hide()
             self.harmonic_boost_slider.hide()
@@ -158,6 +242,15 @@ class Voice_Editor:
             self.unison_voices_slider.hide()
             self.unison_detune_label.hide()
             self.unison_detune_slider.hide()
+        if not const.VCF_ENABLED:
+            self.filter_type_label.hide()
+            self.filter_type_combo.hide()
+            self.filter_cutoff_label.hide()
+            self.filter_cutoff_slider.hide()
+            self.filter_resonance_label.hide()
+            self.filter_resonance_slider.hide()
+            self.filter_env_depth_label.hide()
+            self.filter_env_depth_slider.hide()
             
 
     def _envelope_settings_controls(self):
@@ -198,13 +291,42 @@ class Voice_Editor:
                                      width=200, command=self._handle_set_tremolo_depth)
         self.tremolo_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].tremolo_depth
         
+        self.delay_time_label = guizero.Text(self.envelope_settings_panel, grid=[0,7], text="Echo delay, ms: ")
+        self.delay_time_slider = guizero.Slider(self.envelope_settings_panel, grid=[1,7], start=0, end=const.MAX_DELAY_TIME,
+                                     width=200, command=self._handle_set_delay_time)
+        self.delay_time_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].delay_time
+        
+        self.delay_feedback_label = guizero.Text(self.envelope_settings_panel, grid=[0,8], text="Echo feedback, %: ")
+        self.delay_feedback_slider = guizero.Slider(self.envelope_settings_panel, grid=[1,8], start=0, end=const.MAX_DELAY_FEEDBACK,
+                                     width=200, command=self._handle_set_delay_feedback)
+        self.delay_feedback_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].delay_feedback
+        
+        self.chorus_depth_label = guizero.Text(self.envelope_settings_panel, grid=[0,9], text="Chorus depth, %: ")
+        self.chorus_depth_slider = guizero.Slider(self.envelope_settings_panel, grid=[1,9], start=0, end=const.MAX_CHORUS_DEPTH,
+                                     width=200, command=self._handle_set_chorus_depth)
+        self.chorus_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].chorus_depth
+        
+        self.reverb_level_label = guizero.Text(self.envelope_settings_panel, grid=[0,10], text="Reverb level, %: ")
+        self.reverb_level_slider = guizero.Slider(self.envelope_settings_panel, grid=[1,10], start=0, end=const.MAX_REVERB_LEVEL,
+                                     width=200, command=self._handle_set_reverb_level)
+        self.reverb_level_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].reverb_level
+        
         if not const.TREMOLO_ENABLED:
             self.tremolo_rate_label.hide()
             self.tremolo_rate_slider.hide()    
             self.tremolo_depth_label.hide()
             self.tremolo_depth_slider.hide()           
+        if not const.EFFECTS_ENABLED:
+            self.delay_time_label.hide()
+            self.delay_time_slider.hide()
+            self.delay_feedback_label.hide()
+            self.delay_feedback_slider.hide()
+            self.chorus_depth_label.hide()
+            self.chorus_depth_slider.hide()
+            self.reverb_level_label.hide()
+            self.reverb_level_slider.hide()
    
-    def _draw_keyboard(self, num_octaves=const.NUM_OCTAVES):
+    def _draw_keyboard(self):
         self._debug_2("In _draw_keyboard()")
         self.keyboard.rectangle(0, 0, KEYBOARD_WIDTH, KEYBOARD_HEIGHT, color = "green")
 
@@ -213,8 +335,8 @@ class Voice_Editor:
             key_top = WK_Y0
             self.keyboard.rectangle(key_left, key_top, key_left + WK_WIDTH, key_top + WK_HEIGHT, color = "white")
 
-        for i in range(NUM_BLACK_KEYS):
-            if (i % 7) in [0, 1, 3, 4, 5]:
+        for i in range(NUM_WHITE_KEYS):
+            if black_keys[i] >= 0:
                 key_left = BK_X0 + KEY_X_SPACING * i
                 key_top = BK_Y0
                 self.keyboard.rectangle(key_left, key_top, key_left + BK_WIDTH, key_top + BK_HEIGHT, color = "black")
@@ -233,6 +355,7 @@ class Voice_Editor:
         self.view.update_combo(self.voice_combo, voice_name)
         waveform = self.view.controller.voice_params[self.view.controller.voice_index].waveform
         self.view.update_combo(self.waveform_combo, waveform)
+        self.view.update_combo(self.tuning_combo, self.view.controller.voice_params[self.view.controller.voice_index].tuning)
         self.attack_slider.value = str(self.view.controller.voice_params[self.view.controller.voice_index].attack)
         self.decay_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].decay
         self.sustain_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].sustain_time
@@ -243,6 +366,16 @@ class Voice_Editor:
         self.ring_mod_rate_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].ring_mod_rate
         self.tremolo_rate_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].tremolo_rate
         self.tremolo_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].tremolo_depth
+        if const.VCF_ENABLED:
+            self.view.update_combo(self.filter_type_combo, self.view.controller.voice_params[self.view.controller.voice_index].filter_type)
+            self.filter_cutoff_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_cutoff
+            self.filter_resonance_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_resonance
+            self.filter_env_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].filter_env_depth
+        if const.EFFECTS_ENABLED:
+            self.delay_time_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].delay_time
+            self.delay_feedback_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].delay_feedback
+            self.chorus_depth_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].chorus_depth
+            self.reverb_level_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].reverb_level
         if waveform == "Sawtooth" or waveform == "Square":
             self.width_label.show()
             self.width_slider.show()
@@ -261,119 +394,126 @@ class Voice_Editor:
             self.unison_voices_slider.hide()
             self.unison_detune_label.hide()
             self.unison_detune_slider.hide()
-        if not waveform == "Sine" and const.HARMONIC_BOOST_ENABLED:
+        if waveform in ["Triangle", "Sawtooth", "Square"] and const.HARMONIC_BOOST_ENABLED:
             self.harmonic_boost_label.show()
             self.harmonic_boost_slider.show()
             self.harmonic_boost_slider.value = self.view.controller.voice_params[self.view.controller.voice_index].harmonic_boost
         else:
             self.harmonic_boost_label.hide()
             self.harmonic_boost_slider.hide()
+        self._show_harmonics(waveform)
+
+    # Show the harmonics of the voice if it is additive, otherwise hide them.
+    def _show_harmonics(self, waveform):
+        voice_params = self.view.controller.voice_params[self.view.controller.voice_index]
+        widgets = [self.harmonic_levels_label, self.harmonic_levels_box, self.harmonic_phases_label, self.harmonic_phases_box]
+        if waveform == "Additive":
+            self.harmonic_levels_box.value = " ".join(str(level) for level in voice_params.harmonic_levels)
+            self.harmonic_phases_box.value = " ".join(str(phase) for phase in voice_params.harmonic_phases)
+            for widget in widgets:
+                widget.show()
+        else:
+            for widget in widgets:
+                widget.hide()
 
     def show_frequency(self, frequency):
         self._debug_2("In show_frequency()")
-        self.displayed_frequency = int(frequency)
+        self.displayed_frequency = round(float(frequency), 1)
         self.freq_display.value = self.displayed_frequency
 
+    # Queue the envelope for plotting. Rapid changes are coalesced into one redraw per frame.
     def plot_envelope(self, envelope):
         self._debug_2("In plot_envelope()")
-        self.control_scope.clear()
-        self.control_scope.bg = "dark gray"            
-        # Set graph origin to the bottom, left corner of the drawing area. Envelope always >= 0.
-        origin_x = 0
-        origin_y = self.control_scope.height
-        # Set initial values of the start of the lines being drawn.
-        previous_x = origin_x
-        previous_y = origin_y
-        # Set the number of points to plot. 
-        num_points = const.SAMPLE_RATE * 0.020 # 20 miliseconds worth of input samples.
-        # Increase no. of points to plot in steps of 50ms worth of samples.
-        while num_points < len(envelope):
-            if num_points < const.SAMPLE_RATE * 0.1:
-                num_points += const.SAMPLE_RATE * 0.020 # add 20 msec to timescale
-            else:
-                num_points += const.SAMPLE_RATE * 0.050 # add 50 msec to timescale
-        # Scale down the x axis
-        sub_sampling_factor = 9 # found by trial and error
-        num_points = int(num_points // sub_sampling_factor) + sub_sampling_factor
-        self._debug_2("Envelope length, graph length = " + str(len(envelope)) + ", " + str(num_points))
-        scope_trace = np.zeros(int(num_points), dtype = float)
-        max_env = max(envelope)
-        env_points = int(len(envelope) / sub_sampling_factor)
-        # Select and normalise the envelope points to be plotted
-        for i in range(env_points):
-            scope_trace[i] += envelope[int(i * sub_sampling_factor)] / max_env
-        # Calculate scale factors to fit plot inside drawing widget.
-        scale_x = (self.control_scope.width - 5) / num_points
-        scale_y = (self.control_scope.height - 5) 
-        self._debug_2("scale_y = " + str(scale_y))
-        for i in range(num_points):
-            # Note pixel (0,0) is in the top left of the Drawing, so we need to invert the y data.
-            plot_y = int(origin_y - (scale_y * scope_trace[i]))
-            plot_x = int(origin_x + (scale_x * i))
-            self.control_scope.line(previous_x, previous_y, plot_x, plot_y, color="light green", width=2)
-            previous_x = plot_x
-            previous_y = plot_y
-            
-                    
+        self.pending_envelope = envelope
+        self._schedule_redraw()
+
+    # Queue the sound for plotting. Rapid changes are coalesced into one redraw per frame.
     def plot_sound(self, wave):
-        self._debug_2("In _plot_sound()")
+        self._debug_2("In plot_sound()")
         if self.voice_window_open == False:
             self._debug_2("Can't plot sounds as voice editor window is closed.")
             return
-        left_channel = np.hsplit(wave,2)[0]
-        # right_channel = np.hsplit(wave,2)[1]
-        self._debug_2("Waveform length in _plot_sound() = " + str(len(wave)))
-        max_level = np.max(np.abs(left_channel))
-        if max_level == 0:
+        self.pending_sound = wave
+        self._schedule_redraw()
+
+    # Ask Tk to redraw the scopes on the next frame, unless a redraw is already waiting.
+    def _schedule_redraw(self):
+        if not self.redraw_scheduled:
+            self.redraw_scheduled = True
+            self.window.after(REDRAW_INTERVAL, self._redraw_scopes)
+
+    # Draw only the latest sound and envelope. Any older data queued since the last frame is dropped.
+    def _redraw_scopes(self):
+        self._debug_2("In _redraw_scopes()")
+        self.redraw_scheduled = False
+        if self.voice_window_open == False:
+            return
+        envelope = self.pending_envelope
+        wave = self.pending_sound
+        self.pending_envelope = None
+        self.pending_sound = None
+        if not envelope is None:
+            self._draw_envelope(envelope)
+        if not wave is None:
+            self._draw_sound(wave)
+
+    def _draw_envelope(self, envelope):
+        self._debug_2("In _draw_envelope()")
+        self.control_scope.clear()
+        self.control_scope.bg = "dark gray"
+        max_env = np.max(envelope)
+        if max_env <= 0:
+            self._debug_1("WARNING: zero envelope in plot_envelope().")
+            return
+        # Set graph origin to the bottom, left corner of the drawing area. Envelope always >= 0.
+        origin_y = self.control_scope.height
+        # Normalise the envelope and pad it with zeros to fill the timescale.
+        num_points = _timescale_length(len(envelope))
+        scope_trace = np.zeros(num_points, dtype=float)
+        scope_trace[:len(envelope)] = envelope / max_env
+        # Calculate scale factors to fit plot inside drawing widget.
+        scale_y = (self.control_scope.height - 5)
+        plot_x, plot_y = min_max_decimate(scope_trace, self.control_scope.width - 5)
+        # Note pixel (0,0) is in the top left of the Drawing, so we need to invert the y data.
+        plot_y = origin_y - (scale_y * plot_y)
+        _draw_polyline(self.control_scope, plot_x, plot_y, "light green", 2)
+
+    def _draw_sound(self, wave):
+        self._debug_2("In _draw_sound()")
+        left_channel = wave[:, 0] if wave.ndim == 2 else wave
+        self._debug_2("Waveform length in _draw_sound() = " + str(len(wave)))
+        max_y = np.max(left_channel)
+        min_y = np.min(left_channel)
+        self._debug_2("Audio waveform (min, max) = " + str(min_y) + ", " + str(max_y) + ")")
+        max_y_range = max_y - min_y
+        if max_y_range == 0:
             self._debug_1("WARNING: zero waveform in plot_sound().")
             return -1
-        
+
         self.audio_scope.clear()
         self.audio_scope.bg = "dark gray"
         self.duration_display.value = str(int(len(left_channel) * 1000 / const.SAMPLE_RATE))
-        
+
         # Set graph origin to the middle, left edge of the drawing area.
-        origin_x = 0
         origin_y = int(self.audio_scope.height / 2)
-        # Set initial values of the start of the lines being drawn.
-        previous_x = origin_x
-        previous_y = origin_y
-        # Set the number of points to plot. 
-        num_points = const.SAMPLE_RATE * 0.020 # 20 miliseconds worth of input samples.
-        # Increase no. of points to plot in steps of 50ms worth of samples.
-        while num_points < len(left_channel):
-            if num_points < const.SAMPLE_RATE * 0.1:
-                num_points += const.SAMPLE_RATE * 0.020 # add 20 msec to timescale
-            else:
-                num_points += const.SAMPLE_RATE * 0.050 # add 50 msec to timescale
-        # Scale down the x axis
-        sub_sampling_factor = 2 # found by trial and error
-        num_points = int(num_points // sub_sampling_factor) + sub_sampling_factor
+        # Pad the note with silence to fill the timescale.
+        num_points = _timescale_length(len(left_channel))
+        scope_trace = np.zeros(num_points, dtype=float)
+        scope_trace[:len(left_channel)] = left_channel
         self._debug_2("Note length, graph length = " + str(len(left_channel)) + ", " + str(num_points))
-        scope_trace = np.zeros(int(num_points), dtype = float)
-        
-        note_points = int(len(left_channel) / sub_sampling_factor)
-        # Select the note points to be plotted
-        for i in range(note_points):
-            scope_trace[i] += left_channel[int(i * sub_sampling_factor)]
         # Calculate scale factors to fit plot inside drawing widget.
-        scale_x = (self.audio_scope.width - 5)/ num_points
-        max_y = max(left_channel)
-        min_y = min(left_channel)
-        self._debug_2("Audio waveform (min, max) = " + str(min_y) + ", " + str(max_y) + ")")
-        max_y_range = max_y - min_y
-        scale_y = 0.9 * (self.audio_scope.height - 5)/ max_y_range
-        x_offset = 0
-        for i in range(num_points):
-            # Note pixel (0,0) is in the top left of the Drawing, so we need to invert the y data.
-            plot_y = int(origin_y - (scale_y * scope_trace[int(i + x_offset)]))
-            plot_x = int(origin_x + (scale_x * i))
-            self.audio_scope.line(previous_x, previous_y, plot_x, plot_y, color="light green", width=2)
-            previous_x = plot_x
-            previous_y = plot_y
+        scale_y = 0.9 * (self.audio_scope.height - 5) / max_y_range
+        plot_x, plot_y = min_max_decimate(scope_trace, self.audio_scope.width - 5)
+        # Note pixel (0,0) is in the top left of the Drawing, so we need to invert the y data.
+        plot_y = origin_y - (scale_y * plot_y)
+        _draw_polyline(self.audio_scope, plot_x, plot_y, "light green", 2)
 
     def _closed_voice_editor(self):
         self._debug_1("Voice editor closed")
+        if self.redraw_scheduled:
+            self.window.cancel(self._redraw_scopes)
+            self.redraw_scheduled = False
+        self.voice_window_open = False
         self.view.on_request_voice_editor_closed()
         self.window.destroy()
 
@@ -398,23 +538,21 @@ class Voice_Editor:
         
         if y > BK_Y0 and y < BK_Y0 + BK_HEIGHT:
             
-            if x > BK_X0 and (x - BK_X0) % KEY_X_SPACING < BK_WIDTH:
-                octave = int((x - WK_X0) / (7 * KEY_X_SPACING))
-                octave_origin = (7 * octave * KEY_X_SPACING) + BK_X0
-                key = black_keys[int((x - octave_origin) / KEY_X_SPACING)] + (12 * octave)
+            position = int((x - BK_X0) / KEY_X_SPACING)
+            if x > BK_X0 and position < NUM_WHITE_KEYS and (x - BK_X0) % KEY_X_SPACING < BK_WIDTH:
+                key = int(black_keys[position])
                 if key >= 0:
                     self._debug_2("Black key pressed with number = " + str(key))
                       
         elif y > BK_Y0 + BK_HEIGHT and y < BK_Y0 + WK_HEIGHT:
             
-            if x > WK_X0 and (x - WK_X0) % KEY_X_SPACING < WK_WIDTH:
-                octave = int((x - WK_X0) / (7 * KEY_X_SPACING))
-                octave_origin = (7 * octave * KEY_X_SPACING) + WK_X0
-                key = white_keys[int((x - octave_origin) / KEY_X_SPACING)] + (12 * octave)
+            position = int((x - WK_X0) / KEY_X_SPACING)
+            if x > WK_X0 and position < NUM_WHITE_KEYS and (x - WK_X0) % KEY_X_SPACING < WK_WIDTH:
+                key = int(white_keys[position])
                 if key >= 0:
                     self._debug_2("White key pressed with number = " + str(key))
         # Do extra safety-check (shouldn't really be necessary!)
-        if key >= NUM_KEYS:
+        if key >= const.NUM_KEYS:
             key = -1
         return key
         
@@ -476,6 +614,20 @@ class Voice_Editor:
         self._debug_2("In _handle_set_harmonic_boost()")
         self.view.controller.on_request_harmonic_boost(int(value))
         
+    def _handle_set_harmonic_levels(self, event=None):
+        self._debug_2("In _handle_set_harmonic_levels()")
+        levels = _numbers(self.harmonic_levels_box.value)
+        voice_params = self.view.controller.voice_params[self.view.controller.voice_index]
+        if tuple(levels) != voice_params.harmonic_levels:
+            self.view.controller.on_request_harmonic_levels(levels)
+
+    def _handle_set_harmonic_phases(self, event=None):
+        self._debug_2("In _handle_set_harmonic_phases()")
+        phases = _numbers(self.harmonic_phases_box.value)
+        voice_params = self.view.controller.voice_params[self.view.controller.voice_index]
+        if tuple(phases) != voice_params.harmonic_phases:
+            self.view.controller.on_request_harmonic_phases(phases)
+        
     def _handle_set_vibrato_rate(self, value):
         self._debug_2("In _handle_set_vibrato_rate()")
         self.view.controller.on_request_vibrato_rate(int(value))
@@ -496,6 +648,46 @@ class Voice_Editor:
         self._debug_2("In _handle_set_ring_mod_rate()")
         self.view.controller.on_request_ring_mod_rate(int(value))
         
+    def _handle_set_tuning(self, value):
+        self._debug_2("In _handle_set_tuning()")
+        self.view.controller.on_request_tuning(value)
+        
+    def _handle_set_pitch_bend(self, value):
+        self._debug_2("In _handle_set_pitch_bend()")
+        self.view.controller.on_request_pitch_bend(int(value))
+        
+    def _handle_set_filter_type(self, value):
+        self._debug_2("In _handle_set_filter_type()")
+        self.view.controller.on_request_filter_type(value)
+        
+    def _handle_set_filter_cutoff(self, value):
+        self._debug_2("In _handle_set_filter_cutoff()")
+        self.view.controller.on_request_filter_cutoff(int(value))
+        
+    def _handle_set_filter_resonance(self, value):
+        self._debug_2("In _handle_set_filter_resonance()")
+        self.view.controller.on_request_filter_resonance(int(value))
+        
+    def _handle_set_filter_env_depth(self, value):
+        self._debug_2("In _handle_set_filter_env_depth()")
+        self.view.controller.on_request_filter_env_depth(int(value))
+        
+    def _handle_set_delay_time(self, value):
+        self._debug_2("In _handle_set_delay_time()")
+        self.view.controller.on_request_delay_time(int(value))
+        
+    def _handle_set_delay_feedback(self, value):
+        self._debug_2("In _handle_set_delay_feedback()")
+        self.view.controller.on_request_delay_feedback(int(value))
+        
+    def _handle_set_chorus_depth(self, value):
+        self._debug_2("In _handle_set_chorus_depth()")
+        self.view.controller.on_request_chorus_depth(int(value))
+        
+    def _handle_set_reverb_level(self, value):
+        self._debug_2("In _handle_set_reverb_level()")
+        self.view.controller.on_request_reverb_level(int(value))
+        
     def _handle_request_play(self):
         self._debug_2("In _handle_request_play()")
         self.view.controller.on_request_play()